@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+import warnings
+import numpy as np
+from model import GRADES_DECIMAL_ROUNDING
+
+# Statistics of the grades of a curriculum or of a course: averages, ranks,
+# percentiles, distributions and failure rates of the students, computed in
+# the process from the grades read at once by Model.curriculumGrades() or
+# Model.courseGrades(), instead of one more query per statistic.
+#
+# The grades are loaded into a students x validations matrix (see Grades), in
+# which a missing grade is 0, as in the stored averages (see README.md): the
+# average of a student in a course is the mean of the grades of its
+# validations weighted by their coefficients, and the average in a
+# curriculum the mean of the averages of its courses weighted by their ECTS,
+# ignoring the courses without validations. Every statistic is computed for
+# all the students, courses or validations at once, by NumPy operations on
+# the whole matrix.
+
+# Average below which a student fails a course or a curriculum.
+PASSING_GRADE = 10
+
+# Bounds of the intervals of the distributions of the grades, the last one
+# including 20.
+HISTOGRAM_BINS = np.linspace(0, 20, 11)
+
+# The grades of some students in the validations of some courses, from the
+# row of GRADE_DATA_SQL.
+#   - studentIds, lastnames, firstnames: the students, by name;
+#   - courseIds, courseNames, ects: the courses, by name;
+#   - validationIds, validationNames, coefficients: the validations, by date;
+#   - weights: courses x validations matrix of the coefficient of each
+#     validation in its course (0 for the other courses);
+#   - grades: students x validations matrix of the grades, 0 if missing.
+class Grades:
+    def __init__(self, data):
+        array = lambda name, dtype: np.array(getattr(data, name) or [], dtype=dtype)
+        self.studentIds = array('student_ids', np.int64)
+        self.lastnames = data.student_lastnames or []
+        self.firstnames = data.student_firstnames or []
+        self.courseIds = array('course_ids', np.int64)
+        self.courseNames = data.course_names or []
+        self.ects = array('course_ects', np.float64)
+        self.validationIds = array('validation_ids', np.int64)
+        self.validationNames = data.validation_names or []
+        self.coefficients = array('validation_coefficients', np.float64)
+
+        courses = index_of(self.courseIds, array('validation_courses', np.int64))
+        self.weights = np.zeros((len(self.courseIds), len(self.validationIds)))
+        self.weights[courses, np.arange(len(self.validationIds))] = self.coefficients
+
+        students = index_of(self.studentIds, array('grade_students', np.int64))
+        validations = index_of(self.validationIds, array('grade_validations', np.int64))
+        self.grades = np.zeros((len(self.studentIds), len(self.validationIds)))
+        self.grades[students, validations] = array('grade_values', np.float64)
+
+    # Return the students x courses matrix of the averages of the students in
+    # the courses, NaN for the courses without validations.
+    def courseAverages(self):
+        totals = self.weights.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (self.grades @ self.weights.T) / np.where(totals > 0, totals, np.nan)
+
+    # Return the averages of the students in the curriculum made of the
+    # courses, all NaN if none of them has validations (or ECTS).
+    def curriculumAverages(self):
+        averages = self.courseAverages()
+        validated = ~np.isnan(averages[0]) if len(averages) else np.zeros(len(self.courseIds), dtype=bool)
+        ects = self.ects[validated]
+        if ects.sum() == 0:
+            return np.full(len(self.studentIds), np.nan)
+        return averages[:, validated] @ ects / ects.sum()
+
+# Return the positions in ids (unique) of the given values, all in ids.
+def index_of(ids, values):
+    order = np.argsort(ids)
+    return order[np.searchsorted(ids, values, sorter=order)]
+
+# Return the statistics of each column of a matrix of grades, ignoring NaN:
+# arrays of the number of grades, mean, median, standard deviation, minimum,
+# maximum, and percentage of grades below PASSING_GRADE (NaN for the columns
+# without grades).
+def describe(values):
+    present = ~np.isnan(values)
+    count = present.sum(axis=0)
+    result = {'count': count}
+    if not values.shape[0]:
+        for name in ('mean', 'median', 'std', 'min', 'max', 'failed'):
+            result[name] = np.full(values.shape[1], np.nan)
+        return result
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        # (the columns without grades give NaN, as expected)
+        warnings.simplefilter('ignore', RuntimeWarning)
+        result['mean'] = np.nanmean(values, axis=0)
+        result['median'] = np.nanmedian(values, axis=0)
+        result['std'] = np.nanstd(values, axis=0)
+        result['min'] = np.nanmin(values, axis=0)
+        result['max'] = np.nanmax(values, axis=0)
+        result['failed'] = 100 * (values < PASSING_GRADE).sum(axis=0) / count
+    return result
+
+# Return the ranks of the given averages (1 for the best, ties sharing the
+# best rank) and their percentiles (percentage of the averages lower or
+# equal), NaN for the NaN averages.
+def rank(averages):
+    present = averages[~np.isnan(averages)]
+    ordered = np.sort(present)
+    atMost = np.searchsorted(ordered, averages, side='right')
+    ranks = np.where(np.isnan(averages), np.nan, len(ordered) - atMost + 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        percentiles = np.where(np.isnan(averages), np.nan, 100 * atMost / len(ordered))
+    return ranks, percentiles
+
+# Return the number of the given averages (NaN ignored) in each interval of
+# HISTOGRAM_BINS.
+def histogram(averages):
+    return np.histogram(averages[~np.isnan(averages)], bins=HISTOGRAM_BINS)[0]
+
+# Return a value of a statistic as shown on the pages: rounded as the grades
+# of Model, None for NaN.
+def shown(value, decimals=GRADES_DECIMAL_ROUNDING):
+    if value is None or np.isnan(value):
+        return None
+    return round(float(value), decimals)
+
+# The tables of the statistics pages, as lists of rows:
+#   - summary: (name, ECTS or coefficient, students, mean, median, standard
+#     deviation, min, max, failure rate in %) of each course or validation,
+#     and first of the whole curriculum or course;
+#   - distribution: (interval, students, % of the students) of the averages;
+#   - students: (id, last name, first name, average, rank, percentile).
+class Statistics:
+    def __init__(self, name, summary, distribution, students):
+        self.name = name
+        self.summary = summary
+        self.distribution = distribution
+        self.students = students
+
+def summary_rows(names, weights, values):
+    d = describe(values)
+    return [(name, shown(weight), int(d['count'][i]), shown(d['mean'][i]), shown(d['median'][i]),
+             shown(d['std'][i]), shown(d['min'][i]), shown(d['max'][i]), shown(d['failed'][i], 1))
+            for i, (name, weight) in enumerate(zip(names, weights))]
+
+def build_statistics(name, grades, averages, summary):
+    counts = histogram(averages)
+    total = counts.sum()
+    bounds = [f"{low:g}" for low in HISTOGRAM_BINS]
+    distribution = [(f"[{bounds[i]}, {bounds[i + 1]}{']' if i == len(counts) - 1 else ')'}", int(count),
+                     shown(100 * count / total, 1) if total else None)
+                    for i, count in enumerate(counts)]
+    ranks, percentiles = rank(averages)
+    students = [(int(grades.studentIds[i]), grades.lastnames[i], grades.firstnames[i], shown(averages[i]),
+                 None if np.isnan(ranks[i]) else int(ranks[i]), shown(percentiles[i], 1))
+                for i in range(len(averages))]
+    return Statistics(name, summary, distribution, students)
+
+# Return the Statistics of a curriculum, given the row of
+# Model.curriculumGrades(): its summary has a row for the curriculum averages
+# and one for the averages of each course.
+def curriculum_statistics(data):
+    grades = Grades(data)
+    courseAverages = grades.courseAverages()
+    averages = grades.curriculumAverages()
+    summary = (summary_rows([data.name], [grades.ects.sum()], averages[:, None])
+               + summary_rows(grades.courseNames, grades.ects, courseAverages))
+    return build_statistics(data.name, grades, averages, summary)
+
+# Return the Statistics of a course, given the row of Model.courseGrades():
+# its summary has a row for the course averages and one for the grades of
+# each validation (a missing grade counting as 0).
+def course_statistics(data):
+    grades = Grades(data)
+    averages = grades.courseAverages()[:, 0]
+    summary = (summary_rows([data.name], [None], averages[:, None])
+               + summary_rows(grades.validationNames, grades.coefficients, grades.grades))
+    return build_statistics(data.name, grades, averages, summary)
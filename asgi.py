@@ -0,0 +1,548 @@
+#!/usr/bin/python
+
+# ASGI entry point, serving the pages of run.py with Quart on AsyncModel (see
+# asyncmodel.py), so that the requests waiting for the database do not hold a
+# worker each. It needs the packages of requirements-async.txt:
+#
+#   hypercorn 'asgi:create_app()'
+#
+# A detail page is read by one statement, its heavy tables by concurrent
+# tasks (see asyncmodel.py), and the independent reads of the choices of its
+# forms are awaited together with asyncio.gather. The logic of the pages
+# shared with run.py is in views.py.
+
+from asyncmodel import AsyncModel, open_pool, close_pool
+from model import get_read_cache, get_statement_registry, InvalidCursor, PageTimeout
+from migrate import migrate
+from quart import Quart, Blueprint, Response, request, render_template, redirect, url_for, abort, jsonify, g
+from quart import send_from_directory
+from quart.wrappers.response import IterableBody
+from forms import *
+from psycopg2 import IntegrityError
+import asyncio
+import io
+import time
+import jobs
+import metrics
+import render
+import views
+from werkzeug.datastructures import CombinedMultiDict
+from dotenv import load_dotenv
+
+# The pages, registered on the application by create_app(), see run.py.
+pages = Blueprint('pages', __name__)
+
+
+def create_app():
+    load_dotenv()
+    app = Quart(__name__)
+    app.url_map.converters['int'] = views.IdConverter
+    app.register_blueprint(pages)
+    return app
+
+
+# The connections of the pool are opened in the background (see open_pool()).
+@pages.before_app_serving
+async def startup():
+    await open_pool()
+
+
+@pages.after_app_serving
+async def shutdown():
+    await close_pool()
+
+
+_schema_checked = False
+_schema_lock = asyncio.Lock()
+
+
+# Apply the pending migrations before the first request, see run.py.
+@pages.before_app_request
+async def checkSchema():
+    global _schema_checked
+    if not _schema_checked:
+        async with _schema_lock:
+            if not _schema_checked:
+                await asyncio.to_thread(migrate)
+                _schema_checked = True
+
+
+@pages.app_errorhandler(InvalidCursor)
+async def invalidCursor(error):
+    return "Invalid page cursor", 400
+
+
+# A page whose statement took longer than PAGE_TIMEOUT (see model.query()).
+@pages.app_errorhandler(PageTimeout)
+async def pageTimeout(error):
+    return "The database is too slow to answer, please retry later", 503
+
+
+# Measure each request in the metrics of the process, see run.py.
+@pages.before_app_request
+async def startRequestMetrics():
+    g.requestMetrics = (metrics.start_request(), time.perf_counter())
+
+
+@pages.after_app_request
+async def recordRequestMetrics(response):
+    if 'requestMetrics' not in g:
+        return response
+    stats, start = g.pop('requestMetrics')
+    labels = (request.url_rule.rule if request.url_rule else 'unmatched',
+              request.method, response.status_code)
+    if response.content_length is not None:
+        metrics.finish_request(stats, time.perf_counter() - start, *labels,
+                               response.content_length)
+        return response
+    body = response.response
+
+    async def counted():
+        size = 0
+        try:
+            async with body as chunks:
+                async for chunk in chunks:
+                    size += len(chunk.encode() if isinstance(chunk, str) else chunk)
+                    yield chunk
+        finally:
+            metrics.finish_request(stats, time.perf_counter() - start, *labels, size)
+    response.response = IterableBody(counted())
+    return response
+
+
+# Validators of the GET pages, see run.py.
+@pages.before_app_request
+async def notModified():
+    if request.method != 'GET':
+        return None
+    g.servedSnapshot = render.served_snapshot()
+    page = render.served_page(request.full_path)
+    if page is None or not request.if_none_match.contains(page[0]):
+        return None
+    response = Response("", 304)
+    response.set_etag(page[0])
+    response.last_modified = page[1]
+    response.cache_control.no_cache = True
+    return response
+
+
+@pages.after_app_request
+async def conditionalResponse(response):
+    if request.method != 'GET' or response.status_code != 200 or response.content_length is None:
+        return response
+    await response.add_etag()
+    response.last_modified = render.first_served(request.full_path, response.get_etag()[0],
+                                                 metrics.current_request(), g.get('servedSnapshot'))
+    response.cache_control.no_cache = True
+    return await response.make_conditional(request)
+
+
+pages.add_app_template_global(render.render_table, 'render_table')
+
+
+# Render a template, recording the duration and size of the rendering, see
+# run.py.
+async def renderTemplate(name, **context):
+    start = time.perf_counter()
+    html = await render_template(name, **context)
+    metrics.TEMPLATE_SECONDS.observe(time.perf_counter() - start, name)
+    metrics.TEMPLATE_CHARACTERS.observe(len(html), name)
+    return html
+
+
+# Return a streamed response of the rows yielded by the given export of
+# AsyncModel, as CSV with a header line or as NDJSON, or with ?background=1
+# the page of the job writing it, see run.py.
+async def exportResponse(fmt, filename, columns, export, *args):
+    if fmt not in views.EXPORT_FORMATS:
+        abort(404)
+    if request.args.get('background'):
+        try:
+            jobs.check('export', [fmt, filename, columns, export, *args])
+        except ValueError:
+            abort(404)
+        async with AsyncModel() as model:
+            idJob = await jobs.enqueue(model, 'export', fmt, filename, columns, export, *args)
+            return redirect(url_for('.showJob', id=idJob))
+
+    async def generate():
+        yield views.exportHeader(fmt, columns)
+        async with AsyncModel() as model:
+            async for rows in getattr(model, export)(*args):
+                yield views.exportRows(fmt, columns, rows)
+
+    return Response(generate(), mimetype=views.EXPORT_FORMATS[fmt],
+                    headers=views.exportHeaders(filename, fmt))
+
+
+# Await the choices of the person fields of the given forms, for their
+# setNames(model.results) (see PersonChoicesForm): the persons submitted are
+# only looked for if there are too many persons to list them all.
+async def fetchPersonChoices(model, *forms):
+    choices = await model.listPersonChoices(PERSON_CHOICES_LIMIT)
+    if choices.nextCursor is not None:
+        await asyncio.gather(*(model.listPersonChoicesOf(*form.submittedPersons())
+                               for form in forms))
+
+
+@pages.route('/')
+async def index():
+    return await renderTemplate('index.html')
+
+
+# Counters of the cache shared by the requests of this process, to size it.
+@pages.route('/stats/cache/')
+async def showCacheStats():
+    return jsonify(get_read_cache().stats())
+
+
+# Metrics of this process in the text format of Prometheus (see metrics.py).
+@pages.route('/metrics')
+async def showMetrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Counters of the prepared statements of the threads of this process (see
+# statements.py). The queries of AsyncModel are prepared by psycopg 3.
+@pages.route('/stats/statements/')
+async def showStatementStats():
+    async with AsyncModel() as model:
+        return jsonify(dict(get_statement_registry().stats(), **await model.planCacheStats()))
+
+
+################################################################
+####              HANDLING OF PERSONS                       ####
+################################################################
+
+
+@pages.route('/person/', methods=['GET', 'POST'])
+async def showPersons():
+    async with AsyncModel() as model:
+        form = PersonForm(await request.form)
+        if request.method == 'POST' and form.validate():
+            await model.createPerson(form.lastname.data, form.firstname.data,
+                                     form.address.data, form.phone.data)
+
+        text, size = views.searchArgs(request.args)
+        if text:
+            pers = await model.searchPersons(text, size)
+        else:
+            pers = render.Query(model, 'listPersons', **views.pageArgs(request.args))
+        return await renderTemplate('listing.html', forms=[form], **views.personsContext(pers, text))
+
+
+# The persons found by ?q=<text>, see run.py and views.searchArgs().
+@pages.route('/person/search/')
+async def searchPersons():
+    text, size = views.searchArgs(request.args)
+    if not text:
+        return jsonify([])
+    async with AsyncModel() as model:
+        return jsonify([person._asdict() for person in await model.searchPersons(text, size)])
+
+
+# (with BACKGROUND_JOBS=1, the deletions run as jobs, see jobs.py)
+@pages.route('/person/del/<int:id>/')
+async def delPerson(id=None):
+    async with AsyncModel() as model:
+        if jobs.in_background():
+            return redirect(url_for('.showJob', id=await jobs.enqueue(model, 'deletePerson', id)))
+        await model.deletePerson(id)
+        return redirect(url_for('.showPersons'))
+
+
+@pages.route('/person/<int:id>/', methods=['GET', 'POST'])
+async def showPerson(id=None):
+    async with AsyncModel() as model:
+        page = await model.personPage(id, **views.pageArgs(request.args))
+        if page is None:
+            abort(404)
+        return await renderTemplate('listing.html', **views.personContext(page))
+
+
+@pages.route('/person/<int:id>/export.<fmt>')
+async def exportPerson(id=None, fmt=None):
+    return await exportResponse(fmt, f"grades-of-person-{id}", [
+        'validation', 'date', 'course', 'name', 'coefficient', 'grade'
+    ], 'exportGradesOfStudent', id)
+
+
+################################################################
+####              HANDLING OF CURRICULUMS                   ####
+################################################################
+
+
+@pages.route('/curriculum/', methods=['GET', 'POST'])
+async def showCurriculums():
+    async with AsyncModel() as model:
+        form = CurriculumForm(await request.form)
+        await fetchPersonChoices(model, form)
+        form.setNames(model.results)
+        if request.method == 'POST' and form.validate():
+            await model.createCurriculum(form.name.data, form.secretary.data,
+                                         form.director.data)
+        return await renderTemplate('listing.html', forms=[form],
+                                    **views.curriculumsContext(render.Query(model, 'listCurriculums')))
+
+
+@pages.route('/curriculum/del/<int:id>/')
+async def delCurriculum(id=None):
+    async with AsyncModel() as model:
+        await model.deleteCurriculum(id)
+        return redirect(url_for('.showCurriculums'))
+
+
+@pages.route('/curriculum/<int:id>/', methods=['GET', 'POST'])
+async def showCurriculum(id=None):
+    async with AsyncModel() as model:
+        formdata = await request.form
+        addStudentForm = SelectStudentForm(formdata)
+        addCourseForm = SelectCourseForm(formdata)
+        await asyncio.gather(fetchPersonChoices(model, addStudentForm), model.listCourses())
+        addStudentForm.setNames(model.results)
+        addCourseForm.setNames(model.results)
+        if request.method == 'POST':
+            if addStudentForm.validate():
+                await model.registerPersonsToCurriculum(addStudentForm.students.data,
+                                                        id)
+            else:
+                if addCourseForm.validate():
+                    await model.registerCourseToCurriculum(addCourseForm.course.data,
+                                                           id,
+                                                           addCourseForm.ects.data)
+                    addStudentForm = SelectStudentForm()
+                    await fetchPersonChoices(model, addStudentForm)
+                    addStudentForm.setNames(model.results)
+        page = await model.curriculumPage(id)
+        if page is None:
+            abort(404)
+        return await renderTemplate('listing.html', forms=[addStudentForm, addCourseForm],
+                                    **views.curriculumContext(page))
+
+
+@pages.route('/curriculum/<int:id>/export.<fmt>')
+async def exportCurriculum(id=None, fmt=None):
+    return await exportResponse(fmt, f"averages-of-curriculum-{id}", [
+        'student', 'lastname', 'firstname', 'average'
+    ], 'exportAveragesOfCurriculum', id)
+
+
+@pages.route('/curriculum/<int:id>/refresh/', methods=['POST'])
+async def refreshCurriculum(id=None):
+    async with AsyncModel() as model:
+        if await model.getNameOfCurriculum(id) is None:
+            abort(404)
+        idJob = await jobs.enqueue(model, 'refreshCurriculumAverages', id)
+        return redirect(url_for('.showJob', id=idJob), 303)
+
+
+@pages.route('/curriculum/<int:id>/transcripts/', methods=['POST'])
+async def writeTranscripts(id=None):
+    async with AsyncModel() as model:
+        if await model.getNameOfCurriculum(id) is None:
+            abort(404)
+        idJob = await jobs.enqueue(model, 'transcripts', id)
+        return redirect(url_for('.showJob', id=idJob), 303)
+
+
+@pages.route('/curriculum/<int:id>/stats/')
+async def showCurriculumStats(id=None):
+    async with AsyncModel() as model:
+        data = await model.curriculumGrades(id)
+        if data is None:
+            abort(404)
+        # (NumPy is imported by the first statistics page, not at startup)
+        import analytics
+        stats = await asyncio.to_thread(analytics.curriculum_statistics, data)
+        return await renderTemplate('listing.html', **views.statisticsContext(stats, 'ECTS', "courses"))
+
+
+@pages.route('/curriculum/<int:idCurr>/del/<int:idCou>/')
+async def delCourseFromCurriculum(idCurr=None, idCou=None):
+    async with AsyncModel() as model:
+        await model.deleteCourseFromCurriculum(idCou, idCurr)
+        return redirect(url_for('.showCurriculum', id=idCurr))
+
+
+################################################################
+####              HANDLING OF COURSES                       ####
+################################################################
+
+
+@pages.route('/course/', methods=['GET', 'POST'])
+async def showCourses():
+    async with AsyncModel() as model:
+        addCourseForm = CourseForm(await request.form)
+        await fetchPersonChoices(model, addCourseForm)
+        addCourseForm.setNames(model.results)
+        if request.method == 'POST' and addCourseForm.validate():
+            await model.createCourse(addCourseForm.name.data,
+                                     addCourseForm.teacher.data)
+        text, size = views.searchArgs(request.args)
+        if text:
+            courses = await model.searchCourses(text, size)
+        else:
+            courses = render.Query(model, 'listCourses', **views.pageArgs(request.args))
+        return await renderTemplate('listing.html', forms=[addCourseForm],
+                                    **views.coursesContext(courses, text))
+
+
+# The courses found by ?q=<text>, see run.py.
+@pages.route('/course/search/')
+async def searchCourses():
+    text, size = views.searchArgs(request.args)
+    if not text:
+        return jsonify([])
+    async with AsyncModel() as model:
+        return jsonify([course._asdict() for course in await model.searchCourses(text, size)])
+
+
+@pages.route('/course/del/<int:id>/')
+async def delCourse(id=None):
+    async with AsyncModel() as model:
+        if jobs.in_background():
+            return redirect(url_for('.showJob', id=await jobs.enqueue(model, 'deleteCourse', id)))
+        await model.deleteCourse(id)
+        return redirect(url_for('.showCourses'))
+
+
+@pages.route('/course/<int:id>/', methods=['GET', 'POST'])
+async def showCourse(id=None):
+    async with AsyncModel() as model:
+        form = ValidationForm(await request.form)
+        if request.method == 'POST' and form.validate():
+            await model.addValidationToCourse(form.name.data, form.coef.data, form.date.data, id)
+        page = await model.coursePage(id, **views.pageArgs(request.args))
+        if page is None:
+            abort(404)
+        return await renderTemplate('listing.html', forms=[form], **views.courseContext(page))
+
+
+@pages.route('/course/<int:id>/export.<fmt>')
+async def exportCourse(id=None, fmt=None):
+    return await exportResponse(fmt, f"grades-of-course-{id}", [
+        'validation', 'name', 'date', 'coefficient', 'student', 'lastname',
+        'firstname', 'grade'
+    ], 'exportGradesOfCourse', id)
+
+
+@pages.route('/course/<int:id>/stats/')
+async def showCourseStats(id=None):
+    async with AsyncModel() as model:
+        data = await model.courseGrades(id)
+        if data is None:
+            abort(404)
+        import analytics
+        stats = await asyncio.to_thread(analytics.course_statistics, data)
+        return await renderTemplate('listing.html', **views.statisticsContext(stats, 'Coef', "validations"))
+
+
+@pages.route('/course/<int:idCourse>/<int:idValidation>/', methods=['GET', 'POST'])
+async def showValidation(idCourse=None, idValidation=None):
+    async with AsyncModel() as model:
+        form = GradesForm(await request.form)
+        if request.method == 'POST':
+            await model.listStudentsOfCourse(idCourse)
+            form.setNames(model.results, idCourse)
+            if form.validate():
+                try:
+                    await model.addGrade(idValidation, form.student.data,
+                                         str(form.grade.data))
+                except IntegrityError:
+                    form.student.errors.append("This student already has a grade!")
+
+        page = await model.validationPage(idCourse, idValidation, **views.pageArgs(request.args))
+        if page is None:
+            abort(404)
+        # the students of the course were fetched by validationPage()
+        form.setNames(model.results, idCourse)
+        importForm = ImportGradesForm()
+        importForm.action = url_for('.importGrades', idCourse=idCourse,
+                                    idValidation=idValidation)
+        return await renderTemplate('listing.html', forms=[form, importForm],
+                                    **views.validationContext(page))
+
+
+@pages.route('/course/<int:idCourse>/<int:idValidation>/import/', methods=['GET', 'POST'])
+async def importGrades(idCourse=None, idValidation=None):
+    form = ImportGradesForm(CombinedMultiDict((await request.files, await request.form)))
+    if request.method != 'POST' or not form.validate():
+        return redirect(url_for('.showValidation', idCourse=idCourse,
+                                idValidation=idValidation))
+    async with AsyncModel() as model:
+        name = await model.getNameOfValidation(idValidation, idCourse)
+        if name is None:
+            abort(404)
+        file = io.TextIOWrapper(form.file.data.stream, encoding='utf-8-sig')
+        try:
+            imported, errors = await model.importGrades(idValidation, file,
+                                                        form.upsert.data)
+        except UnicodeDecodeError:
+            imported, errors = 0, views.NOT_UTF8_ERRORS
+        return await renderTemplate('listing.html', **views.importContext(name, imported, errors))
+
+
+################################################################
+####              BACKGROUND JOBS                           ####
+################################################################
+
+
+# The jobs, and the enqueue of one, see run.py.
+@pages.route('/jobs/', methods=['GET', 'POST'])
+async def showJobs():
+    async with AsyncModel() as model:
+        if request.method == 'POST':
+            try:
+                kind, args = views.jobRequest(await request.get_json(silent=True) or {})
+                jobs.check(kind, args)
+                idJob = await jobs.enqueue(model, kind, *args)
+            except (ValueError, KeyError):
+                abort(400)
+            status = url_for('.showJobStatus', id=idJob)
+            return jsonify(id=idJob, status=status), 202, {'Location': status}
+        return await renderTemplate('listing.html',
+                                    **views.jobsContext(await model.listJobs(**views.pageArgs(request.args))))
+
+
+@pages.route('/jobs/<int:id>/')
+async def showJob(id=None):
+    async with AsyncModel() as model:
+        job = await model.getJob(id)
+        if job is None:
+            abort(404)
+        return await renderTemplate('job.html', job=job, title=f'Job {id}')
+
+
+@pages.route('/jobs/<int:id>/status')
+async def showJobStatus(id=None):
+    async with AsyncModel() as model:
+        job = await model.getJob(id)
+        if job is None:
+            abort(404)
+        return jsonify(job._asdict())
+
+
+@pages.route('/jobs/<int:id>/result')
+async def showJobResult(id=None):
+    async with AsyncModel() as model:
+        job = await model.getJob(id)
+    if job is None:
+        abort(404)
+    if job.status != 'done':
+        return jsonify(status=job.status, error=job.error), 409
+    if isinstance(job.result, dict) and 'file' in job.result:
+        return await send_from_directory(jobs.setting('JOB_RESULTS_DIR'), job.result['file'],
+                                         as_attachment=True, attachment_filename=job.result['name'])
+    return jsonify(job.result)
+
+
+@pages.route('/jobs/<int:id>/cancel', methods=['POST'])
+async def cancelJob(id=None):
+    async with AsyncModel() as model:
+        if await model.cancelJob(id) is None:
+            abort(404)
+        return redirect(url_for('.showJob', id=id), 303)
+
+
+if __name__ == '__main__':
+    create_app().run(debug=True)
@@ -0,0 +1,319 @@
+#!/usr/bin/python
+
+# Asynchronous counterpart of Model, used by the ASGI entry point asgi.py.
+#
+# AsyncModel has the same methods as Model, as coroutines:
+#   - the read queries run on a pool of psycopg 3 asynchronous connections,
+#     each one on its own connection. A detail page is read by the single
+#     statement of its page method (see Model.fetchTogether()), while its
+#     heavy tables are read at the same time by tasks of their own (see
+#     replay()); the routes await with asyncio.gather only the independent
+#     reads of their forms (the choices of persons and of courses);
+#   - the exports are asynchronous generators reading a server-side cursor;
+#   - the write queries, short and rare, run the methods of Model in a thread,
+#     with their transactions and the invalidation of the caches.
+#
+# The SQL is not duplicated: a read method of AsyncModel runs the method of
+# Model on a ReplayModel, whose cursor stops at the first statement whose rows
+# are not known yet. AsyncModel fetches them, and runs the method again until
+# it returns. The results are cached exactly as the ones of Model, see query().
+#
+# The read queries and the exports are sent to a replica when Model would
+# send them to one (see Model.runRead()), on pools of their own.
+
+import os
+import asyncio
+import inspect
+import functools
+import time
+import psycopg
+import psycopg_pool
+import model
+import metrics
+import replicas
+from model import Model, ReplayModel, ReplayCursor, PendingQuery, PendingReads, CountingCursor, EXPORT_BATCH_SIZE
+from model import get_db_url, get_read_cache, get_replica_set, record_type, page_limits, check_page_budget
+from model import PageTimeout
+
+# The rows are the same records as the ones of Model (see model.record_type()).
+def row_factory(cursor):
+    return record_type(tuple(column.name for column in cursor.description or ()))._make
+
+# The rows of a query, with the description of its columns.
+class Rows(list):
+    description = None
+
+_pool = None
+_replica_pools = {}
+
+# Open the asynchronous connection pool of the process, bounded as the one of
+# Model (see get_pool()). It must be opened in the event loop that uses it.
+# psycopg 3 prepares the statements itself, on their first execution unless
+# DB_PREPARED_STATEMENTS is 0 (see model.get_statement_registry()).
+async def open_pool(url=None):
+    global _pool
+    if _pool is None:
+        _pool = await new_pool(url or get_db_url(), model.DB_POOL_TIMEOUT)
+    return _pool
+
+async def new_pool(url, timeout):
+    prepared = bool(int(os.getenv('DB_PREPARED_STATEMENTS', model.DB_PREPARED_STATEMENTS)))
+    pool = psycopg_pool.AsyncConnectionPool(
+        url,
+        min_size=int(os.getenv('DB_POOL_MIN', model.DB_POOL_MIN)),
+        max_size=int(os.getenv('DB_POOL_MAX', model.DB_POOL_MAX)),
+        timeout=timeout,
+        kwargs={'autocommit': True, 'row_factory': row_factory,
+                'prepare_threshold': 0 if prepared else None},
+        open=False)
+    await pool.open()
+    return pool
+
+# Return the pool of the connections to a replica, opening it on first use.
+# A connection not obtained within REPLICA_CONNECT_TIMEOUT seconds raises
+# PoolTimeout, and the query is sent to the primary instead.
+async def replica_pool(replica):
+    if replica.url not in _replica_pools:
+        pool = await new_pool(replica.url, replicas.REPLICA_CONNECT_TIMEOUT)
+        if replica.url in _replica_pools: # opened by another task meanwhile
+            await pool.close()
+        else:
+            _replica_pools[replica.url] = pool
+    return _replica_pools[replica.url]
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+    for pool in _replica_pools.values():
+        await pool.close()
+    _replica_pools.clear()
+
+# Synchronous view of the results of the read queries already awaited on an
+# AsyncModel, for the code shared with run.py (the setNames() of the forms).
+class Results:
+    def __init__(self, model):
+        self.model = model
+
+    def __getattr__(self, name):
+        def result(*args, **kwargs):
+            return self.model.cache[(name, args, tuple(sorted(kwargs.items())))].result()
+        return result
+
+class AsyncModel:
+    def __init__(self):
+        # Futures of the results of the read queries of this AsyncModel.
+        self.cache = {}
+        # Number of read queries answered from the cache instead of the database.
+        self.savedRoundTrips = 0
+        self.results = Results(self)
+        # Whether this AsyncModel wrote to the primary, and the replica it
+        # reads (a task choosing it, see readReplica()).
+        self.wrote = False
+        self.replica = None
+        if _pool is None:
+            raise RuntimeError("the connection pool is not open, see open_pool()")
+        self.pool = _pool
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        for future in self.cache.values():
+            future.cancel()
+
+    # Return the rows of a query, run on a connection of the pool, as a list
+    # with the description of its columns (see ReplayCursor).
+    async def fetch(self, sql, params, pool):
+        CountingCursor.count()
+        start = time.perf_counter()
+        async with pool.connection() as connection:
+            metrics.POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+            start = time.perf_counter()
+            cursor = await connection.execute(sql, params)
+            rows = Rows(await cursor.fetchall() if cursor.description else [])
+            rows.description = cursor.description
+        method = metrics.current_method()
+        metrics.STATEMENT_SECONDS.observe(time.perf_counter() - start, method)
+        metrics.STATEMENT_ROWS.observe(len(rows), method)
+        metrics.STATEMENT_BYTES.inc(method, value=len(sql))
+        return rows
+
+    # Return the result of the given function of Model, see ReplayModel. The
+    # results memoized by the function (see Model.fetchTogether()) are cached
+    # by this AsyncModel too. The queries run on the given pool, and the
+    # tables of a page read apart by their read methods, in tasks of their
+    # own, concurrently with its statement (see Model.readApart()).
+    async def replay(self, function, args, kwargs, pool):
+        results = []
+        reads = {}
+        knownTypes = {}
+
+        def readApart(table):
+            if table.key() not in reads:
+                reads[table.key()] = asyncio.ensure_future(table.read(self))
+            return reads[table.key()]
+        while True:
+            replayModel = ReplayModel(ReplayCursor(results), readApart, knownTypes)
+            try:
+                result = function(replayModel, *args, **kwargs)
+            except PendingQuery as pending:
+                results.append(await self.fetch(pending.sql, pending.params, pool))
+                continue
+            except PendingReads as pending:
+                await asyncio.wait(pending.reads)
+                continue
+            for key, value in replayModel.cache.items():
+                if key not in self.cache:
+                    self.cache[key] = asyncio.get_running_loop().create_future()
+                    self.cache[key].set_result(value)
+            return result
+
+    # Return the result of a read method of Model, run on the given pool. The
+    # statement of a page (see model.query()) is cancelled after PAGE_TIMEOUT
+    # seconds, raising PageTimeout, as by Model.runPage().
+    async def read(self, method, args, kwargs, pool):
+        if not method.page:
+            return await self.replay(method.__wrapped__, args, kwargs, pool)
+        budget, timeout = page_limits()
+        start = time.monotonic()
+        try:
+            return await asyncio.wait_for(self.replay(method.__wrapped__, args, kwargs, pool), timeout)
+        except asyncio.TimeoutError:
+            raise PageTimeout(f"the page read by {method.__name__} took more than {timeout} s") from None
+        finally:
+            check_page_budget(method.__name__, time.monotonic() - start, budget)
+
+    # Return the replica read by this AsyncModel, chosen by its first read as
+    # by Model.readCursor(), or None if there is none.
+    async def readReplica(self):
+        if self.replica is None:
+            self.replica = asyncio.ensure_future(self.chooseReplica())
+        return await asyncio.shield(self.replica)
+
+    async def chooseReplica(self):
+        replicaSet = get_replica_set()
+        for replica in replicaSet.candidates():
+            if replicaSet.needsCheck(replica):
+                try:
+                    rows = await self.fetch(replicas.LAG_SQL, (), await replica_pool(replica))
+                except (psycopg.OperationalError, psycopg_pool.PoolTimeout) as error:
+                    replicaSet.failed(replica, error)
+                    continue
+                if not replicaSet.checked(replica, rows[0][0]):
+                    continue
+            return replica
+        return None
+
+    # Return the pool on which to run a read query, the name of its server
+    # and the reason of the choice, for the metrics (see READ_ROUTES), given
+    # the reason to read from the primary, if any (see Model.runRead()).
+    async def readPool(self, reason):
+        reason = "written" if self.wrote else reason
+        replica = None if reason else await self.readReplica()
+        if replica is None:
+            return self.pool, None, reason or "no replica"
+        return await replica_pool(replica), replica, "replica"
+
+    # Asynchronous version of Model.stream().
+    async def stream(self, sql, params):
+        pool, replica, reason = await self.readPool(None)
+        metrics.READ_ROUTES.inc("stream", replica.name if replica else "primary", reason)
+        CountingCursor.count()
+        async with pool.connection() as connection:
+            # (in a read-only transaction, as the ones of Model.stream())
+            await connection.set_read_only(True)
+            try:
+                async with connection.transaction():
+                    async with connection.cursor(name="export") as cursor:
+                        await cursor.execute(sql, params)
+                        while True:
+                            rows = await cursor.fetchmany(EXPORT_BATCH_SIZE)
+                            if not rows:
+                                break
+                            yield rows
+            finally:
+                if not connection.closed:
+                    await connection.set_read_only(None)
+
+    async def cached(self, key, method, args, kwargs):
+        if method.shared:
+            readCache = get_read_cache()
+            found, result = readCache.get(key)
+            if found:
+                self.savedRoundTrips += 1
+                metrics.METHOD_CACHE_HITS.inc(key[0], "process")
+                return result
+            version = readCache.version(method.reads)
+        # (this runs in a task of its own, see read_method())
+        metrics.in_method(key[0])
+        start = time.perf_counter()
+        pool, replica, reason = await self.readPool("shared" if method.shared else "primary" if method.primary else None)
+        try:
+            result = await self.read(method, args, kwargs, pool)
+        except psycopg.errors.QueryCanceled:
+            raise
+        except (psycopg.OperationalError, psycopg_pool.PoolTimeout) as error:
+            if replica is None:
+                raise
+            # (the next reads of this AsyncModel choose another replica)
+            get_replica_set().failed(replica, error)
+            self.replica = None
+            replica, reason = None, "failover"
+            result = await self.read(method, args, kwargs, self.pool)
+        metrics.READ_ROUTES.inc(key[0], replica.name if replica else "primary", reason)
+        metrics.count_read((), replica=replica is not None)
+        metrics.METHOD_SECONDS.observe(time.perf_counter() - start, key[0])
+        if method.shared:
+            readCache.put(key, result, method.reads, version)
+        return result
+
+# Call a method of Model on a Model of its own (in a thread).
+def call_model(name, args, kwargs):
+    with Model() as model:
+        return getattr(model, name)(*args, **kwargs)
+
+def read_method(name, method):
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        key = (name, args, tuple(sorted(kwargs.items())))
+        metrics.count_read(method.reads)
+        if key in self.cache:
+            self.savedRoundTrips += 1
+            metrics.METHOD_CACHE_HITS.inc(name, "request")
+        else:
+            self.cache[key] = asyncio.ensure_future(self.cached(key, method, args, kwargs))
+        return await self.cache[key]
+    return wrapper
+
+def export_method(name, method):
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        return self.stream(*method(ReplayModel(ReplayCursor([])), *args))
+    return wrapper
+
+def thread_method(name, method):
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        try:
+            return await asyncio.to_thread(call_model, name, args, kwargs)
+        finally:
+            if hasattr(method, "writes"):
+                self.cache.clear()
+                self.wrote = True
+    return wrapper
+
+# The helpers of Model itself are not part of the methods of AsyncModel.
+MODEL_HELPERS = {'transaction', 'stream', 'fetchPage', 'fetchTogether', 'readApart',
+                 'runRead', 'runPage', 'readCursor', 'releaseReplica', 'cancel'}
+
+for name, method in inspect.getmembers(Model, inspect.isfunction):
+    if name.startswith("_") or name in MODEL_HELPERS:
+        continue
+    if hasattr(method, "reads"):
+        setattr(AsyncModel, name, read_method(name, method))
+    elif name.startswith("export"):
+        setattr(AsyncModel, name, export_method(name, method))
+    else:
+        setattr(AsyncModel, name, thread_method(name, method))
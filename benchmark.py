@@ -0,0 +1,944 @@
+#!/usr/bin/python
+
+# Benchmark of the queries of Model and of the pages of run.py, on data
+# generated by datagen.py.
+#
+# Each suite times its operations ITERATIONS times (after a few unrecorded
+# warm-up runs) with random arguments drawn from a seeded sample of the data,
+# and reports for each operation the p50/p95/p99 and mean latency in
+# milliseconds, the mean number of rows returned (bytes for the pages) and the
+# mean number of statements sent to the database. The process-wide read
+# cache is cleared before each run, so that every run reaches the database.
+#
+# The suites are:
+#   model   every read query and export of Model, and every write query run
+#           in a transaction which is rolled back, so that the data stays the
+#           same (the cost of the commit itself is not measured);
+#   routes  the GET pages of run.py, through the Flask test client;
+#   throughput
+#           the heavy pages and exports requested by CLIENTS concurrent
+#           clients, served by run.py with WSGI_WORKERS threads, and by
+#           asgi.py on a single event loop (this needs requirements-async.txt).
+#           The latency includes the time waiting for a worker.
+#   analytics
+#           the statistics of a curriculum and of a course, computed by
+#           analytics.py, and by queries on the stored averages;
+#   memory  the memory and the allocations of MEMORY_ROWS rows of
+#           listGradesOfCourse, fetched as the records of Model, as the
+#           rows of a DictCursor (the rows of Model before records) and as
+#           plain tuples;
+#   startup the cold start of a worker of run.py and of asgi.py, each in a
+#           new interpreter: import of the module, creation of the
+#           application, first page served, and whole process;
+#   transcripts
+#           the transcripts of the students of the largest curriculum (see
+#           transcripts.py), rendered from the pages of the students (one
+#           personPage() each), and from the batch read of all of them by one
+#           process and by TRANSCRIPT_PROCESSES processes, in transcripts/s;
+#   replicas
+#           the heavy reads of REPLICA_OPERATIONS on the primary and routed
+#           to the replicas (see Model.runRead()), while a writer creates and
+#           deletes persons; the writer checks that it reads its own writes,
+#           and measures how long they take to be seen on the replicas.
+#
+# By default, a throwaway PostgreSQL server is created in a temporary
+# directory with the initdb and pg_ctl programs of PG_BIN (or of the PATH),
+# and removed at the end. With --env-database, the database configured in
+# the environment (or .env) is used instead, and ALL ITS DATA IS REPLACED.
+# With --latency, the queries go through a proxy adding the given round-trip
+# time, as with the database server of the school (to the primary only).
+# With --replicas, the throwaway server gets the given number of streaming
+# replicas, made with pg_basebackup, to which the reads of all the suites are
+# routed; with --env-database, the replicas of DB_REPLICA_HOSTS are used.
+#
+# Usage:
+#   python benchmark.py [--scale small|medium|large] [--seed N] [--iterations N]
+#                       [--suite NAME]... [--latency MS] [--replicas N]
+#                       [--env-database] [--output FILE]
+#   python benchmark.py --compare BEFORE.json AFTER.json
+
+import os
+import io
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import asyncio
+import threading
+import inspect
+import gc
+import tracemalloc
+import contextlib
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+import psycopg2.extras
+import datagen
+import migrate
+import model
+from model import Model, CountingCursor, get_read_cache, get_replica_set, get_statement_registry, PAGE_SIZE
+
+ITERATIONS = 50
+
+# Runs done before the measured ones, to fill the caches of the database.
+WARMUP = 3
+
+# Operations taking seconds on large data, run ITERATIONS // SLOW_DIVISOR times.
+SLOW_OPERATIONS = {'refreshAverages', 'checkAverages'}
+SLOW_DIVISOR = 10
+
+# Number of ids (or pairs of ids) sampled from each table.
+SAMPLE_SIZE = 200
+
+# Number of threads of the WSGI server serving run.py, and of clients sending
+# requests at the same time, in the throughput suite.
+WSGI_WORKERS = 4
+CLIENTS = 32
+
+# Pages requested by the clients of the throughput suite.
+THROUGHPUT_ROUTES = ['/person/<id>/', '/curriculum/<id>/', '/course/<id>/', '/course/<id>/export.ndjson']
+
+# Number of rows of listGradesOfCourse fetched by the memory suite.
+MEMORY_ROWS = 100000
+
+# Number of interpreters started by the startup suite for each entry point.
+STARTUP_RUNS = 10
+
+# Number of processes rendering the transcripts in the transcripts suite (at
+# least 2, to measure the pool even on a single core).
+TRANSCRIPT_PROCESSES = max(2, os.cpu_count() or 1)
+
+# Reads timed by the replicas suite, and number of times at most that the
+# replicas are polled for a write of its writer.
+REPLICA_OPERATIONS = ['averageGradesOfStudentsInCurriculum', 'listGradesOfCourse', 'listValidationsOfStudent']
+REPLICA_POLLS = 10000
+
+# Script run by the startup suite in a new interpreter, printing the seconds
+# elapsed (since its start) once the entry point is imported, once the
+# application is created and once the first page is served.
+STARTUP_SCRIPTS = {
+    'run.py': """
+import time
+start = time.perf_counter()
+import run
+imported = time.perf_counter()
+app = run.create_app()
+created = time.perf_counter()
+assert app.test_client().get('/person/').status_code == 200
+print(imported - start, created - start, time.perf_counter() - start)
+""",
+    'asgi.py': """
+import time
+start = time.perf_counter()
+import asgi
+imported = time.perf_counter()
+app = asgi.create_app()
+created = time.perf_counter()
+import asyncio
+async def first_page():
+    async with app.test_app() as test_app:
+        response = await test_app.test_client().get('/person/')
+        assert response.status_code == 200
+asyncio.run(first_page())
+print(imported - start, created - start, time.perf_counter() - start)
+""",
+}
+
+# A throwaway PostgreSQL server, listening only on a Unix socket of a
+# temporary directory, with the given number of streaming replicas listening
+# in the same directory (on ports 5433, 5434...). The DB_* environment variables
+# point to its database while it is running, DB_REPLICA_HOSTS to the
+# replicas. Note that initdb refuses to run as root.
+class ThrowawayPostgres:
+    def __init__(self, name="benchmark", replicas=0):
+        self.name = name
+        self.replicas = replicas
+        self.dir = None
+        self.started = []
+
+    def run(self, program, *args):
+        process = subprocess.run([os.path.join(os.getenv('PG_BIN', ''), program), *args],
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if process.returncode != 0:
+            raise RuntimeError(f"{program} failed: {process.stderr.strip()}")
+
+    def __enter__(self):
+        self.dir = tempfile.mkdtemp(prefix="td10-benchmark-")
+        data = os.path.join(self.dir, "data")
+        try:
+            self.run("initdb", "-D", data, "-U", "postgres", "-A", "trust", "--no-sync")
+            self.start(data)
+            connection = psycopg2.connect(dbname="postgres", user="postgres", host=self.dir)
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f"CREATE DATABASE {self.name}")
+            connection.close()
+            hosts = []
+            for i in range(1, self.replicas + 1):
+                replica = os.path.join(self.dir, f"replica{i}")
+                self.run("pg_basebackup", "-h", self.dir, "-U", "postgres", "-D", replica, "-R", "-X", "stream")
+                self.start(replica, 5432 + i)
+                hosts.append(f"{self.dir}:{5432 + i}")
+        except:
+            self.stop()
+            raise
+        os.environ.update(DB_HOST=self.dir, DB_NAME=self.name, DB_USER="postgres", DB_PASSWD="",
+                          DB_REPLICA_HOSTS=",".join(hosts))
+        return self
+
+    def start(self, data, port=None):
+        options = f"-k {self.dir} -c listen_addresses=''" + (f" -p {port}" if port else "")
+        self.run("pg_ctl", "-D", data, "-l", f"{data}.log", "-w", "-o", options, "start")
+        self.started.append(data)
+
+    def stop(self):
+        try:
+            for data in reversed(self.started):
+                self.run("pg_ctl", "-D", data, "-m", "immediate", "stop")
+        finally:
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+# A TCP proxy to the database delaying the data sent in each direction by
+# half of the given number of milliseconds, to simulate a database on another
+# host. The DB_HOST and PGPORT environment variables point to it while it runs.
+class LatencyProxy:
+    def __init__(self, latency):
+        self.delay = latency / 2000
+        self.loop = asyncio.new_event_loop()
+        self.environ = {}
+        self.writers = set()
+
+    async def pipe(self, reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                await asyncio.sleep(self.delay)
+                writer.write(data)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def handle(self, clientReader, clientWriter):
+        if self.host.startswith("/"):
+            path = os.path.join(self.host, f".s.PGSQL.{self.port}")
+            serverReader, serverWriter = await asyncio.open_unix_connection(path)
+        else:
+            serverReader, serverWriter = await asyncio.open_connection(self.host, self.port)
+        self.writers.update((clientWriter, serverWriter))
+        await asyncio.gather(self.pipe(clientReader, serverWriter), self.pipe(serverReader, clientWriter),
+                             return_exceptions=True)
+
+    def __enter__(self):
+        self.host = os.getenv('DB_HOST', 'psql.eleves.ens.fr')
+        self.port = os.getenv('PGPORT', '5432')
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, "127.0.0.1", 0))
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.environ = {name: os.environ.get(name) for name in ('DB_HOST', 'PGPORT')}
+        os.environ.update(DB_HOST="127.0.0.1", PGPORT=str(self.server.sockets[0].getsockname()[1]))
+        return self
+
+    async def stop(self):
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def __exit__(self, type, value, traceback):
+        for name, value in self.environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        asyncio.run_coroutine_threadsafe(self.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+# Ids and pairs of ids drawn at random from the database, from which the
+# arguments of the benchmarked operations are picked.
+class Sample:
+    def __init__(self, model, rng, size=SAMPLE_SIZE):
+        self.rng = rng
+        cursor = model.cursor
+        cursor.execute("SELECT setseed(%s)", (rng.uniform(-1, 1),))
+
+        def fetch(sql):
+            cursor.execute(sql, {'size': size})
+            return [tuple(row) if len(row) > 1 else row[0] for row in cursor.fetchall()]
+
+        self.ids = {table: fetch(f"SELECT id FROM {table} ORDER BY random() LIMIT %(size)s")
+                    for table in set(migrate.SAMPLE_TABLES.values())}
+        self.students = fetch("""
+        SELECT student FROM (SELECT DISTINCT student FROM CurriculumPerson) AS S
+        ORDER BY random() LIMIT %(size)s
+        """)
+        self.validations = fetch("SELECT id, course FROM Validations ORDER BY random() LIMIT %(size)s")
+        # Beginnings of names, as typed in the search boxes of the forms.
+        self.prefixes = fetch("SELECT left(lastname, 3) FROM Persons ORDER BY random() LIMIT %(size)s")
+        self.courseCurriculums = fetch("""
+        SELECT course, curriculum FROM CourseCurriculum ORDER BY random() LIMIT %(size)s
+        """)
+        self.newCourseCurriculums = fetch("""
+        SELECT Courses.id, Curriculums.id
+        FROM (SELECT id FROM Courses ORDER BY random() LIMIT %(size)s) AS Courses, Curriculums
+        WHERE NOT EXISTS (SELECT 1 FROM CourseCurriculum WHERE course = Courses.id AND curriculum = Curriculums.id)
+        """)
+        self.newPersonCurriculums = fetch("""
+        SELECT Persons.id, Curriculums.id
+        FROM (SELECT id FROM Persons ORDER BY random() LIMIT %(size)s) AS Persons, Curriculums
+        WHERE NOT EXISTS (SELECT 1 FROM CurriculumPerson WHERE student = Persons.id AND curriculum = Curriculums.id)
+        """)
+        # Students of the course of a validation not graded in it yet.
+        self.ungraded = {}
+        for (validation, student) in fetch("""
+        SELECT DISTINCT Validations.id, CurriculumPerson.student
+        FROM (SELECT id, course FROM Validations ORDER BY random() LIMIT 20) AS Validations
+        JOIN CourseCurriculum ON CourseCurriculum.course = Validations.course
+        JOIN CurriculumPerson ON CurriculumPerson.curriculum = CourseCurriculum.curriculum
+        WHERE NOT EXISTS (
+            SELECT 1 FROM Grades WHERE validation = Validations.id AND student = CurriculumPerson.student
+        )
+        """):
+            self.ungraded.setdefault(validation, []).append(student)
+
+    # Return a random id for the given parameter of the given Model method.
+    def id(self, method, parameter):
+        if parameter == 'text':
+            return self.rng.choice(self.prefixes)
+        if parameter == 'idStudent':
+            return self.rng.choice(self.students)
+        if parameter == 'idJob':
+            return self.rng.choice(self.ids['Jobs'] or [0]) # (no jobs in a generated database)
+        return self.rng.choice(self.ids[migrate.parameter_table(method, parameter)])
+
+    def pick(self, name):
+        return self.rng.choice(getattr(self, name))
+
+    def persons(self, count):
+        return self.rng.sample(self.ids['Persons'], min(count, len(self.ids['Persons'])))
+
+    def ungradedGrades(self):
+        validation = self.rng.choice(sorted(self.ungraded))
+        return validation, [(student, self.grade()) for student in self.ungraded[validation]]
+
+    def grade(self):
+        return round(self.rng.uniform(0, 20), 2)
+
+    # CSV file grading all the students of the course of a random validation.
+    def gradesFile(self):
+        validation, course = self.pick('validations')
+        with Model() as model:
+            students = model.listStudentsOfCourse(course)
+        return validation, io.StringIO("".join(f"{s[0]},{self.grade()}\n" for s in students))
+
+# Arguments of the write queries of Model, given a Sample.
+WRITE_ARGS = {
+    'createPerson': lambda s: ("Bench", "Mark", "1 rue du Test", "0600000000"),
+    'createPersons': lambda s: ([(f"Bench{i}", "Mark", "1 rue du Test", "0600000000") for i in range(100)],),
+    'deletePerson': lambda s: (s.id('deletePerson', 'idPerson'),),
+    'createCurriculum': lambda s: ("Bench", s.id('', 'idPerson'), s.id('', 'idPerson')),
+    'deleteCurriculum': lambda s: (s.id('', 'idCurriculum'),),
+    'createCourse': lambda s: ("Bench", s.id('', 'idPerson')),
+    'deleteCourse': lambda s: (s.id('', 'idCourse'),),
+    'registerPersonToCurriculum': lambda s: s.pick('newPersonCurriculums'),
+    'registerPersonsToCurriculum': lambda s: (s.persons(100), s.id('', 'idCurriculum')),
+    'registerCourseToCurriculum': lambda s: s.pick('newCourseCurriculums') + (5,),
+    'deleteCourseFromCurriculum': lambda s: s.pick('courseCurriculums'),
+    'addValidationToCourse': lambda s: ("Bench", 2, datetime.date(2025, 6, 1), s.id('', 'idCourse')),
+    'addGrade': lambda s: (lambda v, grades: (v, grades[0][0], grades[0][1]))(*s.ungradedGrades()),
+    'addGrades': lambda s: s.ungradedGrades(),
+    'importGrades': lambda s: s.gradesFile() + (True,),
+    'refreshAverages': lambda s: (),
+    'refreshAveragesOfCurriculum': lambda s: tuple(reversed(s.pick('courseCurriculums'))),
+    'enqueueJob': lambda s: ('refreshAverages', [], 3),
+}
+
+class Rollback(Exception):
+    pass
+
+# Run call() and return (elapsed seconds, its result, number of statements sent).
+def timed(call):
+    get_read_cache().clear()
+    statements = CountingCursor.statements
+    start = time.perf_counter()
+    result = call()
+    elapsed = time.perf_counter() - start
+    return elapsed, result, CountingCursor.statements - statements
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+# Summarize a list of (elapsed seconds, rows, statements).
+def summarize(samples, unit="rows"):
+    times = [1000 * elapsed for (elapsed, _, _) in samples]
+    return {
+        'iterations': len(samples),
+        'p50_ms': round(percentile(times, 50), 3),
+        'p95_ms': round(percentile(times, 95), 3),
+        'p99_ms': round(percentile(times, 99), 3),
+        'mean_ms': round(sum(times) / len(times), 3),
+        unit: round(sum(rows for (_, rows, _) in samples) / len(samples), 1),
+        'queries': round(sum(count for (_, _, count) in samples) / len(samples), 1),
+    }
+
+def count_rows(result):
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    return 1
+
+# Call run(iteration) WARMUP + iterations times and summarize the samples
+# it returns (None if the operation could not be run).
+def repeat(run, iterations, unit="rows"):
+    samples = [run(i) for i in range(-WARMUP, iterations)][WARMUP:]
+    samples = [sample for sample in samples if sample is not None]
+    return summarize(samples, unit) if samples else None
+
+SUITES = {}
+
+def suite(name):
+    def decorator(function):
+        SUITES[name] = function
+        return function
+    return decorator
+
+@suite('model')
+def bench_model(sample, iterations):
+    results = {}
+    for name, method in inspect.getmembers(Model, inspect.isfunction):
+        parameters = list(inspect.signature(method).parameters)[1:]
+        count = max(1, iterations // SLOW_DIVISOR) if name in SLOW_OPERATIONS else iterations
+
+        if hasattr(method, "reads") or name.startswith("export") or name == "checkAverages":
+            def run(i):
+                args = [sample.id(name, p) for p in parameters if p not in ('limit', 'after', 'before', 'withTotal')]
+                kwargs = {'limit': PAGE_SIZE} if 'limit' in parameters else {}
+                with Model() as model:
+                    if name.startswith("export"):
+                        call = lambda: sum(len(rows) for rows in getattr(model, name)(*args))
+                    else:
+                        call = lambda: count_rows(getattr(model, name)(*args, **kwargs))
+                    return timed(call)
+        elif hasattr(method, "writes") and name in WRITE_ARGS:
+            def run(i):
+                try:
+                    args = WRITE_ARGS[name](sample)
+                except (IndexError, ValueError):
+                    return None # nothing left to write in the sample
+                with Model() as model:
+                    try:
+                        with model.transaction():
+                            elapsed, result, statements = timed(lambda: getattr(model, name)(*args))
+                            raise Rollback
+                    except Rollback:
+                        pass
+                rows = result[0] if name == "importGrades" else count_rows(result)
+                return elapsed, rows, statements
+        else:
+            continue
+        results[name] = repeat(run, count)
+    return results
+
+# GET pages of run.py, given a Sample.
+ROUTES = {
+    '/': lambda s: "/",
+    '/person/': lambda s: "/person/",
+    '/person/<id>/': lambda s: f"/person/{s.id('', 'idStudent')}/",
+    '/person/<id>/export.csv': lambda s: f"/person/{s.id('', 'idStudent')}/export.csv",
+    '/person/search/': lambda s: f"/person/search/?q={s.pick('prefixes')}",
+    '/course/search/': lambda s: f"/course/search/?q={s.pick('prefixes')}",
+    '/curriculum/': lambda s: "/curriculum/",
+    '/curriculum/<id>/': lambda s: f"/curriculum/{s.id('', 'idCurriculum')}/",
+    '/curriculum/<id>/export.csv': lambda s: f"/curriculum/{s.id('', 'idCurriculum')}/export.csv",
+    '/course/': lambda s: "/course/",
+    '/course/<id>/': lambda s: f"/course/{s.id('', 'idCourse')}/",
+    '/course/<id>/export.ndjson': lambda s: f"/course/{s.id('', 'idCourse')}/export.ndjson",
+    '/course/<id>/<id>/': lambda s: "/course/{1}/{0}/".format(*s.pick('validations')),
+    '/curriculum/<id>/stats/': lambda s: f"/curriculum/{s.id('', 'idCurriculum')}/stats/",
+    '/course/<id>/stats/': lambda s: f"/course/{s.id('', 'idCourse')}/stats/",
+}
+
+@suite('routes')
+def bench_routes(sample, iterations):
+    from run import create_app
+    client = create_app().test_client()
+    results = {}
+    for route, path in ROUTES.items():
+        def run(i):
+            url = path(sample)
+            # Buffered, so that the body of the streamed exports is generated too.
+            elapsed, response, statements = timed(lambda: client.get(url, buffered=True))
+            if response.status_code != 200:
+                raise RuntimeError(f"{url}: HTTP {response.status_code}")
+            return elapsed, len(response.get_data()), statements
+        results[route] = repeat(run, iterations, unit="bytes")
+    return results
+
+# Summarize the samples of the requests of the throughput suite, sent in
+# elapsed seconds, during which the given number of statements were sent.
+def summarize_throughput(samples, elapsed, statements):
+    summary = summarize(samples, unit="bytes")
+    summary['queries'] = round(statements / len(samples), 1)
+    summary['requests_per_s'] = round(len(samples) / elapsed, 1)
+    return summary
+
+def throughput_wsgi(paths):
+    from run import create_app
+    app = create_app()
+    workers = threading.Semaphore(WSGI_WORKERS)
+
+    def client(paths):
+        samples = []
+        flask = app.test_client()
+        for path in paths:
+            start = time.perf_counter()
+            with workers:
+                response = flask.get(path, buffered=True)
+            samples.append((time.perf_counter() - start, len(response.get_data()), 0))
+        return samples
+
+    get_read_cache().clear()
+    statements = CountingCursor.statements
+    start = time.perf_counter()
+    with ThreadPoolExecutor(CLIENTS) as executor:
+        samples = sum(executor.map(client, [paths[i::CLIENTS] for i in range(CLIENTS)]), [])
+    return summarize_throughput(samples, time.perf_counter() - start, CountingCursor.statements - statements)
+
+async def throughput_asgi(paths):
+    from asgi import create_app
+    app = create_app()
+    samples = []
+
+    async def client(paths):
+        for path in paths:
+            start = time.perf_counter()
+            response = await quart.get(path)
+            size = len(await response.get_data())
+            samples.append((time.perf_counter() - start, size, 0))
+
+    async with app.test_app() as test_app:
+        quart = test_app.test_client()
+        get_read_cache().clear()
+        statements = CountingCursor.statements
+        start = time.perf_counter()
+        await asyncio.gather(*(client(paths[i::CLIENTS]) for i in range(CLIENTS)))
+        return summarize_throughput(samples, time.perf_counter() - start, CountingCursor.statements - statements)
+
+@suite('throughput')
+def bench_throughput(sample, iterations):
+    paths = [ROUTES[route](sample) for route in THROUGHPUT_ROUTES for i in range(iterations)]
+    sample.rng.shuffle(paths)
+    return {
+        f'run.py ({WSGI_WORKERS} threads)': throughput_wsgi(paths),
+        'asgi.py': asyncio.run(throughput_asgi(paths)),
+    }
+
+# A cursor whose rows can be indexed by column name, as the one of Model
+# before its rows were records (see model.record_type()).
+class DictRowCursor(CountingCursor, psycopg2.extras.DictCursor):
+    pass
+
+MEMORY_CURSORS = {
+    'records (Model)': model.Cursor,
+    'DictCursor': DictRowCursor,
+    'tuples': CountingCursor,
+}
+
+@suite('memory')
+def bench_memory(sample, iterations):
+    with Model() as m:
+        m.cursor.execute("""
+        SELECT Validations.course FROM Grades
+        JOIN Validations ON Validations.id = Grades.validation
+        GROUP BY Validations.course ORDER BY count(*) DESC LIMIT 1
+        """)
+        idCourse = m.cursor.fetchone()[0]
+    sql, params = model.paginate_sql(model.GRADES_OF_COURSE_SQL, (model.GRADES_DECIMAL_ROUNDING, idCourse),
+                                     model.GRADES_OF_COURSE_KEYS, True)
+    # The rows of the course with the most grades, repeated up to MEMORY_ROWS.
+    sql = f"SELECT Rows.* FROM ({sql}) AS Rows CROSS JOIN generate_series(1, %s) LIMIT %s"
+    params = params + (MEMORY_ROWS, MEMORY_ROWS)
+
+    results = {}
+    for name, factory in MEMORY_CURSORS.items():
+        with Model() as m:
+            cursor = m.connection.cursor(cursor_factory=factory)
+
+            def run(i):
+                cursor.execute(sql, params)
+                return timed(lambda: len(cursor.fetchall()))
+            results[name] = repeat(run, max(1, iterations // SLOW_DIVISOR))
+
+            # Memory kept by the rows (with their values) and allocated while
+            # fetching them, and number of memory blocks they hold.
+            cursor.execute(sql, params)
+            gc.collect()
+            blocks = sys.getallocatedblocks()
+            tracemalloc.start()
+            rows = cursor.fetchall()
+            kept, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            blocks = sys.getallocatedblocks() - blocks
+            results[name].update({
+                'row_bytes': sys.getsizeof(rows[0]),
+                'bytes_per_row': round(kept / len(rows), 1),
+                'peak_bytes_per_row': round(peak / len(rows), 1),
+                'blocks_per_row': round(blocks / len(rows), 2),
+            })
+            del rows
+            cursor.close()
+    return results
+
+@suite('startup')
+def bench_startup(sample, iterations):
+    results = {}
+    for entry, script in STARTUP_SCRIPTS.items():
+        samples = {'import': [], 'create_app': [], 'first page': [], 'process': []}
+        for i in range(min(iterations, STARTUP_RUNS)):
+            start = time.perf_counter()
+            process = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True,
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+            elapsed = time.perf_counter() - start
+            if process.returncode != 0:
+                if 'ModuleNotFoundError' in process.stderr:
+                    # asgi.py without the packages of requirements-async.txt.
+                    break
+                raise RuntimeError(f"{entry}: {process.stderr.strip()}")
+            imported, created, served = map(float, process.stdout.split()[-3:])
+            for operation, seconds in zip(samples, (imported, created - imported, served - created, elapsed)):
+                samples[operation].append((seconds, 0, 0))
+        for operation, times in samples.items():
+            results[f"{entry} {operation}"] = summarize(times) if times else None
+    return results
+
+# Statistics of the summary of a column of grades, in SQL: number, mean,
+# median, standard deviation, min, max and % below analytics.PASSING_GRADE.
+SUMMARY_SQL = """
+    count({grade}), avg({grade}), percentile_cont(0.5) WITHIN GROUP (ORDER BY {grade}),
+    stddev_pop({grade}), min({grade}), max({grade}),
+    100.0 * count(*) FILTER (WHERE {grade} < %(passing)s) / NULLIF(count({grade}), 0)
+"""
+
+# The statistics of the pages of analytics.py computed by queries instead,
+# one per table of the page, from the stored averages (and the grades for
+# the validations of a course). The last query gives the averages of the
+# students, compared with the ones of analytics.py.
+ANALYTICS_SQL = {
+    'curriculum': [
+        f"SELECT {SUMMARY_SQL.format(grade='grade')} FROM CurriculumAverages WHERE curriculum = %(id)s",
+        f"""
+        SELECT Courses.name, CourseCurriculum.ects, {SUMMARY_SQL.format(grade='CourseAverages.grade')}
+        FROM CourseCurriculum
+        JOIN Courses ON Courses.id = CourseCurriculum.course
+        LEFT JOIN CourseAverages ON CourseAverages.course = CourseCurriculum.course
+            AND CourseAverages.student IN (SELECT student FROM CurriculumPerson WHERE curriculum = %(id)s)
+        WHERE CourseCurriculum.curriculum = %(id)s
+        GROUP BY Courses.id, CourseCurriculum.ects
+        ORDER BY Courses.name, Courses.id
+        """,
+        """
+        SELECT least(width_bucket(grade, 0, 20, 10), 10) AS bucket, count(*)
+        FROM CurriculumAverages WHERE curriculum = %(id)s AND grade IS NOT NULL
+        GROUP BY bucket ORDER BY bucket
+        """,
+        """
+        SELECT Persons.id, lastname, firstname, grade,
+               rank() OVER (ORDER BY grade DESC NULLS LAST), 100 * cume_dist() OVER (ORDER BY grade)
+        FROM CurriculumAverages
+        JOIN Persons ON Persons.id = CurriculumAverages.student
+        WHERE curriculum = %(id)s
+        ORDER BY lastname, firstname, Persons.id
+        """,
+    ],
+    'course': [
+        f"SELECT {SUMMARY_SQL.format(grade='grade')} FROM CourseAverages WHERE course = %(id)s",
+        f"""
+        SELECT Validations.name, Validations.coefficient, {SUMMARY_SQL.format(grade='COALESCE(Grades.grade, 0)')}
+        FROM Validations
+        CROSS JOIN (
+            SELECT DISTINCT student FROM CurriculumPerson
+            JOIN CourseCurriculum ON CourseCurriculum.curriculum = CurriculumPerson.curriculum
+            WHERE CourseCurriculum.course = %(id)s
+        ) AS Students
+        LEFT JOIN Grades ON Grades.validation = Validations.id AND Grades.student = Students.student
+        WHERE Validations.course = %(id)s
+        GROUP BY Validations.id
+        ORDER BY Validations.date, Validations.id
+        """,
+        """
+        SELECT least(width_bucket(grade, 0, 20, 10), 10) AS bucket, count(*)
+        FROM CourseAverages WHERE course = %(id)s
+        GROUP BY bucket ORDER BY bucket
+        """,
+        """
+        SELECT Persons.id, lastname, firstname, grade,
+               rank() OVER (ORDER BY grade DESC), 100 * cume_dist() OVER (ORDER BY grade)
+        FROM CourseAverages
+        JOIN Persons ON Persons.id = CourseAverages.student
+        WHERE course = %(id)s
+        ORDER BY lastname, firstname, Persons.id
+        """,
+    ],
+}
+
+# The statistics pages of a curriculum and of a course, computed by
+# analytics.py from the grades (one statement, then NumPy), and by the
+# queries of ANALYTICS_SQL from the stored averages. The averages of the
+# students given by both are checked to be the same.
+@suite('analytics')
+def bench_analytics(sample, iterations):
+    import analytics
+    results = {}
+    for kind, method, statistics in (('curriculum', 'curriculumGrades', analytics.curriculum_statistics),
+                                     ('course', 'courseGrades', analytics.course_statistics)):
+        ids = {}
+
+        def run_numpy(i):
+            ids[i] = sample.id(method, 'idCurriculum' if kind == 'curriculum' else 'idCourse')
+            with Model() as model:
+                elapsed, stats, statements = timed(lambda: statistics(getattr(model, method)(ids[i])))
+            ids[i] = (ids[i], [(row[0], row[3]) for row in stats.students])
+            return elapsed, len(stats.students), statements
+
+        def run_sql(i):
+            id, averages = ids[i]
+            with Model() as model:
+                def call():
+                    rows = []
+                    for sql in ANALYTICS_SQL[kind]:
+                        model.cursor.execute(sql, {'id': id, 'passing': analytics.PASSING_GRADE})
+                        rows = model.cursor.fetchall()
+                    return rows
+                elapsed, rows, statements = timed(call)
+            # (both are rounded, and can differ by their last digit)
+            if len(rows) != len(averages) or any(
+                    row[0] != student or (row[3] is None) != (average is None)
+                    or (average is not None and abs(row[3] - average) > 0.01 + 1e-9)
+                    for row, (student, average) in zip(rows, averages)):
+                raise RuntimeError(f"{kind} {id}: the averages of analytics.py differ from the stored ones")
+            return elapsed, len(rows), statements
+
+        results[f"{kind} numpy"] = repeat(run_numpy, iterations)
+        results[f"{kind} sql"] = repeat(run_sql, iterations)
+    return results
+
+# The transcripts of the students of the curriculum having the most students,
+# written to a zip archive in memory: rendered one by one from the page of
+# each student (personPage(), as when the pages are loaded one by one), and
+# by transcripts.generate_transcripts() in this process and in a pool of
+# TRANSCRIPT_PROCESSES processes (started by each run).
+@suite('transcripts')
+def bench_transcripts(sample, iterations):
+    import transcripts
+    with Model() as m:
+        m.cursor.execute("""
+        SELECT curriculum FROM CurriculumPerson GROUP BY curriculum ORDER BY count(*) DESC, curriculum LIMIT 1
+        """)
+        idCurriculum = m.cursor.fetchone()[0]
+        m.cursor.execute("SELECT student FROM CurriculumPerson WHERE curriculum = %s", (idCurriculum,))
+        students = [row[0] for row in m.cursor.fetchall()]
+
+    def run_pages(i):
+        get_read_cache().clear()
+        with Model() as model:
+            def call():
+                writer = transcripts.TranscriptWriter(io.BytesIO())
+                curriculum = model.getNameOfCurriculum(idCurriculum)
+                for student in students:
+                    name, curriculums, grades = model.personPage(student)
+                    row = (student, name, "", len(students), [(c.name, c.average) for c in curriculums],
+                           [(g.date, g.curriculum_name, g.course_name, g.validation_name, g.grade)
+                            for g in grades])
+                    for (filename, data) in transcripts.render_transcripts(curriculum, [row]):
+                        writer.write(filename, data)
+                writer.close()
+                return len(students)
+            return timed(call)
+
+    def run_batch(workers):
+        def run(i):
+            with Model() as model:
+                return timed(lambda: transcripts.generate_transcripts(model, idCurriculum, io.BytesIO(),
+                                                                      workers)[0])
+        return run
+
+    results = {}
+    count = max(1, iterations // SLOW_DIVISOR)
+    for operation, run in (("pages", run_pages),
+                           ("batch, 1 process", run_batch(1)),
+                           (f"batch, {TRANSCRIPT_PROCESSES} processes", run_batch(TRANSCRIPT_PROCESSES))):
+        results[operation] = summary = repeat(run, count)
+        summary['transcripts_per_s'] = round(summary['rows'] / (summary['mean_ms'] / 1000), 1)
+    return results
+
+# The reads of REPLICA_OPERATIONS run on the primary (by a Model which wrote,
+# see Model.runRead()) and routed to the replicas, while a thread creates and
+# deletes persons in a loop. After each creation, the writer searches the
+# person (which must be found, on the primary), and other Models poll the
+# replicas until they see it: the delay is reported as the latency of
+# "replication" (in rows, the number of polls). The statements of the writer
+# are counted in the queries of the reads.
+@suite('replicas')
+def bench_replicas(sample, iterations):
+    if not get_replica_set().replicas:
+        return {'(no replicas, see --replicas)': None}
+    writes = []
+    errors = []
+    stop = threading.Event()
+    def writer():
+        try:
+            write()
+        except Exception as error:
+            errors.append(error)
+    def write():
+        while not stop.is_set():
+            name = f"Replicated{len(writes)}"
+            with Model() as m:
+                [idPerson] = m.createPersons([(name, "Bench", "1 rue du Test", "0600000000")])
+                start = time.perf_counter()
+                if idPerson not in (row[0] for row in m.searchPersons(name)):
+                    raise RuntimeError(f"{name}: a write was not read back by its Model")
+                for polls in range(1, REPLICA_POLLS + 1):
+                    with Model() as replica:
+                        if replica.searchPersons(name):
+                            break
+                writes.append((time.perf_counter() - start, polls, 2))
+                m.deletePerson(idPerson)
+    thread = threading.Thread(target=writer)
+    thread.start()
+    results = {}
+    try:
+        for name in REPLICA_OPERATIONS:
+            parameters = [p for p in list(inspect.signature(getattr(Model, name)).parameters)[1:]
+                          if p not in ('limit', 'after', 'before', 'withTotal')]
+            for route in ('primary', 'replicas'):
+                def run(i):
+                    args = [sample.id(name, p) for p in parameters]
+                    with Model() as m:
+                        m.wrote = route == 'primary'
+                        return timed(lambda: count_rows(getattr(m, name)(*args)))
+                results[f"{name} ({route})"] = repeat(run, iterations)
+    finally:
+        stop.set()
+        thread.join()
+    if errors:
+        raise errors[0]
+    results['replication'] = summarize(writes) if writes else None
+    return results
+
+# Generate the data, run the given suites and return the results with the
+# parameters of the run.
+def benchmark(scale, seed=0, iterations=ITERATIONS, suites=None, latency=0):
+    migrate.migrate()
+    start = time.perf_counter()
+    counts = datagen.generate(**datagen.SCALES[scale], seed=seed)
+    generation = time.perf_counter() - start
+
+    rng = random.Random(seed)
+    with LatencyProxy(latency) if latency else contextlib.nullcontext():
+        with Model() as model:
+            model.cursor.execute("SHOW server_version")
+            version = model.cursor.fetchone()[0]
+            sample = Sample(model, rng)
+            results = {name: SUITES[name](sample, iterations) for name in (suites or SUITES)}
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(timespec="seconds"),
+            'commit': commit,
+            'python': platform.python_version(),
+            'postgres': version,
+            'scale': scale,
+            'parameters': datagen.SCALES[scale],
+            'seed': seed,
+            'iterations': iterations,
+            'latency_ms': latency,
+            'replicas': [replica.name for replica in get_replica_set().replicas],
+            'rows': counts,
+            'generation_s': round(generation, 1),
+            'prepared_statements': get_statement_registry().stats(),
+        },
+        'results': results,
+    }
+
+def print_results(report):
+    for name, results in report['results'].items():
+        print(f"== {name}")
+        unit = next((unit for r in results.values() if r for unit in ('rows', 'bytes') if unit in r), 'rows')
+        print(f"{'operation':40} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {unit:>10} {'queries':>8}")
+        for operation, r in results.items():
+            if r is None:
+                print(f"{operation:40} skipped")
+                continue
+            print(f"{operation:40} {r['p50_ms']:9.2f} {r['p95_ms']:9.2f} {r['p99_ms']:9.2f} {r[unit]:10} {r['queries']:8}"
+                  + (f"  {r['requests_per_s']} requests/s" if 'requests_per_s' in r else "")
+                  + (f"  {r['transcripts_per_s']} transcripts/s" if 'transcripts_per_s' in r else "")
+                  + (f"  {r['bytes_per_row']} bytes/row kept ({r['row_bytes']} for the row itself),"
+                     f" {r['peak_bytes_per_row']} at peak, {r['blocks_per_row']} blocks/row"
+                     if 'bytes_per_row' in r else ""))
+
+# Print the latencies of two reports side by side.
+def compare(before, after):
+    print(f"{'operation':48} {'p50 before':>10} {'after':>9} {'ratio':>6} {'p95 before':>10} {'after':>9} {'queries':>9}")
+    for name, results in after['results'].items():
+        for operation, r in results.items():
+            b = before['results'].get(name, {}).get(operation)
+            if r is None or b is None:
+                continue
+            print(f"{name + ' ' + operation:48} {b['p50_ms']:10.2f} {r['p50_ms']:9.2f} "
+                  f"{r['p50_ms'] / b['p50_ms'] if b['p50_ms'] else 0:6.2f} {b['p95_ms']:10.2f} {r['p95_ms']:9.2f} "
+                  f"{b['queries']:>4} -> {r['queries']}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the queries of Model and the pages of run.py.")
+    parser.add_argument("--scale", choices=datagen.SCALES, default="small")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--iterations", type=int, default=ITERATIONS)
+    parser.add_argument("--suite", action="append", choices=SUITES, help="suite to run (default all)")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="round-trip time in milliseconds added to the queries, to simulate a remote database")
+    parser.add_argument("--replicas", type=int, default=0,
+                        help="number of streaming replicas of the throwaway database, to which the reads are routed")
+    parser.add_argument("--env-database", action="store_true",
+                        help="use the database of the environment instead of a throwaway one (its data is replaced)")
+    parser.add_argument("--output", help="file where to write the results as JSON")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two results files")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            compare(json.load(before), json.load(after))
+        sys.exit(0)
+
+    if args.env_database:
+        from dotenv import load_dotenv
+        load_dotenv()
+        report = benchmark(args.scale, args.seed, args.iterations, args.suite, args.latency)
+    else:
+        with ThrowawayPostgres(replicas=args.replicas):
+            report = benchmark(args.scale, args.seed, args.iterations, args.suite, args.latency)
+
+    print_results(report)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+import threading
+import time
+from collections import OrderedDict
+
+# Tables whose rows may be deleted along with the rows of a given table,
+# following the ON DELETE CASCADE foreign keys declared in migrations/.
+CASCADES = {
+    'Persons': ['Curriculums', 'CurriculumPerson', 'Courses', 'Grades', 'CourseAverages'],
+    'Curriculums': ['CurriculumPerson', 'CourseCurriculum'],
+    'CurriculumPerson': ['CurriculumAverages'],
+    'Courses': ['CourseCurriculum', 'Validations', 'CourseAverages'],
+    'Validations': ['Grades'],
+}
+
+# Return the given tables together with all the tables reached by cascading
+# deletes from them.
+def cascade(tables):
+    result = set()
+    todo = list(tables)
+    while todo:
+        table = todo.pop()
+        if table not in result:
+            result.add(table)
+            todo.extend(CASCADES.get(table, []))
+    return result
+
+# A process-wide cache of query results, bounded both in time (entries expire
+# after ttl seconds) and in size (the least recently used entry is evicted when
+# there are more than maxsize entries).
+#
+# Each entry records the tables it was computed from, and invalidate() evicts
+# all the entries reading one of the written tables. Every table also has a
+# version number bumped on invalidation, and the whole cache one bumped by
+# clear(): a result computed while a table was written (or the cache
+# cleared) is not stored, as it may already be stale. The caches linked to
+# this one (see link()) are invalidated and cleared along with it.
+class ReadCache:
+    def __init__(self, maxsize=256, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.epoch = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.linked = []
+
+    # Invalidate and clear the given cache whenever this one is, e.g. for a
+    # cache of values computed from the results cached by this one.
+    def link(self, other):
+        with self.lock:
+            self.linked.append(other)
+
+    # Return a snapshot of the versions of the given tables, to give to put().
+    # If a snapshot of all the tables is given (see snapshot()), the versions
+    # are the ones it recorded.
+    def version(self, tables, snapshot=None):
+        with self.lock:
+            epoch, versions = snapshot or (self.epoch, self.versions)
+            return (epoch,) + tuple(versions.get(table, 0) for table in tables)
+
+    # Return a snapshot of the versions of all the tables, for the results
+    # whose tables are only known once computed (see version()).
+    def snapshot(self):
+        with self.lock:
+            return self.epoch, dict(self.versions)
+
+    # Return (True, value) if key is cached, (False, None) otherwise.
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            value, tables, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def put(self, key, value, tables, version):
+        with self.lock:
+            if version != (self.epoch,) + tuple(self.versions.get(table, 0) for table in tables):
+                return
+            self.entries[key] = (value, frozenset(tables), time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    # Evict the entries reading one of the given tables.
+    def invalidate(self, tables):
+        tables = set(tables)
+        with self.lock:
+            for table in tables:
+                self.versions[table] = self.versions.get(table, 0) + 1
+            stale = [key for key, (_, read, _) in self.entries.items() if read & tables]
+            for key in stale:
+                del self.entries[key]
+            self.invalidations += len(stale)
+            linked = list(self.linked)
+        for other in linked:
+            other.invalidate(tables)
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.entries.clear()
+            linked = list(self.linked)
+        for other in linked:
+            other.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
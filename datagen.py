@@ -0,0 +1,147 @@
+#!/usr/bin/python
+
+# Generator of synthetic data for the schema of migrations/, to measure the
+# queries of Model at realistic volumes (see benchmark.py).
+#
+# The data is fully determined by the scale and the seed:
+#   - the first STAFF_RATIO of the persons are staff, teaching the courses
+#     and managing the curriculums, the others are students;
+#   - each curriculum has coursesPerCurriculum courses of its own, each of
+#     which is also registered to another curriculum with SHARED_COURSE_RATIO
+#     probability;
+#   - each student is registered to one curriculum, and to a second one with
+#     SECOND_CURRICULUM_RATIO probability;
+#   - each course has validationsPerCourse validations, and each student of a
+#     course has a grade for each of its validations with probability
+#     gradeDensity.
+#
+# Usage: python datagen.py [small|medium|large] [--seed N]
+# WARNING: this deletes all the data of the database configured in .env.
+
+import io
+import sys
+import random
+import datetime
+import psycopg2
+from model import Model, get_db_url
+
+STAFF_RATIO = 0.05
+SHARED_COURSE_RATIO = 0.1
+SECOND_CURRICULUM_RATIO = 0.1
+
+# Predefined scales, as keyword arguments of generate().
+SCALES = {
+    'small': dict(persons=1000, curriculums=5, coursesPerCurriculum=8, validationsPerCourse=3, gradeDensity=0.9),
+    'medium': dict(persons=10000, curriculums=20, coursesPerCurriculum=10, validationsPerCourse=4, gradeDensity=0.9),
+    'large': dict(persons=50000, curriculums=40, coursesPerCurriculum=12, validationsPerCourse=4, gradeDensity=0.9),
+}
+
+# Number of rows sent by each COPY.
+COPY_BATCH_SIZE = 100000
+
+LASTNAMES = ["Martin", "Bernard", "Dubois", "Thomas", "Robert", "Richard", "Petit", "Durand",
+             "Leroy", "Moreau", "Simon", "Laurent", "Lefebvre", "Michel", "Garcia", "David"]
+FIRSTNAMES = ["Jean", "Marie", "Pierre", "Anne", "Louis", "Claire", "Paul", "Julie",
+              "Hugo", "Emma", "Lucas", "Lea", "Jules", "Chloe", "Adam", "Alice"]
+
+# Load the rows (tuples) yielded by rows into the given columns of a table.
+def copy_rows(cursor, table, columns, rows):
+    def flush(buffer):
+        buffer.seek(0)
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+    buffer, count = io.StringIO(), 0
+    for row in rows:
+        buffer.write("\t".join(str(value) for value in row) + "\n")
+        count += 1
+        if count % COPY_BATCH_SIZE == 0:
+            flush(buffer)
+            buffer = io.StringIO()
+    flush(buffer)
+    return count
+
+# Replace the content of the database by generated data and return the
+# number of rows of each table.
+def generate(persons, curriculums, coursesPerCurriculum, validationsPerCourse, gradeDensity, seed=0, url=None):
+    rng = random.Random(seed)
+    staff = max(2, int(persons * STAFF_RATIO))
+    students = range(staff + 1, persons + 1)
+    courses = curriculums * coursesPerCurriculum
+    validations = courses * validationsPerCourse
+    counts = {}
+
+    connection = psycopg2.connect(url or get_db_url())
+    with connection:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+            TRUNCATE Persons, Curriculums, CurriculumPerson, Courses, CourseCurriculum,
+                     Validations, Grades, CourseAverages, CurriculumAverages
+            RESTART IDENTITY
+            """)
+
+            counts['Persons'] = copy_rows(cursor, "Persons", ["lastname", "firstname", "address", "phone"], (
+                (rng.choice(LASTNAMES) + str(i), rng.choice(FIRSTNAMES), f"{i} rue de l'Universite", f"06{i:08d}")
+                for i in range(1, persons + 1)))
+
+            counts['Curriculums'] = copy_rows(cursor, "Curriculums", ["name", "secretary", "director"], (
+                (f"Curriculum {c}", rng.randint(1, staff), rng.randint(1, staff))
+                for c in range(1, curriculums + 1)))
+
+            counts['Courses'] = copy_rows(cursor, "Courses", ["name", "teacher"], (
+                (f"Course {k}", rng.randint(1, staff)) for k in range(1, courses + 1)))
+
+            # Course k belongs to curriculum (k - 1) // coursesPerCurriculum + 1.
+            courseCurriculums = {k: [(k - 1) // coursesPerCurriculum + 1] for k in range(1, courses + 1)}
+            for k, cs in courseCurriculums.items():
+                if curriculums > 1 and rng.random() < SHARED_COURSE_RATIO:
+                    cs.append(rng.choice([c for c in range(1, curriculums + 1) if c != cs[0]]))
+            counts['CourseCurriculum'] = copy_rows(cursor, "CourseCurriculum", ["course", "curriculum", "ects"], (
+                (k, c, rng.choice([3, 4, 5, 6])) for k, cs in courseCurriculums.items() for c in cs))
+
+            start = datetime.date(2024, 9, 1)
+            validationCourses = [(v - 1) // validationsPerCourse + 1 for v in range(1, validations + 1)]
+            counts['Validations'] = copy_rows(cursor, "Validations", ["name", "coefficient", "date", "course"], (
+                (f"Exam {(v - 1) % validationsPerCourse + 1}", rng.randint(1, 4),
+                 start + datetime.timedelta(days=rng.randint(0, 270)), k)
+                for v, k in enumerate(validationCourses, 1)))
+
+            studentCurriculums = {}
+            for s in students:
+                cs = [rng.randint(1, curriculums)]
+                if curriculums > 1 and rng.random() < SECOND_CURRICULUM_RATIO:
+                    cs.append(rng.choice([c for c in range(1, curriculums + 1) if c != cs[0]]))
+                studentCurriculums[s] = cs
+            counts['CurriculumPerson'] = copy_rows(cursor, "CurriculumPerson", ["student", "curriculum"], (
+                (s, c) for s, cs in studentCurriculums.items() for c in cs))
+
+            curriculumCourses = {}
+            for k, cs in courseCurriculums.items():
+                for c in cs:
+                    curriculumCourses.setdefault(c, []).append(k)
+            courseValidations = {}
+            for v, k in enumerate(validationCourses, 1):
+                courseValidations.setdefault(k, []).append(v)
+
+            def grades():
+                for s, cs in studentCurriculums.items():
+                    for k in sorted({k for c in cs for k in curriculumCourses.get(c, [])}):
+                        for v in courseValidations[k]:
+                            if rng.random() < gradeDensity:
+                                yield (s, v, round(rng.uniform(0, 20), 2))
+            counts['Grades'] = copy_rows(cursor, "Grades", ["student", "validation", "grade"], grades())
+
+    connection.close()
+
+    with Model() as model:
+        model.refreshAverages()
+        model.cursor.execute("ANALYZE")
+    return counts
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    scale = sys.argv[1] if len(sys.argv) > 1 and not sys.argv[1].startswith("--") else 'small'
+    seed = int(sys.argv[sys.argv.index("--seed") + 1]) if "--seed" in sys.argv else 0
+    for table, count in generate(**SCALES[scale], seed=seed).items():
+        print(f"{table}: {count} rows")
@@ -1,8 +1,40 @@
 #!/usr/bin/python
 
 from wtforms import Form, BooleanField, StringField, IntegerField, SelectField
+from wtforms import FileField, SelectMultipleField
 from wtforms import DecimalField, DateField, DateTimeField, validators
-from model import Model
+
+# Maximum number of persons listed in the select fields of persons. Beyond,
+# such a field only lists the persons submitted, and the others are found by
+# its search box (see static/search.js), from PERSON_SEARCH_URL.
+PERSON_CHOICES_LIMIT = 1000
+PERSON_SEARCH_URL = "/person/search/"
+
+
+# A form with select fields of persons, named in personFields. Their choices
+# are the page of Model.listPersonChoices(PERSON_CHOICES_LIMIT), cached by
+# the process until a person is written, or if there are more persons than
+# that, Model.listPersonChoicesOf() the persons submitted.
+class PersonChoicesForm(Form):
+    personFields = ()
+
+    # Return the IDs of the persons submitted in the person fields.
+    def submittedPersons(self):
+        ids = set()
+        for name in self.personFields:
+            data = self[name].data
+            ids.update(data if isinstance(data, list) else [data])
+        ids.discard(None)
+        return tuple(sorted(ids))
+
+    def setNames(self, model):
+        choices = model.listPersonChoices(PERSON_CHOICES_LIMIT)
+        search = choices.nextCursor is not None
+        if search:
+            choices = model.listPersonChoicesOf(*self.submittedPersons())
+        for name in self.personFields:
+            self[name].choices = choices
+            self[name].render_kw = {'data-search': PERSON_SEARCH_URL} if search else None
 
 
 class PersonForm(Form):
@@ -13,39 +45,27 @@ class PersonForm(Form):
     phone = StringField('Phone', [validators.Length(min=6, max=14)])
 
 
-class CurriculumForm(Form):
+class CurriculumForm(PersonChoicesForm):
+    personFields = ('secretary', 'director')
     formname = "Create a new curriculum"
     name = StringField('Name', [validators.Length(min=2, max=25)])
     secretary = SelectField('Secretary', coerce=int, choices=[])
     director = SelectField('Directory', coerce=int, choices=[])
 
-    def setNames(self):
-        with Model() as model:
-            l = [(p[0], p[1] + " " + p[2]) for p in model.listPersons()]
-            self.secretary.choices = l
-            self.director.choices = l
-
 
-class CourseForm(Form):
+class CourseForm(PersonChoicesForm):
+    personFields = ('teacher',)
     formname = "Create a new course"
     teacher = SelectField('Teacher', coerce=int, choices=[])
     name = StringField('Name of the course',
                        [validators.Length(min=2, max=25)])
-    
-    def setNames(self):
-        with Model() as model:
-            l = [(p[0], p[1] + " " + p[2]) for p in model.listPersons()]
-            self.teacher.choices = l
-
 
-class SelectStudentForm(Form):
-    formname = "Register a student into a curriculum"
-    student = SelectField('Student', coerce=int, choices=[])
 
-    def setNames(self):
-        with Model() as model:
-            l = [(p[0], p[1] + " " + p[2]) for p in model.listPersons()]
-            self.student.choices = l
+class SelectStudentForm(PersonChoicesForm):
+    personFields = ('students',)
+    formname = "Register students into a curriculum"
+    students = SelectMultipleField('Students', [validators.DataRequired()],
+                                   coerce=int, choices=[])
 
 
 class SelectCourseForm(Form):
@@ -53,11 +73,10 @@ class SelectCourseForm(Form):
     course = SelectField('Course', coerce=int, choices=[])
     ects = IntegerField('ECTS')
 
-    def setNames(self):
-        with Model() as model:
-            l = [(p[0], p[1] + " by " + p[3] + " " + p[4])
-                 for p in model.listCourses()]
-            self.course.choices = l
+    def setNames(self, model):
+        l = [(p[0], p[1] + " by " + p[3] + " " + p[4])
+             for p in model.listCourses()]
+        self.course.choices = l
 
 
 class ValidationForm(Form):
@@ -73,8 +92,14 @@ class GradesForm(Form):
     student = SelectField('Student', coerce=int, choices=[])
     grade = DecimalField('Grade')
 
-    def setNames(self, idCourse):
-        with Model() as model:
-            l = [(p[0], p[1] + " " + p[2])
-                 for p in model.listStudentsOfCourse(idCourse)]
-            self.student.choices = l
+    def setNames(self, model, idCourse):
+        l = [(p[0], p[1] + " " + p[2])
+             for p in model.listStudentsOfCourse(idCourse)]
+        self.student.choices = l
+
+
+class ImportGradesForm(Form):
+    formname = "Import grades from a CSV file of lines: student id, grade"
+    enctype = "multipart/form-data"
+    file = FileField('CSV file', [validators.InputRequired()])
+    upsert = BooleanField('Replace the existing grades')
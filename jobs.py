@@ -0,0 +1,340 @@
+#!/usr/bin/python
+
+import os
+import re
+import time
+import select
+import signal
+import socket
+import logging
+import argparse
+import inspect
+import threading
+import traceback
+import multiprocessing
+import psycopg2
+import psycopg2.errors
+import transcripts
+import views
+from model import Model, get_db_url
+
+# Background jobs: the heavy operations (recomputing averages, large exports
+# and transcripts, deletions cascading through the grades) enqueued by the
+# routes of run.py and asgi.py, which answer at once with the job to follow,
+# and run by a pool of worker processes:
+#
+#   python3 jobs.py --workers 2      (or flask --app run jobs)
+#
+# The jobs are kept in the Jobs table (see Model.enqueueJob()). A worker takes
+# the next queued job (see Model.claimJob()), runs the function of JOBS named
+# by its kind, and records its end, its result or its error. Meanwhile, a
+# thread of the worker records its progress every JOB_HEARTBEAT seconds and
+# stops it when it is cancelled. A failed job is tried again after a delay,
+# up to JOB_MAX_ATTEMPTS times, and the job of a worker which stopped without
+# a heartbeat for JOB_STALE_AFTER seconds is queued again. No more than
+# JOB_CONCURRENCY jobs run at once, whatever the number of workers, so that
+# the jobs keep connections and CPU of the database for the pages.
+
+# Number of worker processes of run_workers().
+JOB_WORKERS = 2
+
+# Maximum number of jobs running at once, among all the workers.
+JOB_CONCURRENCY = 2
+
+# Number of times a failed job is tried, and delay in seconds before trying it
+# again, doubled after each attempt.
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY = 10
+
+# Number of seconds between two records of the progress of a running job, and
+# without record after which its worker is deemed stopped.
+JOB_HEARTBEAT = 2
+JOB_STALE_AFTER = 60
+
+# Number of seconds a worker waits for the notification of a new job before
+# looking for one anyway (e.g. a job to try again).
+JOB_POLL_INTERVAL = 5
+
+# Directory of the files written by the jobs (e.g. the exports).
+JOB_RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "job-results")
+
+# Whether the deletions of run.py and asgi.py run as jobs rather than in the
+# request. The constants above can all be overridden by the environment
+# variables of the same name.
+BACKGROUND_JOBS = 0
+
+logger = logging.getLogger(__name__)
+LOG_FORMAT = "%(asctime)s %(processName)s %(message)s"
+
+# Return the value of the setting of the given name (see above), converted by
+# cast, by default to the type of the constant.
+def setting(name, cast=None):
+    value = os.getenv(name)
+    default = globals()[name]
+    return default if value is None else (cast or type(default))(value)
+
+# Whether the deletions of the routes run as jobs, see BACKGROUND_JOBS.
+def in_background():
+    return setting('BACKGROUND_JOBS') == 1
+
+# Raised in a job by Progress.update() when the job is cancelled.
+class JobCancelled(Exception):
+    pass
+
+# The progress of a running job, from 0 to 1, with a message, recorded by its
+# worker (see monitor_job()).
+class Progress:
+    def __init__(self, idJob):
+        self.idJob = idJob
+        self.value = 0
+        self.message = None
+        self.cancelled = False
+
+    # Record that done steps of total (if known) are done, and stop the job
+    # by raising JobCancelled if it was cancelled.
+    def update(self, done, total=None, message=None):
+        if self.cancelled:
+            raise JobCancelled()
+        if total:
+            self.value = done / total
+        self.message = message
+
+# The functions running the jobs, by kind. A job is called with a Model, its
+# Progress and its arguments, and returns its result (a JSON value). Its
+# arguments named id... are IDs: integers, or strings of digits (as taken
+# from the URLs).
+JOBS = {}
+
+# The functions checking the arguments of the jobs of a kind beyond their
+# IDs, by kind, see check().
+CHECKS = {}
+
+def job(kind, check=None):
+    def decorator(function):
+        JOBS[kind] = function
+        if check is not None:
+            CHECKS[kind] = check
+        return function
+    return decorator
+
+# The names of the files written by the jobs, before their extension.
+FILENAME_PATTERN = re.compile(r"[A-Za-z0-9_-]+")
+
+def is_id(value):
+    if isinstance(value, str):
+        return value.isascii() and value.isdigit()
+    return isinstance(value, int) and not isinstance(value, bool)
+
+# Raise ValueError unless args are arguments of the given function, called
+# after the given number of leading arguments, whose IDs are IDs (see JOBS).
+def check_arguments(function, leading, args):
+    try:
+        bound = inspect.signature(function).bind(*[None] * leading, *args)
+    except TypeError as error:
+        raise ValueError(str(error)) from None
+    for (name, value) in list(bound.arguments.items())[leading:]:
+        if name.startswith("id") and not is_id(value):
+            raise ValueError(f"{name} is not an ID: {value!r}")
+
+# Raise KeyError if kind is not a kind of job, or ValueError if args are not
+# valid arguments of its jobs, e.g. for those given to POST /jobs/.
+def check(kind, args):
+    if not isinstance(kind, str) or kind not in JOBS:
+        raise KeyError(kind)
+    check_arguments(JOBS[kind], 2, args)
+    if kind in CHECKS:
+        CHECKS[kind](*args)
+
+# Add a job to the queue and return its ID, or with an AsyncModel, the
+# awaitable of its ID. Raise KeyError for an unknown kind, see check().
+def enqueue(model, kind, *args):
+    if kind not in JOBS:
+        raise KeyError(kind)
+    return model.enqueueJob(kind, list(args), setting('JOB_MAX_ATTEMPTS'))
+
+@job('refreshAverages')
+def refresh_averages(model, progress):
+    model.refreshAverages()
+
+# The averages of a curriculum are recomputed course by course, then for the
+# curriculum itself, each step being committed on its own.
+@job('refreshCurriculumAverages')
+def refresh_curriculum_averages(model, progress, idCurriculum):
+    courses = model.listCoursesOfCurriculum(idCurriculum)
+    for (step, course) in enumerate(courses):
+        progress.update(step, len(courses) + 1, f"course {course.name}")
+        model.refreshAveragesOfCurriculum(idCurriculum, course.id)
+    progress.update(len(courses), len(courses) + 1, "curriculum")
+    model.refreshAveragesOfCurriculum(idCurriculum)
+    return {'courses': len(courses)}
+
+@job('deletePerson')
+def delete_person(model, progress, idPerson):
+    model.deletePerson(idPerson)
+
+@job('deleteCourse')
+def delete_course(model, progress, idCourse):
+    model.deleteCourse(idCourse)
+
+# Return the path of the file of JOB_RESULTS_DIR where a job writes its
+# result under the given name (of a file, any directory being dropped).
+def result_path(progress, name):
+    directory = setting('JOB_RESULTS_DIR')
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{progress.idJob}-{os.path.basename(name)}")
+
+# Raise ValueError unless the arguments are the ones of an export: a format
+# of views.EXPORT_FORMATS, a file name of FILENAME_PATTERN, a list of column
+# names, and an export method of Model with its arguments.
+def check_export(fmt, filename, columns, export, *args):
+    if fmt not in views.EXPORT_FORMATS:
+        raise ValueError(f"unknown export format {fmt!r}")
+    if not isinstance(filename, str) or not FILENAME_PATTERN.fullmatch(filename):
+        raise ValueError(f"invalid file name {filename!r}")
+    if not isinstance(columns, list) or not all(isinstance(column, str) for column in columns):
+        raise ValueError("the columns are not a list of names")
+    if not isinstance(export, str) or not export.startswith("export") or not hasattr(Model, export):
+        raise ValueError(f"unknown export {export!r}")
+    check_arguments(getattr(Model, export), 1, args)
+
+# Write the rows of an export of Model (see exportResponse() in run.py) to a
+# file of JOB_RESULTS_DIR, as CSV or NDJSON depending on fmt (see views.py).
+@job('export', check=check_export)
+def export_rows(model, progress, fmt, filename, columns, export, *args):
+    check_export(fmt, filename, columns, export, *args)
+    name = f"{filename}.{fmt}"
+    path = result_path(progress, name)
+    count = 0
+    with open(path, "w", newline="") as file:
+        file.write(views.exportHeader(fmt, columns))
+        for rows in getattr(model, export)(*args):
+            file.write(views.exportRows(fmt, columns, rows))
+            count += len(rows)
+            progress.update(count, None, f"{count} rows")
+    return {'file': os.path.basename(path), 'name': name, 'rows': count}
+
+# Write the transcripts of the students of a curriculum to a zip archive of
+# JOB_RESULTS_DIR (see transcripts.py).
+@job('transcripts')
+def write_transcripts(model, progress, idCurriculum):
+    name = f"transcripts-of-curriculum-{idCurriculum}.zip"
+    path = result_path(progress, name)
+    count, seconds = transcripts.generate_transcripts(
+        model, idCurriculum, path,
+        progress=lambda done, total: progress.update(done, total, f"{done} of {total} transcripts"))
+    return {'file': os.path.basename(path), 'name': name, 'transcripts': count,
+            'transcripts_per_s': round(count / seconds, 1)}
+
+# Record the progress of a running job every JOB_HEARTBEAT seconds until done
+# is set, on the Model of the worker (named name), and stop the job when it is
+# cancelled or taken from the worker: its Progress raises JobCancelled, and
+# its statement running, if any, is cancelled on the Model of the job.
+def monitor_job(worker, name, idJob, progress, model, done):
+    while not done.wait(setting('JOB_HEARTBEAT', float)):
+        try:
+            cancelled = worker.heartbeatJob(idJob, name, progress.value, progress.message)
+        except psycopg2.Error as error:
+            logger.warning("job %s: heartbeat failed: %s", idJob, str(error).strip())
+            continue
+        if cancelled and not progress.cancelled:
+            progress.cancelled = True
+            model.cancel()
+
+# Run a job taken by a worker (named name), on a Model of its own, and record
+# its end, unless the job was taken from the worker meanwhile.
+def run_job(worker, name, idJob, kind, args):
+    progress = Progress(idJob)
+    done = threading.Event()
+    start = time.monotonic()
+    result = error = None
+    with Model() as model:
+        monitor = threading.Thread(target=monitor_job, args=(worker, name, idJob, progress, model, done),
+                                   daemon=True)
+        monitor.start()
+        try:
+            result = JOBS[kind](model, progress, *args)
+            status = 'done'
+        except JobCancelled:
+            status = 'cancelled'
+        except Exception as exception:
+            if progress.cancelled and isinstance(exception, psycopg2.errors.QueryCanceled):
+                status = 'cancelled'
+            else:
+                status = 'failed'
+                error = "".join(traceback.format_exception_only(type(exception), exception)).strip()
+                logger.warning("job %s (%s) failed: %s", idJob, kind, traceback.format_exc())
+        finally:
+            done.set()
+            monitor.join()
+    status = worker.finishJob(idJob, name, status, result, error, setting('JOB_RETRY_DELAY', float))
+    if status is None:
+        logger.warning("job %s (%s): ended in %.3f s after it was taken from this worker, ignored",
+                       idJob, kind, time.monotonic() - start)
+    else:
+        logger.info("job %s (%s): %s in %.3f s", idJob, kind, status, time.monotonic() - start)
+
+# Run the queued jobs one at a time, waiting for the notification of a new
+# one (see Model.enqueueJob()) when there is none to run.
+def work():
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    listener = psycopg2.connect(get_db_url())
+    listener.autocommit = True
+    listener.cursor().execute("LISTEN jobs")
+    try:
+        with Model() as worker:
+            while True:
+                claimed = worker.claimJob(name, setting('JOB_CONCURRENCY'))
+                if claimed is not None:
+                    run_job(worker, name, *claimed[:3])
+                    continue
+                if worker.requeueStaleJobs(setting('JOB_STALE_AFTER', float)):
+                    continue
+                select.select([listener], [], [], setting('JOB_POLL_INTERVAL', float))
+                listener.poll()
+                listener.notifies.clear()
+    finally:
+        listener.close()
+
+# (not a daemon, so that a job can start processes, see transcripts.py)
+def start_worker(context):
+    process = context.Process(target=work)
+    process.start()
+    return process
+
+# Run the given number of worker processes, starting a new one when one stops
+# (e.g. killed for using too much memory), until interrupted or terminated.
+# The workers are terminated with it, their running jobs being queued again
+# once stale.
+def run_workers(count):
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    context = multiprocessing.get_context("spawn")
+    processes = [start_worker(context) for _ in range(count)]
+    logger.info("%d job workers started", count)
+    try:
+        while True:
+            time.sleep(setting('JOB_POLL_INTERVAL', float))
+            for (index, process) in enumerate(processes):
+                if not process.is_alive():
+                    logger.warning("job worker %s stopped (exit code %s), restarted",
+                                   process.pid, process.exitcode)
+                    processes[index] = start_worker(context)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Run the background jobs of run.py and asgi.py.")
+    parser.add_argument("--workers", type=int, default=setting('JOB_WORKERS'),
+                        help="number of worker processes (default JOB_WORKERS)")
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    run_workers(options.workers)
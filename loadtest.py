@@ -0,0 +1,502 @@
+#!/usr/bin/python
+
+# Load test of run.py (or asgi.py) served over HTTP: concurrent users replay
+# sessions of the school on the pages, while the latency of every request is
+# recorded.
+#
+# Each user opens a keep-alive connection and runs journeys one after the
+# other, picked at random with the weights of JOURNEYS:
+#   student    the page of a student, then the page of a curriculum;
+#   teacher    the page of a course, the page of one of its validations, then
+#              a grade entered on it (a student not graded yet, as long as
+#              there are some);
+#   secretary  the lists of the persons and of the curriculums, and the
+#              persons found by the start of a name;
+#   admin      a person and a course created, found by their names from the
+#              search boxes, then deleted.
+# The number of users goes up by stages (--users 1,2,4,...), each lasting
+# --duration seconds after an unrecorded warm-up of WARMUP_SECONDS. Each
+# stage reports its requests per second, the p50/p95/p99 latency and the
+# error rate (statuses of 400 and more, and failed connections), overall and
+# by route. The application is saturated at the last stage after which more
+# users do not raise the throughput by SATURATION_GAIN, or at which more than
+# MAX_ERROR_RATE of the requests fail.
+#
+# Each --config starts the application in its own processes, on a port of
+# 127.0.0.1, then stops it: APP[:PROCESSES][,VARIABLE=VALUE...], where APP is
+# run (that many processes of the threaded server of Werkzeug, sharing the
+# listening socket) or asgi (hypercorn with that many workers), e.g.
+# run:1 run:4 asgi:2 run:4,DB_POOL_MAX=20. The environment variables are
+# given to the application (see the constants of model.py and jobs.py).
+# With several configurations, their stages are printed side by side.
+#
+# By default, the data of datagen.py at --scale is loaded in a throwaway
+# PostgreSQL server (see ThrowawayPostgres in benchmark.py). With
+# --env-database, the database configured in the environment (or .env) is
+# used as it is: the load test adds grades to it, and creates and deletes
+# persons and courses.
+#
+# Usage:
+#   python loadtest.py [--config APP[:PROCESSES][,VARIABLE=VALUE...]]...
+#                      [--users N,N...] [--duration S] [--think MS]
+#                      [--scale small|medium|large] [--seed N]
+#                      [--env-database] [--output FILE]
+#   python loadtest.py --compare BEFORE.json AFTER.json
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import datetime
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+import urllib.parse
+from benchmark import ThrowawayPostgres, Sample, percentile
+import datagen
+import migrate
+from model import Model
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Configuration of the application, number of concurrent users of each stage
+# and duration in seconds of a stage.
+CONFIG = "run:2"
+USERS = (1, 2, 4, 8, 16, 32, 64)
+STAGE_SECONDS = 10
+
+# Seconds of requests not recorded before the first stage, to fill the caches
+# and the pools of connections of the application.
+WARMUP_SECONDS = 3
+
+# Mean time in milliseconds a user waits between two requests (0: none, each
+# user sending its next request as soon as it has the previous response).
+THINK_TIME = 0
+
+# Minimum ratio of the throughput of a stage to the one of the previous stage
+# under which the server is saturated, and maximum share of failed requests.
+SATURATION_GAIN = 1.1
+MAX_ERROR_RATE = 0.01
+
+# Seconds the application has to answer its first request once started, and
+# seconds a request can take.
+START_TIMEOUT = 60
+REQUEST_TIMEOUT = 60
+
+# Raised by a request sent once the stage is over.
+class StageOver(Exception):
+    pass
+
+# The requests of a stage: (route, status, seconds, bytes), status 0 for a
+# request without response. Shared by the users of the stage.
+class Recorder:
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.samples = []
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, route, status, elapsed, size, error=None):
+        with self.lock:
+            self.samples.append((route, status, elapsed, size))
+            if error is not None or status >= 400:
+                error = error or f"{status} {route}"
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+# A user of the application, on a connection of its own, opened again after
+# an error.
+class User:
+    def __init__(self, port, recorder, rng, think=THINK_TIME):
+        self.port = port
+        self.recorder = recorder
+        self.rng = rng
+        self.think = think / 1000
+        self.connection = None
+
+    # Send a request and return its status and body (None if it failed). The
+    # route is the rule of run.py, under which the request is recorded.
+    def request(self, method, path, route, form=None):
+        if self.think:
+            time.sleep(self.rng.expovariate(1 / self.think))
+        if time.monotonic() >= self.recorder.deadline:
+            raise StageOver()
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=REQUEST_TIMEOUT)
+        body = urllib.parse.urlencode(form) if form is not None else None
+        headers = {'Content-Type': "application/x-www-form-urlencoded"} if form is not None else {}
+        route = f"{method} {route}"
+        start = time.perf_counter()
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException) as error:
+            self.recorder.record(route, 0, time.perf_counter() - start, 0, f"{type(error).__name__} {route}")
+            self.close()
+            return 0, None
+        self.recorder.record(route, response.status, time.perf_counter() - start, len(data))
+        return response.status, data
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+# Ids of the data, from which the journeys pick their pages, and the students
+# not graded yet in some validations, shared by the teachers.
+class Data:
+    def __init__(self, seed):
+        with Model() as model:
+            self.sample = Sample(model, random.Random(seed))
+            validations = sorted(self.sample.ungraded)
+            model.cursor.execute("SELECT id, course FROM Validations WHERE id = ANY(%s)", (validations,))
+            courses = dict(model.cursor.fetchall())
+        self.ungraded = [(courses[validation], validation, student)
+                         for (validation, students) in self.sample.ungraded.items() for student in students]
+        random.Random(seed).shuffle(self.ungraded)
+        self.lock = threading.Lock()
+        self.count = 0
+
+    # Return a (course, validation, student) to grade: a student not graded
+    # yet while there are some, then any student (refused by the page if
+    # graded already, or not in the course).
+    def toGrade(self, rng):
+        with self.lock:
+            if self.ungraded:
+                return self.ungraded.pop()
+        validation, course = rng.choice(self.sample.validations)
+        return course, validation, rng.choice(self.sample.students)
+
+    # Return a name no other journey uses.
+    def uniqueName(self, prefix):
+        with self.lock:
+            self.count += 1
+            return f"{prefix}{os.getpid()}x{self.count}"
+
+##### Journeys
+
+JOURNEYS = {}
+
+def journey(name, weight):
+    def decorator(function):
+        JOURNEYS[name] = (weight, function)
+        return function
+    return decorator
+
+@journey('student', 50)
+def student_journey(user, data):
+    sample = data.sample
+    user.request("GET", f"/person/{sample.id('', 'idStudent')}/", "/person/<id>/")
+    user.request("GET", f"/curriculum/{sample.id('', 'idCurriculum')}/", "/curriculum/<id>/")
+
+@journey('teacher', 30)
+def teacher_journey(user, data):
+    course, validation, student = data.toGrade(user.rng)
+    user.request("GET", f"/course/{course}/", "/course/<id>/")
+    path = f"/course/{course}/{validation}/"
+    user.request("GET", path, "/course/<idCourse>/<idValidation>/")
+    user.request("POST", path, "/course/<idCourse>/<idValidation>/",
+                 {'student': student, 'grade': data.sample.grade()})
+
+@journey('secretary', 15)
+def secretary_journey(user, data):
+    user.request("GET", "/person/", "/person/")
+    user.request("GET", "/curriculum/", "/curriculum/")
+    user.request("GET", f"/person/?q={urllib.parse.quote(data.sample.id('', 'text'))}", "/person/?q=<text>")
+
+# (the deletions answer with a redirection, 302)
+@journey('admin', 5)
+def admin_journey(user, data):
+    lastname = data.uniqueName("Load")
+    user.request("POST", "/person/", "/person/",
+                 {'lastname': lastname, 'firstname': "Test", 'address': "1 rue du Test", 'phone': "0600000000"})
+    status, body = user.request("GET", f"/person/search/?q={lastname}", "/person/search/")
+    if status == 200:
+        for person in json.loads(body):
+            user.request("GET", f"/person/del/{person['id']}/", "/person/del/<id>/")
+    name = data.uniqueName("Load")
+    user.request("POST", "/course/", "/course/", {'name': name, 'teacher': data.sample.id('', 'idPerson')})
+    status, body = user.request("GET", f"/course/search/?q={name}", "/course/search/")
+    if status == 200:
+        for course in json.loads(body):
+            user.request("GET", f"/course/del/{course['id']}/", "/course/del/<id>/")
+
+# Run journeys picked by their weights until the stage is over.
+def run_user(user, data):
+    names = list(JOURNEYS)
+    weights = [JOURNEYS[name][0] for name in names]
+    try:
+        while True:
+            JOURNEYS[user.rng.choices(names, weights)[0]][1](user, data)
+    except StageOver:
+        pass
+    finally:
+        user.close()
+
+##### Application
+
+# The application of a configuration (see above), started in its own
+# processes on a listening socket of 127.0.0.1 they share.
+class Server:
+    def __init__(self, config):
+        app, _, options = config.partition(",")
+        self.app, _, processes = app.partition(":")
+        if self.app not in ('run', 'asgi'):
+            raise ValueError(f"unknown application {self.app!r} in {config!r}")
+        self.processes = int(processes or 1)
+        self.environ = dict(option.split("=", 1) for option in options.split(",") if option)
+        self.children = []
+
+    def __enter__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(1024)
+        self.port = self.socket.getsockname()[1]
+        fd = self.socket.fileno()
+        if self.app == 'run':
+            commands = [[sys.executable, os.path.abspath(__file__), "--serve", str(fd)]] * self.processes
+        else:
+            commands = [[sys.executable, "-m", "hypercorn", "--bind", f"fd://{fd}",
+                         "--workers", str(self.processes), "asgi:create_app()"]]
+        self.log = tempfile.TemporaryFile("w+")
+        try:
+            for command in commands:
+                self.children.append(subprocess.Popen(command, cwd=ROOT, env={**os.environ, **self.environ},
+                                                      pass_fds=(fd,), stdout=self.log, stderr=self.log))
+            self.wait()
+        except:
+            self.stop()
+            raise
+        return self
+
+    # Wait until the application answers.
+    def wait(self):
+        deadline = time.monotonic() + START_TIMEOUT
+        while True:
+            if any(child.poll() is not None for child in self.children):
+                self.log.seek(0)
+                raise RuntimeError(f"the application stopped:\n{self.log.read()}")
+            try:
+                connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=1)
+                connection.request("GET", "/")
+                if connection.getresponse().status == 200:
+                    return
+            except (OSError, http.client.HTTPException):
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"the application did not answer in {START_TIMEOUT} s")
+            time.sleep(0.2)
+
+    def stop(self):
+        for child in self.children:
+            child.terminate()
+        for child in self.children:
+            try:
+                child.wait(10)
+            except subprocess.TimeoutExpired:
+                child.kill()
+                child.wait()
+        self.socket.close()
+        self.log.close()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+# Serve run.py on the listening socket of the given file descriptor (in the
+# processes started by Server).
+def serve(fd):
+    import logging
+    from werkzeug.serving import make_server
+    from run import create_app
+    # (no line logged per request)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, create_app(), threaded=True, fd=fd)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+##### Stages
+
+# Summarize the samples of a stage of the given number of seconds.
+def summarize(samples, seconds):
+    times = [1000 * elapsed for (_, _, elapsed, _) in samples]
+    errors = sum(1 for (_, status, _, _) in samples if status == 0 or status >= 400)
+    return {
+        'requests': len(samples),
+        'requests_per_s': round(len(samples) / seconds, 1),
+        'p50_ms': round(percentile(times, 50), 2) if times else None,
+        'p95_ms': round(percentile(times, 95), 2) if times else None,
+        'p99_ms': round(percentile(times, 99), 2) if times else None,
+        'error_rate': round(errors / len(samples), 4) if samples else 0,
+        'bytes': round(sum(size for (_, _, _, size) in samples) / len(samples)) if samples else 0,
+    }
+
+# Run the given number of users for the given number of seconds, and return
+# the recorder of their requests.
+def run_stage(port, data, users, seconds, seed, think=THINK_TIME):
+    recorder = Recorder(time.monotonic() + seconds)
+    threads = [threading.Thread(target=run_user, args=(User(port, recorder, random.Random(seed * 1000 + i), think),
+                                                       data), daemon=True)
+               for i in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder
+
+# Return the stage at which the application is saturated, see above (None if
+# it is not at the last stage).
+def saturation(stages):
+    for (previous, stage) in zip(stages, stages[1:]):
+        if stage['error_rate'] > MAX_ERROR_RATE:
+            return previous
+        if stage['requests_per_s'] < previous['requests_per_s'] * SATURATION_GAIN:
+            return previous
+    if stages and stages[-1]['error_rate'] > MAX_ERROR_RATE:
+        return stages[-1]
+    return None
+
+# Load the application of a configuration by stages, and return its results.
+def load_test(config, data, users=USERS, seconds=STAGE_SECONDS, seed=0, think=THINK_TIME):
+    stages = []
+    with Server(config) as server:
+        run_stage(server.port, data, users[0], WARMUP_SECONDS, seed, think)
+        for (index, count) in enumerate(users):
+            recorder = run_stage(server.port, data, count, seconds, seed + index + 1, think)
+            stage = {'users': count, **summarize(recorder.samples, seconds), 'routes': {}, 'errors': recorder.errors}
+            for route in sorted({route for (route, _, _, _) in recorder.samples}):
+                stage['routes'][route] = summarize([s for s in recorder.samples if s[0] == route], seconds)
+            stages.append(stage)
+            print(f"{config}: {count} users, {stage['requests_per_s']} requests/s, p95 {stage['p95_ms']} ms, "
+                  f"{100 * stage['error_rate']:.2f}% errors", file=sys.stderr)
+    saturated = saturation(stages)
+    return {'stages': stages, 'saturation': saturated and saturated['users']}
+
+def run_load_tests(configs, users=USERS, seconds=STAGE_SECONDS, seed=0, think=THINK_TIME, scale=None):
+    migrate.migrate()
+    if scale is not None:
+        datagen.generate(**datagen.SCALES[scale], seed=seed)
+    data = Data(seed)
+    results = {config: load_test(config, data, users, seconds, seed, think) for config in configs}
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, cwd=ROOT).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(timespec="seconds"),
+            'commit': commit,
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'scale': scale,
+            'seed': seed,
+            'users': list(users),
+            'stage_seconds': seconds,
+            'think_ms': think,
+            'journeys': {name: weight for (name, (weight, _)) in JOURNEYS.items()},
+        },
+        'results': results,
+    }
+
+##### Report
+
+def print_stage_routes(config, result):
+    stages = result['stages']
+    users = result['saturation']
+    stage = next((s for s in stages if s['users'] == users), stages[-1])
+    state = f"saturated at {users} users" if users else f"not saturated at {stage['users']} users"
+    print(f"== {config}: {state}, {stage['requests_per_s']} requests/s")
+    print(f"{'users':>5} {'requests/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for s in stages:
+        print(f"{s['users']:5} {s['requests_per_s']:10} {s['p50_ms'] or 0:9.2f} {s['p95_ms'] or 0:9.2f} "
+              f"{s['p99_ms'] or 0:9.2f} {100 * s['error_rate']:6.2f}%")
+    print(f"-- by route, {stage['users']} users")
+    print(f"{'route':45} {'requests/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7} {'bytes':>8}")
+    for route, r in stage['routes'].items():
+        print(f"{route:45} {r['requests_per_s']:10} {r['p50_ms']:9.2f} {r['p95_ms']:9.2f} {r['p99_ms']:9.2f} "
+              f"{100 * r['error_rate']:6.2f}% {r['bytes']:8}")
+    for error, count in sorted(stage['errors'].items(), key=lambda item: -item[1])[:10]:
+        print(f"   {count} x {error}")
+
+# Print the stages of several configurations side by side.
+def print_side_by_side(results):
+    configs = list(results)
+    print(f"{'users':>5} " + " ".join(f"{config[:27]:>27}" for config in configs))
+    print(f"{'':5} " + " ".join(f"{'requests/s':>10} {'p95 ms':>9} {'errors':>6}" for _ in configs))
+    users = sorted({s['users'] for result in results.values() for s in result['stages']})
+    for count in users:
+        line = f"{count:5}"
+        for config in configs:
+            s = next((s for s in results[config]['stages'] if s['users'] == count), None)
+            line += (f" {s['requests_per_s']:10} {s['p95_ms'] or 0:9.2f} {100 * s['error_rate']:5.1f}%"
+                     if s else f" {'':27}")
+        print(line)
+    print(f"{'':5} " + " ".join(f"{'saturated at ' + str(results[config]['saturation'] or '-') + ' users':>27}"
+                                for config in configs))
+
+def print_results(report):
+    for config, result in report['results'].items():
+        print_stage_routes(config, result)
+    if len(report['results']) > 1:
+        print("== side by side")
+        print_side_by_side(report['results'])
+
+# Print the configurations of two reports side by side.
+def compare(before, after):
+    results = {}
+    for (label, report) in (("before", before), ("after", after)):
+        for config, result in report['results'].items():
+            results[f"{label} {config}"] = result
+    print_side_by_side(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test run.py or asgi.py with concurrent users.")
+    parser.add_argument("--config", action="append",
+                        help=f"APP[:PROCESSES][,VARIABLE=VALUE...] to load (default {CONFIG}), e.g. run:4")
+    parser.add_argument("--users", type=lambda text: [int(n) for n in text.split(",")], default=USERS,
+                        help="numbers of concurrent users of the stages (default %(default)s)")
+    parser.add_argument("--duration", type=float, default=STAGE_SECONDS, help="seconds of each stage")
+    parser.add_argument("--think", type=float, default=THINK_TIME,
+                        help="mean milliseconds a user waits between two requests")
+    parser.add_argument("--scale", choices=datagen.SCALES, default="small")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--env-database", action="store_true",
+                        help="use the database of the environment as it is instead of a throwaway one")
+    parser.add_argument("--output", help="file where to write the results as JSON")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two results files")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        serve(args.serve)
+        sys.exit(0)
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            compare(json.load(before), json.load(after))
+        sys.exit(0)
+
+    configs = args.config or [CONFIG]
+    for config in configs:
+        Server(config)  # (checks the configuration before loading the data)
+    if args.env_database:
+        from dotenv import load_dotenv
+        load_dotenv()
+        report = run_load_tests(configs, args.users, args.duration, args.seed, args.think)
+    else:
+        with ThrowawayPostgres(name="loadtest"):
+            report = run_load_tests(configs, args.users, args.duration, args.seed, args.think, args.scale)
+
+    print_results(report)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
@@ -0,0 +1,228 @@
+#!/usr/bin/python
+
+import bisect
+import threading
+import contextvars
+
+# Metrics of the process in the text format of Prometheus, served at /metrics
+# by run.py and asgi.py. Model records the duration, rows and SQL sent of each
+# statement, labelled by the Model method running it (see in_method()), the
+# duration of its methods and the time waited for a connection of the pool,
+# and the server chosen for each read method (see replicas.py).
+# The routes record their duration, size and number of statements (see
+# start_request()), and the pages the duration and size of their rendering
+# (see render.py). Recording a value takes a lock and a bisect, a few
+# microseconds, so that the metrics can stay on in production.
+
+# Upper bounds of the buckets of the histograms: seconds, numbers of rows or
+# bytes, and numbers of statements.
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+STATEMENTS_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# A counter by values of its labels.
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def inc(self, *labels, value=1):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + value
+
+    def render(self):
+        with self.lock:
+            return [f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}"
+                    for labels, value in sorted(self.series.items())]
+
+# A histogram by values of its labels: the number of values observed in each
+# bucket, their sum and their number.
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # For each value of the labels, [count of each bucket..., count above them, sum].
+        self.series = {}
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.series.get(labels)
+            if counts is None:
+                counts = self.series[labels] = [0] * (len(self.buckets) + 1) + [0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for labels, counts in sorted(self.series.items()):
+                total = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    total += count
+                    lines.append(f"{self.name}_bucket{format_labels(self.labels, labels, [('le', bound)])} {total}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {format_value(counts[-1])}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {total}")
+        return lines
+
+# A gauge by values of its labels: the last value set.
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.series[labels] = value
+
+    def render(self):
+        with self.lock:
+            return [f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}"
+                    for labels, value in sorted(self.series.items())]
+
+METRICS = []
+
+def register(metric):
+    METRICS.append(metric)
+    return metric
+
+STATEMENT_SECONDS = register(Histogram(
+    "db_statement_duration_seconds", "Duration of the statements sent by Model, by Model method.", ("method",)))
+STATEMENT_ROWS = register(Histogram(
+    "db_statement_rows", "Rows returned or written by the statements of Model, by Model method.", ("method",), SIZE_BUCKETS))
+STATEMENT_BYTES = register(Counter(
+    "db_statement_sent_bytes_total", "Bytes of SQL sent by the statements of Model, by Model method.", ("method",)))
+SLOW_STATEMENTS = register(Counter(
+    "db_slow_statements_total", "Statements slower than SLOW_QUERY_THRESHOLD, by Model method.", ("method",)))
+METHOD_SECONDS = register(Histogram(
+    "model_method_duration_seconds", "Duration of the methods of Model run on the database.", ("method",)))
+METHOD_CACHE_HITS = register(Counter(
+    "model_method_cache_hits_total", "Calls of the read methods of Model answered by a cache (request or process).", ("method", "cache")))
+READ_ROUTES = register(Counter(
+    "db_read_routes_total", "Read methods of Model run on the primary or on a replica, by method, server and reason.",
+    ("method", "server", "reason")))
+REPLICA_LAG_SECONDS = register(Gauge(
+    "db_replica_lag_seconds", "Replication lag of the replicas at their last check, by replica.", ("replica",)))
+REPLICA_FAILURES = register(Counter(
+    "db_replica_failures_total", "Replicas set aside because they were down or lagging, by replica and reason.",
+    ("replica", "reason")))
+POOL_WAIT_SECONDS = register(Histogram(
+    "db_pool_wait_seconds", "Time waited for a connection of the pool."))
+REQUEST_SECONDS = register(Histogram(
+    "http_request_duration_seconds", "Duration of the requests, by route, HTTP method and status.", ("route", "method", "status")))
+RESPONSE_BYTES = register(Histogram(
+    "http_response_bytes", "Size of the responses, by route.", ("route",), SIZE_BUCKETS))
+TEMPLATE_SECONDS = register(Histogram(
+    "template_render_duration_seconds", "Duration of the rendering of the templates, by template.", ("template",)))
+TEMPLATE_CHARACTERS = register(Histogram(
+    "template_render_characters", "Size of the rendered templates in characters, by template.", ("template",), SIZE_BUCKETS))
+TABLE_RENDER_SECONDS = register(Histogram(
+    "table_render_duration_seconds", "Duration of the rendering of the tables not found in the fragment cache."))
+FRAGMENT_CACHE_LOOKUPS = register(Counter(
+    "fragment_cache_lookups_total", "Tables of the cached lists found in the fragment cache (hit) or read and rendered (miss).", ("result",)))
+REQUEST_STATEMENTS = register(Histogram(
+    "http_request_statements", "Statements sent to the database (round trips) per request, by route.", ("route",), STATEMENTS_BUCKETS))
+
+# Return all the metrics in the text format of Prometheus.
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# Name of the Model method running in the current thread or task.
+_method = contextvars.ContextVar("method", default="")
+
+# Return the name of the Model method running, the label of its statements.
+def current_method():
+    return _method.get()
+
+# Label the statements run until reset_method(token) with the given method,
+# and return the token to give to it.
+def in_method(name):
+    return _method.set(name)
+
+def reset_method(token):
+    _method.reset(token)
+
+# The statements of the request being served, the tables read by its read
+# methods of Model, and whether one of them was read from a replica (see
+# render.first_served()).
+class RequestStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements = 0
+        self.tables = set()
+        self.replica = False
+
+    def statement(self):
+        with self.lock:
+            self.statements += 1
+
+    def read(self, tables, replica=False):
+        with self.lock:
+            self.tables.update(tables)
+            self.replica = self.replica or replica
+
+_request = contextvars.ContextVar("request", default=None)
+
+# Count the statements sent from now on in the current context (and the
+# contexts copied from it) as part of a new request.
+def start_request():
+    stats = RequestStats()
+    _request.set(stats)
+    return stats
+
+# Return the RequestStats of the current request, None if there is none.
+def current_request():
+    return _request.get()
+
+# Count a statement sent to the database for the current request, if any.
+def count_statement():
+    stats = _request.get()
+    if stats is not None:
+        stats.statement()
+
+# Record that the current request, if any, read the given tables, from a
+# replica if replica is set.
+def count_read(tables, replica=False):
+    stats = _request.get()
+    if stats is not None:
+        stats.read(tables, replica)
+
+# Record a request started by start_request(), which took the given number
+# of seconds. size is the number of bytes of the response, None if unknown.
+def finish_request(stats, seconds, route, method, status, size=None):
+    if _request.get() is stats:
+        _request.set(None)
+    REQUEST_SECONDS.observe(seconds, route, method, status)
+    REQUEST_STATEMENTS.observe(stats.statements, route)
+    if size is not None:
+        RESPONSE_BYTES.observe(size, route)
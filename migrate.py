@@ -0,0 +1,190 @@
+#!/usr/bin/python
+
+# Versioned migrations of the database schema.
+#
+# The migrations are the files migrations/<version>_<name>.sql, applied in
+# increasing version order. Each one runs in its own transaction, and the
+# applied versions are recorded in the SchemaMigrations table so that only the
+# pending ones run at startup.
+#
+# Usage:
+#   python migrate.py                  apply the pending migrations
+#   python migrate.py --status         list the migrations and whether they are applied
+#   python migrate.py --verify [ROWS]  EXPLAIN every Model query and report the
+#                                      sequential scans on tables of more than
+#                                      ROWS rows (default 10000)
+
+import os
+import re
+import sys
+import inspect
+import psycopg2
+from model import Model, get_db_url, get_read_cache
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Arbitrary key preventing two processes from migrating at the same time.
+MIGRATIONS_LOCK = 2010
+
+# Tables with at least this many rows should not be scanned sequentially.
+VERIFY_MIN_ROWS = 10000
+
+# Return the list of (version, name, path) of the available migrations.
+def list_migrations():
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = re.fullmatch(r"(\d+)_(\w+)\.sql", filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    return sorted(migrations)
+
+def applied_versions(cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS SchemaMigrations
+    (
+        version INT PRIMARY KEY NOT NULL,
+        name VARCHAR NOT NULL,
+        applied_at TIMESTAMP NOT NULL DEFAULT now()
+    )
+    """)
+    cursor.execute("SELECT version FROM SchemaMigrations")
+    return {row[0] for row in cursor.fetchall()}
+
+# Apply the pending migrations and return their versions.
+def migrate(url=None):
+    connection = psycopg2.connect(url or get_db_url())
+    applied = []
+    try:
+        # Most of the time there is none: check it without taking the lock.
+        with connection:
+            with connection.cursor() as cursor:
+                done = applied_versions(cursor)
+        for (version, name, path) in list_migrations():
+            if version in done:
+                continue
+            with connection:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK,))
+                    if version in applied_versions(cursor):
+                        continue
+                    with open(path, "r") as file:
+                        cursor.execute(file.read())
+                    cursor.execute("""
+                    INSERT INTO SchemaMigrations (version, name) VALUES (%s, %s)
+                    """, (version, name))
+                    print(f"Applied migration {version} ({name}).")
+                    applied.append(version)
+    finally:
+        connection.close()
+    return applied
+
+# Return a list of (version, name, applied?) of the available migrations.
+def status(url=None):
+    connection = psycopg2.connect(url or get_db_url())
+    try:
+        with connection:
+            with connection.cursor() as cursor:
+                versions = applied_versions(cursor)
+    finally:
+        connection.close()
+    return [(version, name, version in versions) for (version, name, _) in list_migrations()]
+
+# A cursor running EXPLAIN before each query, to check the plans of the
+# queries of a Model. The query itself is run afterwards as usual.
+class ExplainCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.plans = []
+
+    def execute(self, query, vars=None):
+        self.cursor.execute("EXPLAIN (FORMAT JSON) " + query, vars)
+        self.plans.append(self.cursor.fetchone()[0][0]["Plan"])
+        self.cursor.execute(query, vars)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+# Tables in which to pick an existing id for each parameter of the queries.
+SAMPLE_TABLES = {
+    'idPerson': 'Persons',
+    'idStudent': 'Persons',
+    'idCurriculum': 'Curriculums',
+    'idCourse': 'Courses',
+    'idValidation': 'Validations',
+    'idJob': 'Jobs',
+}
+
+# Sample values of the parameters of the queries which are not ids.
+SAMPLE_VALUES = {
+    'text': "a b",
+}
+
+# Return the table in which to pick an id for the given parameter of the
+# given method of Model.
+def parameter_table(method, parameter):
+    table = SAMPLE_TABLES.get(parameter)
+    if table is None:
+        table = next(t for t in ('Curriculum', 'Course', 'Validation', 'Person') if t in method) + "s"
+    return table
+
+def sample_id(cursor, table):
+    cursor.execute(f"SELECT id FROM {table} LIMIT 1")
+    row = cursor.fetchone()
+    return row[0] if row else 1
+
+# Return the relations scanned sequentially by a plan and its subplans.
+def seq_scans(plan):
+    relations = []
+    if plan["Node Type"] == "Seq Scan":
+        relations.append(plan["Relation Name"])
+    for subplan in plan.get("Plans", []):
+        relations.extend(seq_scans(subplan))
+    return relations
+
+# Run EXPLAIN on each read query of Model and return a list of
+# (query, table, rows) for the sequential scans on tables having at least
+# minRows rows.
+def verify(minRows=VERIFY_MIN_ROWS):
+    problems = []
+    get_read_cache().clear()
+    with Model() as model:
+        model.cursor.execute("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'")
+        sizes = {name: rows for (name, rows) in model.cursor.fetchall()}
+        cursor = model.cursor
+        for name, method in inspect.getmembers(Model, inspect.isfunction):
+            if not hasattr(method, "reads"):
+                continue
+            args = []
+            for parameter in list(inspect.signature(method).parameters.values())[1:]:
+                if parameter.default is not parameter.empty:
+                    break
+                if parameter.name in SAMPLE_VALUES:
+                    args.append(SAMPLE_VALUES[parameter.name])
+                    continue
+                args.append(sample_id(cursor, parameter_table(name, parameter.name)))
+            model.cursor = ExplainCursor(cursor)
+            getattr(model, name)(*args)
+            for plan in model.cursor.plans:
+                for relation in seq_scans(plan):
+                    if sizes.get(relation, 0) >= minRows:
+                        problems.append((name, relation, int(sizes[relation])))
+            model.cursor = cursor
+    return problems
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--status":
+        for (version, name, done) in status():
+            print(f"{version:04d} {name}: {'applied' if done else 'pending'}")
+    elif len(sys.argv) > 1 and sys.argv[1] == "--verify":
+        minRows = int(sys.argv[2]) if len(sys.argv) > 2 else VERIFY_MIN_ROWS
+        problems = verify(minRows)
+        for (query, table, rows) in problems:
+            print(f"{query}: sequential scan on {table} ({rows} rows)")
+        print(f"{len(problems)} sequential scans on tables of more than {minRows} rows.")
+        sys.exit(1 if problems else 0)
+    else:
+        if not migrate():
+            print("Database is up to date.")
@@ -64,3 +64,4 @@ CREATE TABLE IF NOT EXISTS Grades
     grade FLOAT NOT NULL CHECK (grade >= 0 AND grade <= 20),
     PRIMARY KEY (student, validation)
 );
+
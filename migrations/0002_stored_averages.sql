@@ -0,0 +1,51 @@
+-- Weighted averages of the students, kept up to date by the write queries of
+-- Model (see refresh_averages_sql() in model.py) so that the pages showing them
+-- do not recompute them from the Grades on each view.
+
+-- Average of a student in a course, for each course having validations and each
+-- student registered to a curriculum containing it. A missing grade counts as 0.
+CREATE TABLE IF NOT EXISTS CourseAverages
+(
+    student INT NOT NULL REFERENCES Persons(id) ON DELETE CASCADE,
+    course INT NOT NULL REFERENCES Courses(id) ON DELETE CASCADE,
+    grade FLOAT NOT NULL,
+    PRIMARY KEY (student, course)
+);
+
+-- Average of a student in each curriculum he is registered to, weighted by the
+-- ECTS of its courses having validations. NULL if there is no such course.
+CREATE TABLE IF NOT EXISTS CurriculumAverages
+(
+    student INT NOT NULL,
+    curriculum INT NOT NULL,
+    grade FLOAT,
+    PRIMARY KEY (student, curriculum),
+    FOREIGN KEY (student, curriculum) REFERENCES CurriculumPerson(student, curriculum) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS CurriculumAverages_curriculum ON CurriculumAverages (curriculum);
+
+-- Compute them once for the existing grades.
+TRUNCATE CourseAverages, CurriculumAverages;
+
+INSERT INTO CourseAverages (student, course, grade)
+SELECT Pairs.student, Pairs.course,
+       COALESCE(sum(Grades.grade * Validations.coefficient), 0) / sum(Validations.coefficient)
+FROM (
+    SELECT DISTINCT CurriculumPerson.student, CourseCurriculum.course
+    FROM CurriculumPerson
+    JOIN CourseCurriculum ON CourseCurriculum.curriculum = CurriculumPerson.curriculum
+) AS Pairs
+JOIN Validations ON Validations.course = Pairs.course
+LEFT JOIN Grades ON Grades.validation = Validations.id AND Grades.student = Pairs.student
+GROUP BY Pairs.student, Pairs.course;
+
+INSERT INTO CurriculumAverages (student, curriculum, grade)
+SELECT CurriculumPerson.student, CurriculumPerson.curriculum,
+       sum(CourseAverages.grade * CourseCurriculum.ects)
+           / NULLIF(sum(CourseCurriculum.ects) FILTER (WHERE CourseAverages.grade IS NOT NULL), 0)
+FROM CurriculumPerson
+LEFT JOIN CourseCurriculum ON CourseCurriculum.curriculum = CurriculumPerson.curriculum
+LEFT JOIN CourseAverages
+    ON CourseAverages.student = CurriculumPerson.student AND CourseAverages.course = CourseCurriculum.course
+GROUP BY CurriculumPerson.student, CurriculumPerson.curriculum;
@@ -0,0 +1,21 @@
+-- Secondary indexes on the foreign keys used to filter or join, and on the
+-- ON DELETE CASCADE foreign keys (deleting a row otherwise scans the tables
+-- referencing it). The primary keys already cover Grades.student,
+-- CurriculumPerson.student, CourseCurriculum.curriculum and the averages.
+
+CREATE INDEX IF NOT EXISTS Validations_course ON Validations (course);
+
+-- listGradesOfValidation sorts the grades of a validation.
+CREATE INDEX IF NOT EXISTS Grades_validation_grade ON Grades (validation, grade DESC);
+
+CREATE INDEX IF NOT EXISTS CourseCurriculum_course ON CourseCurriculum (course);
+
+CREATE INDEX IF NOT EXISTS CurriculumPerson_curriculum ON CurriculumPerson (curriculum);
+
+CREATE INDEX IF NOT EXISTS Courses_teacher ON Courses (teacher);
+
+CREATE INDEX IF NOT EXISTS Curriculums_secretary ON Curriculums (secretary);
+
+CREATE INDEX IF NOT EXISTS Curriculums_director ON Curriculums (director);
+
+CREATE INDEX IF NOT EXISTS CourseAverages_course ON CourseAverages (course);
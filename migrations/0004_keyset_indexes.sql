@@ -0,0 +1,10 @@
+-- Indexes matching the sort keys of the paginated lists of Model, so that a
+-- page is read from the index instead of sorting the whole list.
+
+-- listGradesOfValidation: by decreasing (grade, student).
+DROP INDEX IF EXISTS Grades_validation_grade;
+CREATE INDEX IF NOT EXISTS Grades_validation_grade_student ON Grades (validation, grade DESC, student DESC);
+
+-- listGradesOfCourse: by decreasing (date, id) of the validations of a course.
+DROP INDEX IF EXISTS Validations_course;
+CREATE INDEX IF NOT EXISTS Validations_course_date_id ON Validations (course, date DESC, id DESC);
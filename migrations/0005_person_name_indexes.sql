@@ -0,0 +1,10 @@
+-- Indexes on the names of the persons, for the choices of the forms and the
+-- search of a person as the name is typed.
+
+-- listPersonChoices: by (name, id), name being "lastname firstname".
+CREATE INDEX IF NOT EXISTS Persons_name_id ON Persons ((lastname || ' ' || firstname), id);
+
+-- searchPersons: the prefixes of the name and of the first name, whatever
+-- their case (text_pattern_ops, for LIKE 'prefix%' in any collation).
+CREATE INDEX IF NOT EXISTS Persons_lower_name ON Persons (lower(lastname || ' ' || firstname) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS Persons_lower_firstname ON Persons (lower(firstname) text_pattern_ops);
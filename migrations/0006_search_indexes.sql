@@ -0,0 +1,10 @@
+-- Indexes of the search of the persons (searchPersons): each way of finding
+-- a person is a prefix of one of these, read in index order up to the limit.
+
+-- "firstname lastname", as the name can also be typed (this also finds the
+-- first names, as lower(firstname) did).
+DROP INDEX IF EXISTS Persons_lower_firstname;
+CREATE INDEX IF NOT EXISTS Persons_lower_firstname_name ON Persons (lower(firstname || ' ' || lastname) text_pattern_ops);
+
+-- The phone numbers.
+CREATE INDEX IF NOT EXISTS Persons_phone ON Persons (phone text_pattern_ops);
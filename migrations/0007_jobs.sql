@@ -0,0 +1,32 @@
+-- Queue of the background jobs (see jobs.py): the heavy operations enqueued by
+-- the routes, run by the worker processes of jobs.py.
+
+-- A job runs the function of jobs.JOBS named kind with the arguments args.
+-- Its status goes from queued to running, then to done, failed or cancelled,
+-- or back to queued (after run_after) to be tried again after an error. Its
+-- worker updates its progress (from 0 to 1), message and heartbeat while it
+-- runs, and cancel_requested asks it to stop.
+CREATE TABLE IF NOT EXISTS Jobs
+(
+    id SERIAL PRIMARY KEY NOT NULL,
+    kind VARCHAR NOT NULL,
+    args JSONB NOT NULL DEFAULT '[]',
+    status VARCHAR NOT NULL DEFAULT 'queued'
+        CHECK (status IN ('queued', 'running', 'done', 'failed', 'cancelled')),
+    progress FLOAT NOT NULL DEFAULT 0,
+    message VARCHAR,
+    result JSONB,
+    error VARCHAR,
+    attempts INT NOT NULL DEFAULT 0,
+    max_attempts INT NOT NULL DEFAULT 3,
+    cancel_requested BOOLEAN NOT NULL DEFAULT FALSE,
+    worker VARCHAR,
+    created TIMESTAMPTZ NOT NULL DEFAULT now(),
+    run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+    started TIMESTAMPTZ,
+    heartbeat TIMESTAMPTZ,
+    finished TIMESTAMPTZ
+);
+
+-- claimJob: the next queued job; requeueStaleJobs: the running ones.
+CREATE INDEX IF NOT EXISTS Jobs_pending ON Jobs (status, run_after, id) WHERE status IN ('queued', 'running');
@@ -1,287 +1,1877 @@
 #!/usr/bin/python
 
 import sys
+import io
+import csv
+import json
+import base64
+import functools
+import collections
+import contextlib
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+from psycopg2.extras import execute_values
+import cache
+import statements
+import replicas
 import os
+import select
+import threading
+import time
+import logging
+import concurrent.futures
+import contextvars
+import metrics
 
 # The number of decimals to return for grades (e.g. 14.32 instead of 14.325622354). Si c'est pas de la doc ça...
 GRADES_DECIMAL_ROUNDING = 2
 
-def get_db_url():
-    return f"dbname='{os.getenv('DB_NAME')}' user='{os.getenv('DB_USER')}' host='psql.eleves.ens.fr' password='{os.getenv('DB_PASSWD')}'"
+# Bounds of the connection pool shared by all the Model instances of a process.
+# They can be overridden with the DB_POOL_MIN and DB_POOL_MAX environment variables.
+DB_POOL_MIN = 1
+DB_POOL_MAX = 10
 
-def init_db():
-    with open("init.sql", "r") as file:
-        sql = file.read()
+# Number of seconds to wait for a free connection before giving up.
+DB_POOL_TIMEOUT = 30
 
-        connection = psycopg2.connect(get_db_url())
-        connection.autocommit = True
+# A connection idle for longer than this (in seconds) is pinged before being
+# handed out, so that connections dropped by the server are never used.
+DB_POOL_HEALTH_CHECK_DELAY = 30
 
-        with connection:
+# Return the URL of the database on the given host (host or host:port), by
+# default the primary DB_HOST.
+def get_db_url(host=None):
+    host = host or os.getenv('DB_HOST', 'psql.eleves.ens.fr')
+    name, _, port = host.rpartition(':')
+    url = f"dbname='{os.getenv('DB_NAME')}' user='{os.getenv('DB_USER')}' host='{name if port.isdigit() else host}' password='{os.getenv('DB_PASSWD')}'"
+    return url + f" port='{port}'" if name and port.isdigit() else url
+
+# Hosts of the replicas of the database (host or host:port, separated by
+# commas) to which the read queries are sent, see replicas.py. They can be
+# set with the DB_REPLICA_HOSTS environment variable; none by default.
+DB_REPLICA_HOSTS = ""
+
+# Whether the statements of Model are prepared once per connection (see
+# statements.py). It can be overridden with the DB_PREPARED_STATEMENTS
+# environment variable, 0 running them as they are (e.g. to debug them).
+DB_PREPARED_STATEMENTS = 1
+
+# Maximum number of statements of the registry (see statements.py), and so
+# prepared on each connection: the least recently used ones are deallocated
+# beyond it. It can be overridden with the DB_PREPARED_STATEMENTS_MAX
+# environment variable.
+DB_PREPARED_STATEMENTS_MAX = 256
+
+# A psycopg2 connection remembering when it was last returned to the pool,
+# and the names of the statements prepared on it.
+class Connection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lastUsed = time.monotonic()
+        self.prepared = set()
+
+# A cursor counting the statements sent to the server by all the cursors of
+# the process, to measure the number of queries of a request (see benchmark.py
+# and metrics.count_statement()).
+class CountingCursor(psycopg2.extensions.cursor):
+    statements = 0
+    # (the cursors of several threads count at the same time)
+    lock = threading.Lock()
+
+    # Count a statement sent to the server (also by AsyncModel).
+    @staticmethod
+    def count():
+        with CountingCursor.lock:
+            CountingCursor.statements += 1
+        metrics.count_statement()
+
+    def execute(self, query, vars=None):
+        CountingCursor.count()
+        return super().execute(query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        CountingCursor.count()
+        return super().copy_expert(sql, file, size)
+
+# Statements longer than this (in seconds) are logged with their parameters,
+# and the first time with their plan by EXPLAIN ANALYZE (run in a transaction
+# rolled back, so that writes are not done twice). It can be overridden with
+# the SLOW_QUERY_THRESHOLD environment variable, 0 disabling the log.
+SLOW_QUERY_THRESHOLD = 0
+
+# Bounds of the memos of the statements (see _explained and _column_types):
+# number of statements, the least recently used being forgotten, and time to
+# live in seconds.
+STATEMENT_MEMO_SIZE = 1024
+STATEMENT_MEMO_TTL = 3600
+
+# The statements already explained in the slow query log (explained again
+# once forgotten).
+_explained = cache.ReadCache(STATEMENT_MEMO_SIZE, STATEMENT_MEMO_TTL)
+
+# Number of rows converted at once into records by Cursor.fetchall().
+FETCH_BATCH_SIZE = 1000
+
+# The cursor of Model, whose rows are records (see record_type()). The
+# statements of the registry (see get_statement_registry()) are prepared the
+# first time they are run on a connection, outside of a transaction so that
+# a failed PREPARE does not abort it, and then run by name. Their duration,
+# rows and size are recorded in metrics.py.
+class Cursor(CountingCursor, psycopg2.extras.NamedTupleCursor):
+    # Number of bytes of SQL sent by this cursor.
+    sentBytes = 0
+
+    # The class of the rows of the last statement (see NamedTupleCursor).
+    def _make_nt(self):
+        return record_type(tuple(column.name for column in self.description or ()))
+
+    # Make the records FETCH_BATCH_SIZE rows at a time, so that the tuples read
+    # by psycopg2 are not all kept next to them.
+    def fetchall(self):
+        if self.Record is None:
+            self.Record = self._make_nt()
+        make = self.Record._make
+        rows = []
+        while True:
+            batch = super(psycopg2.extras.NamedTupleCursor, self).fetchmany(FETCH_BATCH_SIZE)
+            if not batch:
+                return rows
+            rows.extend(map(make, batch))
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        sentBytes = self.sentBytes
+        try:
+            result = self.executeStatement(query, vars)
+        finally:
+            elapsed = time.perf_counter() - start
+            method = metrics.current_method()
+            metrics.STATEMENT_SECONDS.observe(elapsed, method)
+            metrics.STATEMENT_ROWS.observe(max(self.rowcount, 0), method)
+            metrics.STATEMENT_BYTES.inc(method, value=self.sentBytes - sentBytes)
+        threshold = float(os.getenv('SLOW_QUERY_THRESHOLD', SLOW_QUERY_THRESHOLD))
+        if threshold and elapsed > threshold:
+            self.logSlowStatement(method, elapsed, query, vars)
+        return result
+
+    # Log a statement slower than SLOW_QUERY_THRESHOLD (see above).
+    def logSlowStatement(self, method, elapsed, query, vars):
+        metrics.SLOW_STATEMENTS.inc(method)
+        plan = ""
+        if isinstance(query, str) and not _explained.get(query)[0] and statements.PREPARABLE.match(query):
+            _explained.put(query, True, (), _explained.version(()))
+            transaction = not self.connection.autocommit
+            with self.connection.cursor() as cursor:
+                cursor.execute("SAVEPOINT explain" if transaction else "BEGIN")
+                try:
+                    cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, vars)
+                    plan = "\n" + "\n".join(row[0] for row in cursor.fetchall())
+                except psycopg2.Error as error:
+                    plan = f"\nEXPLAIN failed: {error}"
+                finally:
+                    cursor.execute("ROLLBACK TO SAVEPOINT explain" if transaction else "ROLLBACK")
+        logger.warning("slow statement in %s: %.0f ms, parameters %r\n%s%s", method or "?", 1000 * elapsed,
+                       vars, query.decode() if isinstance(query, bytes) else query.strip(), plan)
+
+    # Run a statement, prepared on the connection if it is in the registry.
+    def executeStatement(self, query, vars):
+        registry = get_statement_registry()
+        statement = registry.get(query, vars)
+        if statement is None:
+            return self.send(query, vars)
+        if statement.name not in self.connection.prepared:
+            if not self.connection.autocommit:
+                return self.send(query, vars)
+            self.deallocateEvicted(registry)
+            try:
+                self.send(statement.prepareSql)
+            except psycopg2.ProgrammingError:
+                registry.failed(statement)
+                return self.send(query, vars)
+            self.connection.prepared.add(statement.name)
+            registry.prepared()
+        registry.executed()
+        return self.send(statement.executeSql, vars)
+
+    # Deallocate the statements prepared on the connection which were evicted
+    # from the registry since, before preparing another one.
+    def deallocateEvicted(self, registry):
+        evicted = registry.evicted(self.connection.prepared)
+        if evicted:
+            self.connection.prepared.difference_update(evicted)
+            self.send("; ".join(f"DEALLOCATE {name}" for name in evicted))
+            registry.deallocated(len(evicted))
+
+    # Send a statement to the server.
+    def send(self, query, vars=None):
+        try:
+            return super().execute(query, vars)
+        finally:
+            self.sentBytes += len(self.query or b"")
+
+# A thread-safe pool of connections. Contrary to psycopg2's pools, getconn()
+# blocks (up to DB_POOL_TIMEOUT seconds) instead of failing when all the
+# connections are in use, and checks the health of the connection it returns.
+class ConnectionPool:
+    def __init__(self, url, minconn, maxconn):
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, url, connection_factory=Connection)
+        # psycopg2 closes the connections given back beyond minconn, which
+        # would reconnect on most requests of a threaded server: keep up to
+        # maxconn of them.
+        self.pool.minconn = maxconn
+        self.available = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, timeout=DB_POOL_TIMEOUT):
+        start = time.perf_counter()
+        acquired = self.available.acquire(timeout=timeout)
+        metrics.POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+        if not acquired:
+            raise psycopg2.pool.PoolError("no database connection available")
+        try:
+            while True:
+                connection = self.pool.getconn()
+                if self.isHealthy(connection):
+                    return connection
+                self.pool.putconn(connection, close=True)
+        except:
+            self.available.release()
+            raise
+
+    def putconn(self, connection):
+        close = bool(connection.closed)
+        if not close and connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                close = True
+        connection.lastUsed = time.monotonic()
+        self.pool.putconn(connection, close=close)
+        self.available.release()
+
+    # Return False if the connection is closed or does not answer anymore.
+    def isHealthy(self, connection):
+        if connection.closed:
+            return False
+        if time.monotonic() - connection.lastUsed < DB_POOL_HEALTH_CHECK_DELAY:
+            return True
+        try:
             with connection.cursor() as cursor:
-                cursor.execute(sql)
-                print("Database initialized!")
+                cursor.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
 
-        connection.close()
+    def closeall(self):
+        self.pool.closeall()
 
-class Model:
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Return the connection pool of the given database URL, creating it on first use.
+def get_pool(url=None):
+    url = url or get_db_url()
+    with _pools_lock:
+        if url not in _pools:
+            minconn = int(os.getenv('DB_POOL_MIN', DB_POOL_MIN))
+            maxconn = int(os.getenv('DB_POOL_MAX', DB_POOL_MAX))
+            _pools[url] = ConnectionPool(url, minconn, maxconn)
+        return _pools[url]
+
+_replica_set = None
+
+# Return the replicas of the process (see replicas.py), creating them on first use.
+def get_replica_set():
+    global _replica_set
+    with _pools_lock:
+        if _replica_set is None:
+            hosts = [host.strip() for host in os.getenv('DB_REPLICA_HOSTS', DB_REPLICA_HOSTS).split(',') if host.strip()]
+            _replica_set = replicas.ReplicaSet([
+                replicas.Replica(host, get_db_url(host) + f" connect_timeout={replicas.REPLICA_CONNECT_TIMEOUT}")
+                for host in hosts])
+        return _replica_set
+
+_statement_registry = None
+
+# Return the process-wide registry of prepared statements, creating it on first use.
+def get_statement_registry():
+    global _statement_registry
+    with _pools_lock:
+        if _statement_registry is None:
+            enabled = bool(int(os.getenv('DB_PREPARED_STATEMENTS', DB_PREPARED_STATEMENTS)))
+            maxsize = int(os.getenv('DB_PREPARED_STATEMENTS_MAX', DB_PREPARED_STATEMENTS_MAX))
+            _statement_registry = statements.StatementRegistry(enabled, maxsize)
+        return _statement_registry
+
+# Bounds of the cache shared by all the Model instances of a process (see
+# cache.py): number of entries and time to live in seconds. They can be
+# overridden with the READ_CACHE_SIZE and READ_CACHE_TTL environment variables.
+READ_CACHE_SIZE = 256
+READ_CACHE_TTL = 60
+
+# Whether the writes of a process are notified to the other processes using
+# the database (the other workers of the web server, the workers of jobs.py),
+# so that they evict the results of the written tables from their caches at
+# once rather than up to READ_CACHE_TTL seconds later: a write of a table read
+# by a shared query (see query()) sends the names of the tables written on the
+# channel CACHE_CHANNEL (see Model.notifyWritten()), which a thread of each
+# process listens to on a connection of its own (see listen_writes()). It can
+# be overridden with the READ_CACHE_NOTIFY environment variable.
+READ_CACHE_NOTIFY = 1
+CACHE_CHANNEL = "cache"
+
+# Seconds without notification after which the listener checks its
+# connection, and seconds it waits before connecting again once it is lost.
+LISTEN_PING_INTERVAL = 30
+LISTEN_RETRY_DELAY = 5
+
+_read_cache = None
+
+# Return the process-wide cache of query results, creating it on first use,
+# with the thread invalidating it on the writes of the other processes.
+def get_read_cache():
+    global _read_cache
+    with _pools_lock:
+        if _read_cache is None:
+            maxsize = int(os.getenv('READ_CACHE_SIZE', READ_CACHE_SIZE))
+            ttl = float(os.getenv('READ_CACHE_TTL', READ_CACHE_TTL))
+            _read_cache = cache.ReadCache(maxsize, ttl)
+            if int(os.getenv('READ_CACHE_NOTIFY', READ_CACHE_NOTIFY)):
+                threading.Thread(target=listen_writes, args=(_read_cache, get_db_url()),
+                                 name="cache-listener", daemon=True).start()
+        return _read_cache
+
+# Invalidate the given cache with the tables written by the processes using
+# the database at url, as notified on CACHE_CHANNEL (by this process too).
+# The whole cache is cleared each time the listener connects, as the writes
+# made while it was not listening are not notified to it.
+def listen_writes(readCache, url):
+    while True:
+        try:
+            connection = psycopg2.connect(url)
+        except psycopg2.Error as error:
+            logger.warning("the cache listener cannot connect: %s", str(error).strip())
+            time.sleep(LISTEN_RETRY_DELAY)
+            continue
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {CACHE_CHANNEL}")
+                readCache.clear()
+                while True:
+                    if not select.select([connection], [], [], LISTEN_PING_INTERVAL)[0]:
+                        cursor.execute("SELECT 1")
+                    connection.poll()
+                    tables = {table for notify in connection.notifies for table in notify.payload.split(",")}
+                    connection.notifies.clear()
+                    if tables:
+                        readCache.invalidate(tables)
+        except psycopg2.Error as error:
+            logger.warning("the cache listener lost its connection: %s", str(error).strip())
+        finally:
+            connection.close()
+        time.sleep(LISTEN_RETRY_DELAY)
+
+# Yield the rows of the given query by lists of at most EXPORT_BATCH_SIZE
+# rows, from a server-side cursor of the given connection (see Model.stream()).
+def stream_rows(connection, sql, params):
+    with connection.cursor(name="export", cursor_factory=CountingCursor) as cursor:
+        cursor.itersize = EXPORT_BATCH_SIZE
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            yield rows
+
+# Run a method of Model, recording its duration in metrics.py and labelling
+# its statements with its name.
+def measured(method, self, args, kwargs):
+    token = metrics.in_method(method.__name__)
+    start = time.perf_counter()
+    try:
+        return method(self, *args, **kwargs)
+    finally:
+        metrics.METHOD_SECONDS.observe(time.perf_counter() - start, method.__name__)
+        metrics.reset_method(token)
+
+# Decorator for the read queries of Model, given the tables they read.
+# Results are memoized for the lifetime of the Model (that is, one request)
+# keyed by the method and its arguments, so that a page asking several times
+# for the same name or list only goes once to the database. If shared is set,
+# results are also kept across requests in the process-wide cache, until one
+# of the tables is written; but not inside a transaction, whose reads may see
+# its writes before they are committed (or rolled back), and which must not
+# read the results cached before them. The methods read from a replica when
+# possible (see Model.runRead()), unless primary is set, for the tables
+# written by other processes whose changes must be seen at once (see getJob()).
+# If page is set, the method reads a whole page (see Model.fetchTogether()): a
+# warning is logged if it takes longer than PAGE_BUDGET seconds, and after
+# PAGE_TIMEOUT seconds its statements are cancelled and PageTimeout raised (see
+# Model.runPage()).
+def query(*tables, shared=False, primary=False, page=False):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            key = (method.__name__, args, tuple(sorted(kwargs.items())))
+            metrics.count_read(tables)
+            if key in self.cache:
+                self.savedRoundTrips += 1
+                metrics.METHOD_CACHE_HITS.inc(method.__name__, "request")
+                return self.cache[key]
+            useShared = shared and not self.inTransaction
+            if useShared:
+                readCache = get_read_cache()
+                found, result = readCache.get(key)
+                if found:
+                    self.savedRoundTrips += 1
+                    metrics.METHOD_CACHE_HITS.inc(method.__name__, "process")
+                    self.cache[key] = result
+                    return result
+                version = readCache.version(tables)
+            reason = "shared" if shared else "primary" if primary else None
+            if page:
+                result = self.runPage(method.__name__, lambda: self.runRead(method, args, kwargs, reason))
+            else:
+                result = self.runRead(method, args, kwargs, reason)
+            if useShared:
+                readCache.put(key, result, tables, version)
+            self.cache[key] = result
+            return result
+        wrapper.reads = tables
+        wrapper.shared = shared
+        wrapper.primary = primary
+        wrapper.page = page
+        return wrapper
+    return decorator
+
+# Decorator for the write queries of Model, given the tables they write.
+# Anything memoized so far and reading these tables may be stale afterwards,
+# so the caches are invalidated, and the other processes notified (see
+# READ_CACHE_NOTIFY), once the transaction is committed if the query is part
+# of one. Deletes must set cascade, as they can remove rows of other tables
+# through the ON DELETE CASCADE foreign keys.
+def write(*tables, cascade=False):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            self.wrote = True
+            written = cache.cascade(tables) if cascade else tables
+            try:
+                result = measured(method, self, args, kwargs)
+            finally:
+                self.cache.clear()
+                if self.inTransaction:
+                    self.writtenTables.update(written)
+                else:
+                    get_read_cache().invalidate(written)
+            if not self.inTransaction:
+                self.notifyWritten(written)
+            return result
+        wrapper.writes = tables
+        return wrapper
+    return decorator
+
+# Query computing the average of each student in each course, for the
+# (student, course) pairs selected by the {scope} query that are still valid
+# (the course has validations and the student is registered to a curriculum
+# containing it). A missing grade counts as 0.
+COURSE_AVERAGES_SQL = """
+    SELECT Scope.student, Scope.course,
+           COALESCE(sum(Grades.grade * Validations.coefficient), 0) / sum(Validations.coefficient) AS grade
+    FROM (SELECT DISTINCT * FROM ({scope}) AS S) AS Scope (student, course)
+    JOIN Validations ON Validations.course = Scope.course
+    LEFT JOIN Grades ON Grades.validation = Validations.id AND Grades.student = Scope.student
+    WHERE EXISTS (
+        SELECT 1 FROM CurriculumPerson
+        JOIN CourseCurriculum ON CourseCurriculum.curriculum = CurriculumPerson.curriculum
+        WHERE CurriculumPerson.student = Scope.student AND CourseCurriculum.course = Scope.course
+    )
+    GROUP BY Scope.student, Scope.course
+"""
+
+# Query computing the average of each student in each curriculum, for the
+# (student, curriculum) pairs selected by the {scope} query, from the course
+# averages given by {courseAverages}. Courses without validations are ignored,
+# and the average is NULL if no course of the curriculum has validations.
+CURRICULUM_AVERAGES_SQL = """
+    SELECT CurriculumPerson.student, CurriculumPerson.curriculum,
+           sum(CourseAverages.grade * CourseCurriculum.ects)
+               / NULLIF(sum(CourseCurriculum.ects) FILTER (WHERE CourseAverages.grade IS NOT NULL), 0) AS grade
+    FROM CurriculumPerson
+    LEFT JOIN CourseCurriculum ON CourseCurriculum.curriculum = CurriculumPerson.curriculum
+    LEFT JOIN {courseAverages} AS CourseAverages
+        ON CourseAverages.student = CurriculumPerson.student AND CourseAverages.course = CourseCurriculum.course
+    WHERE (CurriculumPerson.student, CurriculumPerson.curriculum) IN ({scope})
+    GROUP BY CurriculumPerson.student, CurriculumPerson.curriculum
+"""
+
+# Return the SQL recomputing the stored averages (tables CourseAverages and
+# CurriculumAverages, see migrations/0002_stored_averages.sql) of the (student, course) pairs selected by
+# the courseScope query and of the (student, curriculum) pairs selected by
+# the curriculumScope query. Either scope can be None if nothing changed there.
+def refresh_averages_sql(courseScope=None, curriculumScope=None):
+    sql = ""
+    if courseScope:
+        sql += f"""
+        DELETE FROM CourseAverages WHERE (student, course) IN ({courseScope});
+        INSERT INTO CourseAverages (student, course, grade)
+        {COURSE_AVERAGES_SQL.format(scope=courseScope)};
+        """
+    if curriculumScope:
+        sql += f"""
+        DELETE FROM CurriculumAverages WHERE (student, curriculum) IN ({curriculumScope});
+        INSERT INTO CurriculumAverages (student, curriculum, grade)
+        {CURRICULUM_AVERAGES_SQL.format(scope=curriculumScope, courseAverages="CourseAverages")};
+        """
+    return sql
+
+# Scopes selecting all the pairs, to rebuild or check the stored averages.
+ALL_COURSE_PAIRS_SQL = """
+    SELECT CurriculumPerson.student, CourseCurriculum.course
+    FROM CurriculumPerson
+    JOIN CourseCurriculum ON CourseCurriculum.curriculum = CurriculumPerson.curriculum
+"""
+ALL_CURRICULUM_PAIRS_SQL = "SELECT student, curriculum FROM CurriculumPerson"
+
+# Query selecting in a single row, as arrays, the grades of the students
+# selected by the {students} query in the courses selected by the {courses}
+# query (as (course, ects) pairs), for the statistics of analytics.py: the
+# students sorted by name, the courses sorted by name, their validations and
+# the grades, each column an array of the same length as the others of its
+# group. An empty group gives NULL arrays.
+GRADE_DATA_SQL = """
+    SELECT StudentList.*, CourseList.*, ValidationList.*, GradeList.*
+    FROM (
+        SELECT array_agg(id ORDER BY lastname, firstname, id) AS student_ids,
+               array_agg(lastname ORDER BY lastname, firstname, id) AS student_lastnames,
+               array_agg(firstname ORDER BY lastname, firstname, id) AS student_firstnames
+        FROM Persons WHERE id IN ({students})
+    ) AS StudentList, (
+        SELECT array_agg(Courses.id ORDER BY name, Courses.id) AS course_ids,
+               array_agg(name ORDER BY name, Courses.id) AS course_names,
+               array_agg(Scope.ects ORDER BY name, Courses.id) AS course_ects
+        FROM ({courses}) AS Scope (course, ects)
+        JOIN Courses ON Courses.id = Scope.course
+    ) AS CourseList, (
+        SELECT array_agg(id ORDER BY date, id) AS validation_ids,
+               array_agg(name ORDER BY date, id) AS validation_names,
+               array_agg(course ORDER BY date, id) AS validation_courses,
+               array_agg(coefficient ORDER BY date, id) AS validation_coefficients
+        FROM Validations WHERE course IN (SELECT course FROM ({courses}) AS Scope (course, ects))
+    ) AS ValidationList, (
+        SELECT array_agg(student) AS grade_students,
+               array_agg(validation) AS grade_validations,
+               array_agg(grade) AS grade_values
+        FROM Grades
+        JOIN Validations ON Validations.id = Grades.validation
+        WHERE Grades.student IN ({students})
+          AND Validations.course IN (SELECT course FROM ({courses}) AS Scope (course, ects))
+    ) AS GradeList
+"""
+
+# Queries of the tables of the person, curriculum, course and validation
+# pages, run alone by the list methods of Model and selected together by its
+# page methods (see Model.fetchTogether()). The paginated ones are given with
+# the columns sorting them, see paginate_sql().
+COURSES_OF_CURRICULUM_SQL = """
+    SELECT Courses.id, Courses.name, Persons.lastname AS teacher_lastname, Persons.firstname AS teacher_firstname,
+           CourseCurriculum.ects
+    FROM Courses
+    JOIN Curriculums ON Curriculums.id = %s
+    JOIN Persons ON Persons.id = Courses.teacher
+    JOIN CourseCurriculum ON (CourseCurriculum.course = Courses.id AND CourseCurriculum.curriculum = Curriculums.id)
+"""
+AVERAGES_OF_CURRICULUM_SQL = """
+    SELECT lastname, firstname, ROUND(CurriculumAverages.grade::numeric, %s) AS average
+    FROM CurriculumAverages
+    JOIN Persons ON Persons.id = CurriculumAverages.student
+    WHERE CurriculumAverages.curriculum = %s
+    ORDER BY lastname, firstname
+"""
+CURRICULUMS_OF_COURSE_SQL = """
+    SELECT Curriculums.id, Curriculums.name, CourseCurriculum.ects
+    FROM CourseCurriculum
+    JOIN Curriculums ON Curriculums.id = CourseCurriculum.curriculum
+    WHERE CourseCurriculum.course = %s
+"""
+VALIDATIONS_OF_COURSE_SQL = """
+    SELECT id, date, name, coefficient
+    FROM Validations
+    WHERE Validations.course = %s
+"""
+STUDENTS_OF_COURSE_SQL = """
+    SELECT Persons.id, Persons.lastname, Persons.firstname
+    FROM Persons
+    JOIN CurriculumPerson on CurriculumPerson.student = Persons.id
+    JOIN CourseCurriculum ON CourseCurriculum.curriculum = CurriculumPerson.curriculum
+    WHERE CourseCurriculum.course = %s
+"""
+GRADES_OF_COURSE_SQL = """
+    SELECT Validations.id, Validations.date, Curriculums.name AS curriculum_name, Persons.lastname, Persons.firstname,
+           Validations.name AS validation_name, ROUND(Grades.grade::numeric, %s) AS grade, Validations.coefficient,
+           Grades.student AS student_id, Curriculums.id AS curriculum_id
+    FROM Validations
+    JOIN Courses ON Validations.course = Courses.id
+    JOIN Grades ON Grades.validation = Validations.id
+    JOIN Persons ON Persons.id = Grades.student
+    JOIN CurriculumPerson ON CurriculumPerson.student = Grades.student
+    JOIN CourseCurriculum ON CourseCurriculum.course = Courses.id
+    JOIN Curriculums ON Curriculums.id = CurriculumPerson.curriculum AND Curriculums.id = CourseCurriculum.curriculum
+    WHERE Validations.course = %s
+"""
+GRADES_OF_COURSE_KEYS = ["date", "id", "student_id", "curriculum_id"]
+GRADES_OF_VALIDATION_SQL = """
+    SELECT ROUND(Grades.grade::numeric, %s) AS grade, Persons.lastname, Persons.firstname,
+           Grades.grade AS exact_grade, Grades.student AS student_id
+    FROM Grades
+    JOIN Persons ON Grades.student = Persons.id
+    WHERE Grades.validation = %s
+"""
+GRADES_OF_VALIDATION_KEYS = ["exact_grade", "student_id"]
+CURRICULUMS_OF_STUDENT_SQL = """
+    SELECT Curriculums.name, ROUND(CurriculumAverages.grade::numeric, %s) AS average
+    FROM CurriculumAverages
+    JOIN Curriculums ON Curriculums.id = CurriculumAverages.curriculum
+    WHERE CurriculumAverages.student = %s
+    ORDER BY Curriculums.name
+"""
+VALIDATIONS_OF_STUDENT_SQL = """
+    SELECT Validations.id, Validations.date, Curriculums.name AS curriculum_name, Courses.name AS course_name,
+           Validations.name AS validation_name, ROUND(Grades.grade::numeric, %s) AS grade,
+           Curriculums.id AS curriculum_id
+    FROM Persons
+    JOIN Grades ON Grades.student = Persons.id
+    JOIN Validations ON Validations.id = Grades.validation
+    JOIN CourseCurriculum ON CourseCurriculum.course = Validations.course
+    JOIN Curriculums ON CourseCurriculum.curriculum = Curriculums.id
+    JOIN Courses ON Courses.id = Validations.course
+    WHERE Persons.id = %s
+"""
+VALIDATIONS_OF_STUDENT_KEYS = ["date", "id", "curriculum_id"]
+
+logger = logging.getLogger(__name__)
+
+# Default latency budget and timeout of the statement of a page, in seconds
+# (see query()). They can be overridden with the PAGE_BUDGET and PAGE_TIMEOUT
+# environment variables.
+PAGE_BUDGET = 0.5
+PAGE_TIMEOUT = 10
+
+# Number of threads reading the heavy tables of the pages at the same time as
+# their statement, each on a connection of its own (see Model.readApart()).
+# It can be overridden with the PAGE_WORKERS environment variable.
+PAGE_WORKERS = 4
+
+# Return the latency budget and the timeout of the pages, see PAGE_BUDGET.
+def page_limits():
+    return float(os.getenv('PAGE_BUDGET', PAGE_BUDGET)), float(os.getenv('PAGE_TIMEOUT', PAGE_TIMEOUT))
+
+# Log a warning if the page read by the given method took longer than its budget.
+def check_page_budget(name, elapsed, budget):
+    if elapsed > budget:
+        logger.warning("the page read by %s took %.0f ms, over its budget of %.0f ms",
+                       name, 1000 * elapsed, 1000 * budget)
+
+# Raised by the methods reading a page (see query()) when it exceeds its timeout.
+class PageTimeout(Exception):
+    pass
+
+# A thread cancelling the pages which run for longer than their timeout (see
+# Model.runPage()), shared by all the Models of the process.
+class Watchdog:
     def __init__(self):
-        self.connection = psycopg2.connect(get_db_url())
+        self.condition = threading.Condition()
+        self.deadlines = {}
+        self.thread = None
+
+    # Call cancel() in timeout seconds, unless unwatch() is called before with
+    # the token returned.
+    def watch(self, timeout, cancel):
+        token = object()
+        with self.condition:
+            self.deadlines[token] = (time.monotonic() + timeout, cancel)
+            # (started on first use, and again in a forked process)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="page-watchdog", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return token
+
+    # Stop watching the given token, and return whether cancel() was called:
+    # it is not called after this returns.
+    def unwatch(self, token):
+        with self.condition:
+            return self.deadlines.pop(token, None) is None
+
+    def run(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                for token, (deadline, cancel) in list(self.deadlines.items()):
+                    if deadline <= now:
+                        del self.deadlines[token]
+                        try:
+                            cancel()
+                        except Exception:
+                            logger.exception("failed to cancel a page")
+                wake = min((deadline for (deadline, _) in self.deadlines.values()), default=None)
+                self.condition.wait(None if wake is None else wake - now)
+
+_watchdog = Watchdog()
+_executor = None
+
+# Return the executor of Model.readApart(), creating it on first use.
+def get_executor():
+    global _executor
+    with _pools_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(int(os.getenv('PAGE_WORKERS', PAGE_WORKERS)),
+                                                              thread_name_prefix="page-table")
+        return _executor
+
+# Number of rows per page of the paginated lists shown by run.py.
+PAGE_SIZE = 100
+
+# Default number of results of searchPersons() and searchCourses(), and
+# number of words of the searched text taken into account.
+SEARCH_LIMIT = 20
+SEARCH_WORDS = 4
+
+# Arbitrary key serializing the workers taking a job, so that no more than
+# the maximum number of jobs run at once (see Model.claimJob()).
+JOBS_CLAIM_LOCK = 2011
+
+# Return the LIKE pattern matching the strings starting with the given text.
+def like_prefix(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+# Maximum number of rows inserted by a single statement by the batched writes.
+WRITE_BATCH_SIZE = 1000
+
+# Number of rows fetched at once from the server-side cursors of the exports.
+EXPORT_BATCH_SIZE = 2000
+
+# Raised when a pagination cursor was not made by encode_cursor().
+class InvalidCursor(ValueError):
+    pass
+
+# Pagination cursors are opaque strings holding the values of the sort keys
+# of a row, from which the next or previous page starts.
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise InvalidCursor(cursor)
+    # (a tampered cursor could hold objects or arrays, which psycopg2 would
+    # fail to compare to the keys)
+    if not isinstance(values, list) or not all(
+            value is None or isinstance(value, (str, int, float)) for value in values):
+        raise InvalidCursor(cursor)
+    return values
+
+# One page of rows of a paginated list. nextCursor (resp. prevCursor) is the
+# cursor to give as after (resp. before) to get the next (resp. previous)
+# page, or None if this is the last (resp. first) one. total is the number of
+# rows of the whole list if it was asked for, None otherwise.
+class Page(list):
+    def __init__(self, rows, limit=None, nextCursor=None, prevCursor=None, total=None):
+        super().__init__(rows)
+        self.limit = limit
+        self.nextCursor = nextCursor
+        self.prevCursor = prevCursor
+        self.total = total
+
+# Return the SQL and parameters selecting a page of at most limit rows (plus
+# one, to know if there is a next page) of the rows of the given query, sorted
+# by its columns named in keys (which must identify a row). The page starts
+# after (or ends before) the row of the given cursor. Without limit, all the
+# rows are selected in order. The limit is a parameter, so that the pages of
+# any size run the same prepared statement (see statements.py).
+def paginate_sql(sql, params, keys, descending=False, limit=None, after=None, before=None):
+    forward = before is None
+    cursor = after if forward else before
+    if cursor is not None:
+        values = decode_cursor(cursor)
+        if len(values) != len(keys):
+            raise InvalidCursor(cursor)
+        sign = ">" if forward != descending else "<"
+        sql = f"SELECT * FROM ({sql}) AS Rows WHERE ({', '.join(keys)}) {sign} ({', '.join(['%s'] * len(keys))})"
+        params = tuple(params) + tuple(values)
+    else:
+        sql = f"SELECT * FROM ({sql}) AS Rows"
+    order = "DESC" if forward == descending else "ASC"
+    sql += " ORDER BY " + ", ".join(f"{key} {order}" for key in keys)
+    if limit is not None:
+        sql += " LIMIT %s"
+        params = tuple(params) + (int(limit) + 1,)
+    return sql, params
+
+# Build the Page of the rows fetched with the query given by paginate_sql().
+def build_page(rows, keys, limit=None, after=None, before=None, total=None):
+    if limit is None:
+        return Page(rows, total=total)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if before is None:
+        hasNext, hasPrev = more, after is not None
+    else:
+        # The rows were fetched backwards from the cursor.
+        rows.reverse()
+        hasNext, hasPrev = True, more
+    nextCursor = prevCursor = None
+    if rows and hasNext:
+        nextCursor = encode_cursor([getattr(rows[-1], key) for key in keys])
+    if rows and hasPrev:
+        prevCursor = encode_cursor([getattr(rows[0], key) for key in keys])
+    return Page(rows, limit, nextCursor, prevCursor, total)
+
+# Return the class of the rows of the queries whose columns have the given
+# names: a named tuple, whose values are read by position (as the templates
+# and forms.py do) or as attributes named as the columns, e.g. row.lastname.
+# A row takes no more memory than a tuple. The names which are not valid
+# identifiers, or repeated, are replaced by _<position>.
+@functools.lru_cache(maxsize=1024)
+def record_type(names):
+    return collections.namedtuple("Record", names, rename=True)
+
+# SQL selecting the rows of the given query as the text of a JSON array of
+# objects, in the order of the query. This relies on json_agg() aggregating
+# the rows in the order given by the ORDER BY of the subquery: SQL does not
+# guarantee it, but PostgreSQL keeps it when, as here, the outer query neither
+# joins nor groups the rows (see "Aggregate Expressions" in its manual). The
+# statements of the methods cannot be ordered again here, since their sort
+# keys are only known by their SQL.
+JSON_ROWS_SQL = "(SELECT COALESCE(json_agg(Rows), '[]')::text FROM ({sql}) AS Rows)"
+
+# Types (oids) of the columns of the queries run by fetchTogether(), by SQL.
+_column_types = cache.ReadCache(STATEMENT_MEMO_SIZE, STATEMENT_MEMO_TTL)
+
+# Return the list of records of a JSON array given by JSON_ROWS_SQL, whose
+# columns have the given types (oids). The values are read by the typecasters
+# of psycopg2, as if the query had been run by a cursor: JSON does not tell a
+# float from a numeric nor a date from a string.
+def load_json_rows(text, types):
+    casters = [psycopg2.extensions.string_types.get(oid) for oid in types]
+
+    def cast(caster, value):
+        if value is None or caster is None:
+            return value
+        if isinstance(value, bool):
+            value = 't' if value else 'f'
+        return caster(value, None)
+
+    def row(pairs):
+        return record_type(tuple(name for (name, _) in pairs))._make(
+            [cast(caster, value) for caster, (_, value) in zip(casters, pairs)])
+    return json.loads(text, parse_int=str, parse_float=str, parse_constant=str, object_pairs_hook=row)
+
+# Raised by ReplayCursor on a statement whose rows are not known yet.
+class PendingQuery(Exception):
+    def __init__(self, sql, params):
+        super().__init__(sql)
+        self.sql = sql
+        self.params = params
+
+# Raised by ReplayModel on the tables of a page read apart (see
+# Model.readApart()) whose results are not known yet: reads are the futures
+# of their results.
+class PendingReads(Exception):
+    def __init__(self, reads):
+        super().__init__(f"{len(reads)} tables")
+        self.reads = reads
+
+# A stand-in for the cursor of Model, answering the successive statements of
+# a read method with the given lists of rows, see ReplayModel.
+class ReplayCursor:
+    def __init__(self, results):
+        self.results = results
+        self.position = 0
+        self.rows = None
+        self.description = None
+
+    def execute(self, query, vars=None):
+        if self.position == len(self.results):
+            raise PendingQuery(query, vars)
+        self.rows = self.results[self.position]
+        self.description = getattr(self.rows, 'description', None)
+        self.position += 1
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+# A table of a page read by Model.fetchTogether(): the rows of the query sql,
+# returned by the read method name of Model when called with args and kwargs.
+# If keys are given, the rows are paginated by the kwargs, as by
+# Model.fetchPage(). statements are the queries of the table, and result()
+# returns the table given their rows. A heavy table is read apart, by its
+# read method, at the same time as the statement of the page (see
+# Model.readApart()).
+class PageTable:
+    def __init__(self, name, args, sql, params, keys=None, descending=False, apart=False, **kwargs):
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.keys = keys
+        self.apart = apart
+        self.statements = []
+        if keys is None:
+            self.statements.append((sql, tuple(params)))
+            return
+        if kwargs.get('withTotal'):
+            self.statements.append((f"SELECT count(*) FROM ({sql}) AS Rows", tuple(params)))
+        pageSql, pageParams = paginate_sql(sql, params, keys, descending, kwargs.get('limit'),
+                                           kwargs.get('after'), kwargs.get('before'))
+        self.statements.append((pageSql, tuple(pageParams)))
+
+    # The key of the table, as the one of the result of its read method in
+    # the cache of a Model (see query()).
+    def key(self):
+        return (self.name, self.args, tuple(sorted(self.kwargs.items())))
+
+    # Return the table, read by its method on the given Model.
+    def read(self, model):
+        return getattr(model, self.name)(*self.args, **self.kwargs)
+
+    def result(self, results):
+        if self.keys is None:
+            return results[0]
+        total = results[0][0][0] if self.kwargs.get('withTotal') else None
+        return build_page(results[-1], self.keys, self.kwargs.get('limit'),
+                          self.kwargs.get('after'), self.kwargs.get('before'), total)
+
+class Model:
+    # Wait at most timeout seconds for a connection of the pool.
+    def __init__(self, timeout=DB_POOL_TIMEOUT):
+        # Results of the read queries of this Model, see query().
+        self.cache = {}
+        # Number of read queries answered from the cache instead of the database.
+        self.savedRoundTrips = 0
+        # Whether a transaction is open, and the tables written by it so far.
+        self.inTransaction = False
+        self.writtenTables = set()
+        # Whether this Model wrote to the primary, see runRead().
+        self.wrote = False
+        self.pool = get_pool()
+        self.connection = self.pool.getconn(timeout)
         self.connection.autocommit = True
-        self.cursor = self.connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        self.cursor = self.primaryCursor = self.connection.cursor(cursor_factory=Cursor)
+        # The replica read by this Model, taken by the first read routed to
+        # it, with a connection and a cursor (see readCursor()).
+        self.replica = None
+        self.replicaConnection = None
+        self.replicaCursor = None
+        # The Models reading the tables of the page read by this one (see
+        # readApart()), cancelled along with it.
+        self.helpers = []
+        self.helpersLock = threading.Lock()
+        self.cancelled = False
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
         if (self.connection):
-            self.connection.close()
+            self.cursor.close()
+            self.pool.putconn(self.connection)
+            self.connection = None
+        self.releaseReplica()
+
+    # Cancel the statements running on the connections of this Model and of
+    # its helpers (from another thread).
+    def cancel(self):
+        with self.helpersLock:
+            self.cancelled = True
+            models = [self] + self.helpers
+        for model in models:
+            for connection in (model.connection, model.replicaConnection):
+                if connection is not None:
+                    connection.cancel()
+
+    # Return read(), the read of a page by the method of the given name (see
+    # query()), cancelling its statements after PAGE_TIMEOUT seconds (from the
+    # watchdog thread of the process, so that the page is still sent in a
+    # single round trip).
+    def runPage(self, name, read):
+        budget, timeout = page_limits()
+        self.cancelled = False
+        start = time.monotonic()
+        token = _watchdog.watch(timeout, self.cancel)
+        try:
+            return read()
+        except psycopg2.errors.QueryCanceled:
+            if _watchdog.unwatch(token):
+                raise PageTimeout(f"the page read by {name} took more than {timeout} s") from None
+            raise
+        finally:
+            # (the watchdog must not cancel the next statements of the connection)
+            _watchdog.unwatch(token)
+            check_page_budget(name, time.monotonic() - start, budget)
+
+    # Run a read method of Model (see query()) on a replica if one can be
+    # used, or else on the primary. The reads stay on the primary after a
+    # write of this Model, so that a request sees its own writes, inside a
+    # transaction, and for the results kept in the process-wide cache
+    # (shared), which is invalidated by the writes of this process as soon as
+    # they are committed, before the replicas replay them. The reads nested
+    # in another one, or on another cursor than the one of the Model (see
+    # ReplayModel and migrate.verify()), run on that cursor. If the replica
+    # fails, the method is run again on the primary. The reason given by
+    # query() ("shared" or "primary"), if any, keeps the method on the primary.
+    def runRead(self, method, args, kwargs, reason):
+        if self.cursor is not self.primaryCursor:
+            return measured(method, self, args, kwargs)
+        reason = "written" if self.wrote else "transaction" if self.inTransaction else reason
+        cursor = None if reason else self.readCursor()
+        if cursor is None:
+            metrics.READ_ROUTES.inc(method.__name__, "primary", reason or "no replica")
+            return measured(method, self, args, kwargs)
+        replica = self.replica
+        self.cursor = cursor
+        try:
+            result = measured(method, self, args, kwargs)
+        except psycopg2.Error as error:
+            # (a lost connection may be reported as a DatabaseError, without
+            # the SQLSTATE of an error of the server)
+            lost = error.pgcode is None or isinstance(error, psycopg2.OperationalError)
+            if not lost or isinstance(error, psycopg2.errors.QueryCanceled):
+                raise
+            self.cursor = self.primaryCursor
+            get_replica_set().failed(replica, error)
+            self.releaseReplica()
+            metrics.READ_ROUTES.inc(method.__name__, "primary", "failover")
+            return measured(method, self, args, kwargs)
+        finally:
+            self.cursor = self.primaryCursor
+        metrics.READ_ROUTES.inc(method.__name__, replica.name, "replica")
+        metrics.count_read((), replica=True)
+        return result
+
+    # Return the cursor of the replica read by this Model, taking on first use
+    # a connection to the next replica which can be used (see replicas.py), or
+    # None if there is none.
+    def readCursor(self):
+        if self.replica is not None:
+            return self.replicaCursor
+        replicaSet = get_replica_set()
+        for replica in replicaSet.candidates():
+            try:
+                pool = get_pool(replica.url)
+                connection = pool.getconn(replicas.REPLICA_CONNECT_TIMEOUT)
+            except psycopg2.pool.PoolError:
+                continue # all its connections are in use
+            except psycopg2.Error as error:
+                replicaSet.failed(replica, error)
+                continue
+            connection.autocommit = True
+            if replicaSet.needsCheck(replica):
+                try:
+                    with connection.cursor() as cursor:
+                        cursor.execute(replicas.LAG_SQL)
+                        lag = cursor.fetchone()[0]
+                except psycopg2.Error as error:
+                    pool.putconn(connection)
+                    replicaSet.failed(replica, error)
+                    continue
+                if not replicaSet.checked(replica, lag):
+                    pool.putconn(connection)
+                    continue
+            self.replica = replica
+            self.replicaConnection = connection
+            self.replicaCursor = connection.cursor(cursor_factory=Cursor)
+            return self.replicaCursor
+        return None
+
+    # Give back the connection to the replica read by this Model, if any.
+    def releaseReplica(self):
+        if self.replica is not None:
+            if not self.replicaConnection.closed:
+                self.replicaCursor.close()
+            get_pool(self.replica.url).putconn(self.replicaConnection)
+            self.replica = self.replicaConnection = self.replicaCursor = None
+
+    # Context manager running the queries inside it in a single transaction,
+    # committed at the end or rolled back if an exception is raised. Without
+    # it, each write query is committed on its own. Transactions can be nested,
+    # the inner ones being part of the outermost one:
+    #
+    #   with model.transaction():
+    #       model.createCourse(...)
+    #       model.registerCourseToCurriculum(...)
+    @contextlib.contextmanager
+    def transaction(self):
+        if self.inTransaction:
+            yield self
+            return
+        self.inTransaction = True
+        self.connection.autocommit = False
+        try:
+            yield self
+            # (delivered by the commit, and not if the transaction fails)
+            self.notifyWritten(self.writtenTables)
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+        finally:
+            self.connection.autocommit = True
+            self.inTransaction = False
+            if self.writtenTables:
+                get_read_cache().invalidate(self.writtenTables)
+                self.writtenTables = set()
+
+    # Notify the other processes that the given tables were written, if a
+    # shared query reads one of them (see READ_CACHE_NOTIFY).
+    def notifyWritten(self, tables):
+        shared = SHARED_TABLES.intersection(tables)
+        if shared and int(os.getenv('READ_CACHE_NOTIFY', READ_CACHE_NOTIFY)):
+            self.primaryCursor.execute("SELECT pg_notify(%s, %s)", (CACHE_CHANNEL, ",".join(sorted(shared))))
+
+    # Yield the rows of the given query by lists of at most EXPORT_BATCH_SIZE
+    # rows, read from a server-side cursor so that the memory used does not
+    # depend on the number of rows. Closing the generator (e.g. when the
+    # client of an export disconnects) closes the cursor and its transaction,
+    # which is read-only (unless the stream is part of a transaction of this
+    # Model). The rows are read from a replica when a read query would be
+    # (see runRead()).
+    def stream(self, sql, params):
+        if self.wrote or self.inTransaction or self.readCursor() is None:
+            metrics.READ_ROUTES.inc("stream", "primary", "written" if self.wrote else
+                                    "transaction" if self.inTransaction else "no replica")
+            if self.inTransaction:
+                yield from stream_rows(self.connection, sql, params)
+                return
+            # (BEGIN READ ONLY, in the same round trip as the cursor)
+            self.connection.readonly = True
+            try:
+                with self.transaction():
+                    yield from stream_rows(self.connection, sql, params)
+            finally:
+                if not self.connection.closed:
+                    self.connection.readonly = None
+            return
+        metrics.READ_ROUTES.inc("stream", self.replica.name, "replica")
+        connection = self.replicaConnection
+        connection.readonly = True
+        connection.autocommit = False
+        try:
+            yield from stream_rows(connection, sql, params)
+        finally:
+            if not connection.closed:
+                connection.rollback()
+                connection.autocommit = True
+                connection.readonly = None
+
+    # Return the Page of the rows of the given query, see paginate_sql().
+    # If withTotal is set, the total number of rows is counted too.
+    def fetchPage(self, sql, params, keys, descending=False, limit=None, after=None, before=None, withTotal=False):
+        table = PageTable(None, (), sql, params, keys, descending,
+                          limit=limit, after=after, before=before, withTotal=withTotal)
+        results = []
+        for (query, queryParams) in table.statements:
+            self.cursor.execute(query, queryParams)
+            results.append(self.cursor.fetchall())
+        return table.result(results)
+
+    # Return the number of statements prepared on the connection of this Model,
+    # and the number of times the server planned them for their parameters
+    # (custom plans) or reused a plan of the statement (generic plans).
+    def planCacheStats(self):
+        self.cursor.execute("""
+        SELECT count(*) AS prepared,
+               COALESCE(sum(generic_plans), 0)::bigint AS generic_plans,
+               COALESCE(sum(custom_plans), 0)::bigint AS custom_plans
+        FROM pg_prepared_statements
+        """)
+        return self.cursor.fetchone()._asdict()
+
+    # Read the given tables of a page (see PageTable) together with its header
+    # query sql, in a single statement, and return the first row of the header
+    # query and the list of the tables, or None if the header query has no
+    # row. The queries of the tables are selected as JSON arrays next to the
+    # columns of the header, and the tables memoized as if their read methods
+    # had been called. The types of the columns of each query are asked for
+    # the first time it is run by the process (see load_json_rows()): a page
+    # is read in one round trip once the process knows them, and in one more
+    # per query not seen yet before.
+    #
+    # The heavy tables (see PageTable) are read apart, at the same time as
+    # this statement (see readApart()): the latency of the page is the one of
+    # the slowest of them, or of the statement of the others, instead of their
+    # sum.
+    def fetchTogether(self, sql, params, tables):
+        apart = [table for table in tables if table.apart]
+        collect = self.readApart(apart)
+        parts = [statement for table in tables if not table.apart for statement in table.statements]
+        # (the types learnt are kept at the end only, so that a replay of this
+        # method runs the same statements, see ReplayModel)
+        types = {}
+        for (query, queryParams) in parts:
+            known = self.columnTypes(query)
+            if known is not None:
+                types[query] = known
+            elif query not in types:
+                self.cursor.execute(f"SELECT * FROM ({query}) AS Rows LIMIT 0", queryParams)
+                types[query] = [column.type_code for column in self.cursor.description]
+        self.cursor.execute(f"""
+        SELECT Header.*, {", ".join(JSON_ROWS_SQL.format(sql=query) for (query, _) in parts)}
+        FROM ({sql}) AS Header
+        """, tuple(p for (_, queryParams) in parts for p in queryParams) + tuple(params))
+        row = self.cursor.fetchone()
+        apartResults = dict(zip(map(id, apart), collect()))
+        for query, columnTypes in types.items():
+            _column_types.put(query, columnTypes, (), _column_types.version(()))
+        if row is None:
+            return None
+        position = len(row) - len(parts)
+        header = row[:position]
+        results = []
+        for table in tables:
+            if table.apart:
+                results.append(apartResults[id(table)])
+                continue
+            rows = [load_json_rows(text, types[query])
+                    for text, (query, _) in zip(row[position:position + len(table.statements)], table.statements)]
+            position += len(table.statements)
+            result = table.result(rows)
+            self.cache[table.key()] = result
+            results.append(result)
+        return header, results
+
+    # Return the types of the columns of the given query of fetchTogether() if
+    # they are known, None otherwise.
+    def columnTypes(self, query):
+        found, types = _column_types.get(query)
+        return types if found else None
+
+    # Start reading the given tables of a page (see PageTable), each by its
+    # read method on a Model of its own, in a thread of get_executor(), and
+    # return the function returning their results once read, memoized by
+    # this Model as if it had read them. The tables which cannot get a free
+    # connection at once are read by that function on this Model, as are all
+    # of them inside a transaction (which must see its own writes) and in a
+    # read nested in another one (see runRead()).
+    def readApart(self, tables):
+        if not tables or self.inTransaction or (self.cursor is not self.primaryCursor
+                                                and self.cursor is not self.replicaCursor):
+            return lambda: [table.read(self) for table in tables]
+
+        def run(table):
+            try:
+                model = Model(timeout=0)
+            except psycopg2.pool.PoolError:
+                return None
+            model.wrote = self.wrote
+            with model:
+                with self.helpersLock:
+                    if self.cancelled:
+                        raise psycopg2.errors.QueryCanceled("the page was cancelled")
+                    self.helpers.append(model)
+                try:
+                    return table.read(model), model
+                finally:
+                    with self.helpersLock:
+                        self.helpers.remove(model)
+
+        # (each in a copy of the context, so that the statements are counted in
+        # the metrics of the request, see metrics.start_request())
+        futures = [get_executor().submit(contextvars.copy_context().run, run, table) for table in tables]
+
+        def collect():
+            results = []
+            for table, future in zip(tables, futures):
+                outcome = future.result()
+                if outcome is None:
+                    results.append(table.read(self))
+                    continue
+                result, model = outcome
+                self.cache.update(model.cache)
+                self.savedRoundTrips += model.savedRoundTrips
+                results.append(result)
+            return results
+        return collect
 
 ##############################################
 ######      Queries for tab  PERSONS    ######
 ##############################################
 
     # Create a new person.
+    @write("Persons")
     def createPerson(self, lastname, firstname, address, phone):
         self.cursor.execute("""
         INSERT INTO Persons (lastname, firstname, address, phone) VALUES (%s, %s, %s, %s)
         """, (lastname, firstname, address, phone))
-        self.connection.commit()
+
+    # Create several persons given a list of (lastname, firstname,
+    # address, phone), in one transaction. Return the list of their IDs.
+    @write("Persons")
+    def createPersons(self, persons):
+        with self.transaction():
+            return [row[0] for row in execute_values(self.cursor, """
+            INSERT INTO Persons (lastname, firstname, address, phone) VALUES %s
+            RETURNING id
+            """, persons, page_size=WRITE_BATCH_SIZE, fetch=True)]
 
     # Return a list of (id, lastname, firstname, address, phone,
-    # number of curriculums) corresponding to all persons.
-    def listPersons(self):
-        self.cursor.execute("""
-        SELECT Persons.id, lastname, firstname, address, phone, count(CurriculumPerson.student) 
+    # curriculums: number of curriculums) corresponding to all persons,
+    # sorted by id.
+    # The list is paginated by limit, after and before, see fetchPage().
+    @query("Persons", "CurriculumPerson", shared=True)
+    def listPersons(self, limit=None, after=None, before=None, withTotal=False):
+        return self.fetchPage("""
+        SELECT Persons.id, lastname, firstname, address, phone, count(CurriculumPerson.student) AS curriculums
         FROM Persons
         LEFT JOIN CurriculumPerson ON CurriculumPerson.student = Persons.id
         GROUP BY Persons.id, CurriculumPerson.student
-        """)
+        """, (), ["id"], False, limit, after, before, withTotal)
+
+    # Return a list of (id, name: "lastname firstname") of all the persons,
+    # sorted by name, for the choices of the forms (see forms.py). The list
+    # is paginated by limit, after and before, see fetchPage(): a page has a
+    # nextCursor if there are more than limit persons.
+    @query("Persons", shared=True)
+    def listPersonChoices(self, limit=None, after=None, before=None):
+        return self.fetchPage("""
+        SELECT id, lastname || ' ' || firstname AS name
+        FROM Persons
+        """, (), ["name", "id"], False, limit, after, before)
+
+    # Return a list of (id, name: "lastname firstname") of the persons of the
+    # given IDs which exist, sorted by name.
+    @query("Persons")
+    def listPersonChoicesOf(self, *idPersons):
+        if not idPersons:
+            return []
+        self.cursor.execute("""
+        SELECT id, lastname || ' ' || firstname AS name
+        FROM Persons
+        WHERE id = ANY(%s::int[])
+        ORDER BY name, id
+        """, (list(idPersons),))
+        return self.cursor.fetchall()
+
+    # Return a list of (id, name: "lastname firstname", phone) of at most
+    # limit persons found by the given text, whatever its case, best first:
+    #   0. the name starts with the text ("lastname firstname"),
+    #   1. or "firstname lastname" does,
+    #   2. or the phone does (its spaces ignored),
+    #   3. or each word of the text starts the last name, the first name or
+    #      the phone ("Mar Je" finds "Martin Jean").
+    # Each rank is read from an index in its order up to limit (see the
+    # 0006_search_indexes migration), the last one in no particular order,
+    # then the persons are sorted by rank and name.
+    @query("Persons")
+    def searchPersons(self, text, limit=SEARCH_LIMIT):
+        words = text.split()[:SEARCH_WORDS]
+        if not words:
+            return []
+        params = {'name': like_prefix(" ".join(words)), 'phone': like_prefix("".join(words)), 'limit': limit}
+        byWords = ""
+        if len(words) > 1:
+            conditions = []
+            for i, word in enumerate(words):
+                params[f'word{i}'] = like_prefix(word)
+                conditions.append(f"""(lower(lastname || ' ' || firstname) LIKE lower(%(word{i})s)
+                    OR lower(firstname || ' ' || lastname) LIKE lower(%(word{i})s) OR phone LIKE %(word{i})s)""")
+            byWords = f"""
+            UNION ALL
+            (SELECT id, lastname || ' ' || firstname, phone, 3 FROM Persons
+             WHERE {" AND ".join(conditions)}
+             LIMIT %(limit)s)"""
+        self.cursor.execute(f"""
+        SELECT id, name, phone
+        FROM (
+            (SELECT id, lastname || ' ' || firstname AS name, phone, 0 AS rank FROM Persons
+             WHERE lower(lastname || ' ' || firstname) LIKE lower(%(name)s)
+             ORDER BY lower(lastname || ' ' || firstname) USING ~<~ LIMIT %(limit)s)
+            UNION ALL
+            (SELECT id, lastname || ' ' || firstname, phone, 1 FROM Persons
+             WHERE lower(firstname || ' ' || lastname) LIKE lower(%(name)s)
+             ORDER BY lower(firstname || ' ' || lastname) USING ~<~ LIMIT %(limit)s)
+            UNION ALL
+            (SELECT id, lastname || ' ' || firstname, phone, 2 FROM Persons
+             WHERE phone LIKE %(phone)s
+             ORDER BY phone USING ~<~ LIMIT %(limit)s){byWords}
+        ) AS Found
+        GROUP BY id, name, phone
+        ORDER BY min(rank), name, id
+        LIMIT %(limit)s
+        """, params)
         return self.cursor.fetchall()
 
     # Delete a person given its ID (beware of the foreign constraints!).
+    # The curriculums he manages and the courses he teaches are deleted too,
+    # so the averages of the students of these are recomputed.
+    @write("Persons", "CourseAverages", "CurriculumAverages", cascade=True)
     def deletePerson(self, idPerson):
-        self.cursor.execute("""
-        DELETE FROM Persons
-        WHERE id=%s
-        """, (idPerson,))
-        self.connection.commit()
+        with self.transaction():
+            self.cursor.execute("""
+            SELECT CurriculumPerson.student, CourseCurriculum.course
+            FROM Curriculums
+            JOIN CurriculumPerson ON CurriculumPerson.curriculum = Curriculums.id
+            JOIN CourseCurriculum ON CourseCurriculum.curriculum = Curriculums.id
+            WHERE Curriculums.secretary = %s OR Curriculums.director = %s
+            """, (idPerson, idPerson))
+            pairs = self.cursor.fetchall()
+            self.cursor.execute("""
+            SELECT DISTINCT CourseCurriculum.curriculum
+            FROM Courses
+            JOIN CourseCurriculum ON CourseCurriculum.course = Courses.id
+            WHERE Courses.teacher = %s
+            """, (idPerson,))
+            curriculums = [c[0] for c in self.cursor.fetchall()]
+            self.cursor.execute("""
+            DELETE FROM Persons
+            WHERE id=%(person)s;
+            """ + refresh_averages_sql(
+                "SELECT * FROM unnest(%(students)s::int[], %(courses)s::int[])",
+                "SELECT student, curriculum FROM CurriculumPerson WHERE curriculum = ANY(%(curriculums)s::int[])"),
+            {'person': idPerson, 'students': [p[0] for p in pairs],
+             'courses': [p[1] for p in pairs], 'curriculums': curriculums})
 
 ##############################################
 ######     Queries for  CURRICULUMS     ######
 ##############################################
 
     # Create a curriculum.
+    @write("Curriculums")
     def createCurriculum(self, name, secretary, director):
         self.cursor.execute("""
         INSERT INTO Curriculums (name, secretary, director) VALUES (%s,%s,%s)
         """, (name, secretary, director))
-        self.connection.commit()
 
-    # Return a list of (id,name of curriculum,director lastname,
-    # director firstname, secretary lastname, secretary firstname)
+    # Return a list of (id, name of curriculum, director_lastname,
+    # director_firstname, secretary_lastname, secretary_firstname)
     # corresponding to all curriculums.
+    @query("Curriculums", "Persons", shared=True)
     def listCurriculums(self):
         self.cursor.execute("""
-        SELECT C.id, C.name, Dir.lastname, Dir.firstname, Sec.lastname, Sec.firstname FROM Curriculums as C
+        SELECT C.id, C.name, Dir.lastname AS director_lastname, Dir.firstname AS director_firstname,
+               Sec.lastname AS secretary_lastname, Sec.firstname AS secretary_firstname
+        FROM Curriculums as C
         JOIN Persons AS Sec ON Sec.id = C.secretary
         JOIN Persons AS Dir ON Dir.id = C.director
         """)
         return self.cursor.fetchall()
 
     # Delete a curriculum given its ID (beware of the foreign constraints!).
+    @write("Curriculums", "CourseAverages", "CurriculumAverages", cascade=True)
     def deleteCurriculum(self, idCurriculum):
-        self.cursor.execute("""
-        DELETE FROM Curriculums
-        WHERE id=%s
-        """, (idCurriculum,))
-        self.connection.commit()
+        with self.transaction():
+            self.cursor.execute("""
+            SELECT CurriculumPerson.student, CourseCurriculum.course
+            FROM CurriculumPerson
+            JOIN CourseCurriculum ON CourseCurriculum.curriculum = CurriculumPerson.curriculum
+            WHERE CurriculumPerson.curriculum = %s
+            """, (idCurriculum,))
+            pairs = self.cursor.fetchall()
+            self.cursor.execute("""
+            DELETE FROM Curriculums
+            WHERE id=%(curriculum)s;
+            """ + refresh_averages_sql("SELECT * FROM unnest(%(students)s::int[], %(courses)s::int[])"),
+            {'curriculum': idCurriculum, 'students': [p[0] for p in pairs], 'courses': [p[1] for p in pairs]})
 
 ##############################################
 ######     Queries for  COURSES         ######
 ##############################################
 
     # Create a course.
+    @write("Courses")
     def createCourse(self, name, idProfessor):
         self.cursor.execute("""
         INSERT INTO Courses (name, teacher) VALUES (%s,%s)
         """, (name, idProfessor))
-        self.connection.commit()
 
-    # Return a list of (course id, course name, teacher id,
-    # teacher last name, teacher first name) corresponding
-    # to all the courses.
-    def listCourses(self):
-        self.cursor.execute("""
-        SELECT C.id, C.name, T.id, T.lastname, T.firstname FROM Courses as C
+    # Return a list of (id, name, teacher: teacher id,
+    # teacher_lastname, teacher_firstname) corresponding
+    # to all the courses, sorted by id. The list is paginated
+    # by limit, after and before, see fetchPage().
+    @query("Courses", "Persons", shared=True)
+    def listCourses(self, limit=None, after=None, before=None, withTotal=False):
+        return self.fetchPage("""
+        SELECT C.id, C.name, T.id AS teacher, T.lastname AS teacher_lastname, T.firstname AS teacher_firstname
+        FROM Courses as C
         JOIN Persons as T ON C.teacher = T.id
-        """)
+        """, (), ["id"], False, limit, after, before, withTotal)
+
+    # Return a list of (id, name, teacher: "lastname firstname") of at most
+    # limit courses of which each word of the given text, whatever its case,
+    # is in the name or in the name of the teacher, best first: the name
+    # starts with the text, or a word of the name does, or the name of the
+    # teacher does (in either order); then by name. The courses, a few hundred,
+    # are all read, and their teachers by their primary key.
+    @query("Courses", "Persons")
+    def searchCourses(self, text, limit=SEARCH_LIMIT):
+        words = text.split()[:SEARCH_WORDS]
+        if not words:
+            return []
+        params = {'name': like_prefix(" ".join(words)), 'limit': limit}
+        conditions = []
+        for i, word in enumerate(words):
+            params[f'word{i}'] = "%" + like_prefix(word)
+            conditions.append(f"""(lower(C.name) LIKE lower(%(word{i})s)
+                OR lower(T.lastname || ' ' || T.firstname) LIKE lower(%(word{i})s))""")
+        self.cursor.execute(f"""
+        SELECT C.id, C.name, T.lastname || ' ' || T.firstname AS teacher
+        FROM Courses AS C
+        JOIN Persons AS T ON T.id = C.teacher
+        WHERE {" AND ".join(conditions)}
+        ORDER BY CASE WHEN lower(C.name) LIKE lower(%(name)s) THEN 0
+                      WHEN lower(C.name) LIKE '%% ' || lower(%(name)s) THEN 1
+                      WHEN lower(T.lastname || ' ' || T.firstname) LIKE lower(%(name)s)
+                        OR lower(T.firstname || ' ' || T.lastname) LIKE lower(%(name)s) THEN 2
+                      ELSE 3 END,
+                 C.name, C.id
+        LIMIT %(limit)s
+        """, params)
         return self.cursor.fetchall()
 
     # Delete a given course (beware that the course might be registered to
     # curriculum, and have grades that should also be deleted).
+    @write("Courses", "CourseAverages", "CurriculumAverages", cascade=True)
     def deleteCourse(self, idCourse):
-        self.cursor.execute("""
-        DELETE FROM Courses
-        WHERE id=%s
-        """, (idCourse,))
-        self.connection.commit()
+        with self.transaction():
+            self.cursor.execute("""
+            SELECT curriculum FROM CourseCurriculum
+            WHERE course = %s
+            """, (idCourse,))
+            curriculums = [c[0] for c in self.cursor.fetchall()]
+            self.cursor.execute("""
+            DELETE FROM Courses
+            WHERE id=%(course)s;
+            """ + refresh_averages_sql(None,
+                "SELECT student, curriculum FROM CurriculumPerson WHERE curriculum = ANY(%(curriculums)s::int[])"),
+            {'course': idCourse, 'curriculums': curriculums})
 
 
 ##############################################
 ###### Queries for tab  CURRICULUM/<ID> ######
 ##############################################
 
-    # Get the name of a given curriculum.
+    # Get the name of a given curriculum. None if it does not exist.
+    @query("Curriculums")
     def getNameOfCurriculum(self, id):
         self.cursor.execute("""
         SELECT name FROM Curriculums
         WHERE id = %s
         """, (id,))
-        # suppose that there is a solution
-        return self.cursor.fetchall()[0][0]
+        row = self.cursor.fetchone()
+        return row[0] if row else None
 
-    # Return the list (course ID, course name, course teacher
-    # last name and first name, ECTS) corresponding to the courses
-    # registered to a given curriculum.
+    # Return the list (id, name, teacher_lastname, teacher_firstname,
+    # ects) corresponding to the courses registered to a given curriculum.
+    @query("Courses", "Curriculums", "Persons", "CourseCurriculum")
     def listCoursesOfCurriculum(self, idCurriculum):
-        self.cursor.execute("""
-        SELECT Courses.id, Courses.name, Persons.lastname, Persons.firstname, CourseCurriculum.ects
-        FROM Courses
-        JOIN Curriculums ON Curriculums.id = %s
-        JOIN Persons ON Persons.id = Courses.teacher
-        JOIN CourseCurriculum ON (CourseCurriculum.course = Courses.id AND CourseCurriculum.curriculum = Curriculums.id)
-        """, (idCurriculum,))
+        self.cursor.execute(COURSES_OF_CURRICULUM_SQL, (idCurriculum,))
         return self.cursor.fetchall()
 
     #  !! HARD !!
-    # Return a list (last name, first name, average grade) of students
+    # Return a list (lastname, firstname, average) of students
     # registered to a given curriculum. The
     # average grade is computed as described in the document, but
     # beware that if a student does not have a grade for a validation
     # or is not registered to a course, he should have 0.
+    # The averages are stored in CurriculumAverages, see refresh_averages_sql().
+    @query("Persons", "CurriculumAverages")
     def averageGradesOfStudentsInCurriculum(self, idCurriculum):
-        self.cursor.execute("""
-        WITH CourseGrades AS (
-            SELECT CurriculumPerson.student as student, Validations.course as course, 
-                            sum(Grades.grade * Validations.coefficient) / sum(Validations.coefficient) AS grades
-            FROM Validations
-            JOIN CourseCurriculum ON CourseCurriculum.course = Validations.course AND CourseCurriculum.curriculum = %s
-            JOIN CurriculumPerson ON CurriculumPerson.curriculum = CourseCurriculum.curriculum
-            LEFT JOIN Grades ON Grades.validation = Validations.id AND Grades.student = CurriculumPerson.student
-            GROUP BY CurriculumPerson.student, Validations.course
-        )
-
-        SELECT lastname, firstname, 
-                            ROUND((sum(COALESCE(CourseGrades.grades, 0) * COALESCE(CourseCurriculum.ects, 0)) / sum(CourseCurriculum.ects))::numeric, %s)
-        FROM Persons
-        JOIN CurriculumPerson ON CurriculumPerson.student = Persons.id AND CurriculumPerson.curriculum = %s
-        LEFT JOIN CourseGrades ON Persons.id = CourseGrades.student
-        LEFT JOIN CourseCurriculum ON CourseCurriculum.course = CourseGrades.course
-        GROUP BY Persons.id
-        """, (idCurriculum, GRADES_DECIMAL_ROUNDING, idCurriculum))
+        self.cursor.execute(AVERAGES_OF_CURRICULUM_SQL, (GRADES_DECIMAL_ROUNDING, idCurriculum))
         return self.cursor.fetchall()
 
+    # Return (name, averages of the students, courses) of the page of a
+    # curriculum, as returned by getNameOfCurriculum(),
+    # averageGradesOfStudentsInCurriculum() and listCoursesOfCurriculum(),
+    # in a single statement (see fetchTogether()). None if it does not exist.
+    @query("Curriculums", "Persons", "CurriculumAverages", "Courses", "CourseCurriculum", page=True)
+    def curriculumPage(self, idCurriculum):
+        page = self.fetchTogether("SELECT name FROM Curriculums WHERE id = %s", (idCurriculum,), [
+            PageTable('averageGradesOfStudentsInCurriculum', (idCurriculum,),
+                      AVERAGES_OF_CURRICULUM_SQL, (GRADES_DECIMAL_ROUNDING, idCurriculum), apart=True),
+            PageTable('listCoursesOfCurriculum', (idCurriculum,), COURSES_OF_CURRICULUM_SQL, (idCurriculum,)),
+        ])
+        return page and (page[0][0], *page[1])
+
+    # Return the name of a curriculum and the grades of its students in its
+    # courses (see GRADE_DATA_SQL), in a single row, or None if it does not
+    # exist. Read by analytics.curriculum_statistics().
+    @query("Curriculums", "CurriculumPerson", "Persons", "CourseCurriculum", "Courses", "Validations", "Grades", page=True)
+    def curriculumGrades(self, idCurriculum):
+        self.cursor.execute(f"""
+        SELECT Curriculums.name, Data.*
+        FROM Curriculums, ({GRADE_DATA_SQL.format(
+            students="SELECT student FROM CurriculumPerson WHERE curriculum = %(curriculum)s",
+            courses="SELECT course, ects FROM CourseCurriculum WHERE curriculum = %(curriculum)s")}) AS Data
+        WHERE Curriculums.id = %(curriculum)s
+        """, {'curriculum': idCurriculum})
+        return self.cursor.fetchone()
+
     # Register a person to a curriculum.
+    @write("CurriculumPerson", "CourseAverages", "CurriculumAverages")
     def registerPersonToCurriculum(self, idPerson, idCurriculum):
         self.cursor.execute("""
-        INSERT INTO CurriculumPerson VALUES (%s, %s)
-        """, (idPerson, idCurriculum))
-        self.connection.commit()
+        INSERT INTO CurriculumPerson VALUES (%(person)s, %(curriculum)s);
+        """ + refresh_averages_sql(
+            "SELECT %(person)s::int, course FROM CourseCurriculum WHERE curriculum = %(curriculum)s",
+            "SELECT %(person)s::int, %(curriculum)s::int"),
+        {'person': idPerson, 'curriculum': idCurriculum})
+
+    # Register a list of persons to a curriculum, in one statement. The
+    # persons already registered to it are ignored.
+    @write("CurriculumPerson", "CourseAverages", "CurriculumAverages")
+    def registerPersonsToCurriculum(self, idPersons, idCurriculum):
+        self.cursor.execute("""
+        INSERT INTO CurriculumPerson
+        SELECT DISTINCT unnest(%(persons)s::int[]), %(curriculum)s::int
+        ON CONFLICT DO NOTHING;
+        """ + refresh_averages_sql("""
+            SELECT Persons.id, CourseCurriculum.course
+            FROM unnest(%(persons)s::int[]) AS Persons (id), CourseCurriculum
+            WHERE CourseCurriculum.curriculum = %(curriculum)s""",
+            "SELECT unnest(%(persons)s::int[]), %(curriculum)s::int"),
+        {'persons': [int(id) for id in idPersons], 'curriculum': idCurriculum})
 
     # Register a course to a curriculum.
+    @write("CourseCurriculum", "CourseAverages", "CurriculumAverages")
     def registerCourseToCurriculum(self, idCourse, idCurriculum, ects):
         self.cursor.execute("""
-        INSERT INTO CourseCurriculum VALUES (%s, %s, %s)
-        """, (idCourse, idCurriculum, ects))
-        self.connection.commit()
+        INSERT INTO CourseCurriculum VALUES (%(course)s, %(curriculum)s, %(ects)s);
+        """ + refresh_averages_sql(
+            "SELECT student, %(course)s::int FROM CurriculumPerson WHERE curriculum = %(curriculum)s",
+            "SELECT student, curriculum FROM CurriculumPerson WHERE curriculum = %(curriculum)s"),
+        {'course': idCourse, 'curriculum': idCurriculum, 'ects': ects})
 
     # Unregister a course to a curriculum.
+    @write("CourseCurriculum", "CourseAverages", "CurriculumAverages")
     def deleteCourseFromCurriculum(self, idCourse, idCurriculum):
         self.cursor.execute("""
         DELETE FROM CourseCurriculum
-        WHERE curriculum = %s AND course = %s
-        """, (idCurriculum, idCourse))
-        self.connection.commit()
+        WHERE curriculum = %(curriculum)s AND course = %(course)s;
+        """ + refresh_averages_sql(
+            "SELECT student, %(course)s::int FROM CurriculumPerson WHERE curriculum = %(curriculum)s",
+            "SELECT student, curriculum FROM CurriculumPerson WHERE curriculum = %(curriculum)s"),
+        {'course': idCourse, 'curriculum': idCurriculum})
 
 ##############################################
 ######   Queries for tab  COURSE/<ID>   ######
 ##############################################
 
-    # Get the name of a given course.
+    # Get the name of a given course. None if it does not exist.
+    @query("Courses")
     def getNameOfCourse(self, id):
         self.cursor.execute("""
         SELECT name FROM Courses
         WHERE id = %s
         """, (id,))
-        # suppose that there is a solution
-        return self.cursor.fetchall()[0][0]
+        row = self.cursor.fetchone()
+        return row[0] if row else None
 
     # Return a list of (id, name, ECTS) of the curriculums in
     # which a given course is registered.
+    @query("Curriculums", "CourseCurriculum")
     def listCurriculumsOfCourse(self, idCourse):
-        self.cursor.execute("""
-        SELECT Curriculums.id, Curriculums.name, CourseCurriculum.ects
-        FROM CourseCurriculum
-        JOIN Curriculums ON Curriculums.id = CourseCurriculum.curriculum
-        WHERE CourseCurriculum.course = %s
-        """, (idCourse,))
+        self.cursor.execute(CURRICULUMS_OF_COURSE_SQL, (idCourse,))
         return self.cursor.fetchall()
 
-    # Returns a list of (id, date, name, coefficent) for the validations
+    # Returns a list of (id, date, name, coefficient) for the validations
     # assiociated to a given course.
+    @query("Validations")
     def listValidationsOfCourse(self, idCourse):
-        self.cursor.execute("""
-        SELECT id, date, name, coefficient
-        FROM Validations
-        WHERE Validations.course = %s
-        """, (idCourse,))
+        self.cursor.execute(VALIDATIONS_OF_COURSE_SQL, (idCourse,))
         return self.cursor.fetchall()
 
     # Return a list (id, last name, first name) of persons that are
     # registered in a curriculum with the given course
+    @query("Persons", "CurriculumPerson", "CourseCurriculum")
     def listStudentsOfCourse(self, idCourse):
-        self.cursor.execute("""
-        SELECT Persons.id, Persons.lastname, Persons.firstname
-        FROM Persons
-        JOIN CurriculumPerson on CurriculumPerson.student = Persons.id
-        JOIN CourseCurriculum ON CourseCurriculum.curriculum = CurriculumPerson.curriculum
-        WHERE CourseCurriculum.course = %s
-        """, (idCourse,))
+        self.cursor.execute(STUDENTS_OF_COURSE_SQL, (idCourse,))
         return self.cursor.fetchall()
 
-    # Return a list (id, date, curriculum name, student last name,
-    # student first name, validation name, grade, coefficient) of
-    # grades for all the validations and students having taken them,
-    # sorted by decreasing date of validation.
-    def listGradesOfCourse(self, idCourse):
-        self.cursor.execute("""
-        SELECT Validations.id, Validations.date, Curriculums.name, Persons.lastname, Persons.firstname, Validations.name, ROUND(Grades.grade::numeric, %s), Validations.coefficient
-        FROM Validations
-        JOIN Courses ON Validations.course = Courses.id
-        JOIN Grades ON Grades.validation = Validations.id
-        JOIN Persons ON Persons.id = Grades.student
-        JOIN CurriculumPerson ON CurriculumPerson.student = Grades.student
-        JOIN CourseCurriculum ON CourseCurriculum.course = Courses.id
-        JOIN Curriculums ON Curriculums.id = CurriculumPerson.curriculum AND Curriculums.id = CourseCurriculum.curriculum
-        WHERE Validations.course = %s
-        """, (GRADES_DECIMAL_ROUNDING, idCourse))
-        return self.cursor.fetchall()
+    # Return a list (id, date, curriculum_name, lastname, firstname,
+    # validation_name, grade, coefficient) of grades for all the
+    # validations and students having taken them, sorted by decreasing
+    # date of validation (then student_id and curriculum_id). The list is paginated
+    # by limit, after and before, see fetchPage().
+    @query("Validations", "Courses", "Grades", "Persons", "CurriculumPerson", "CourseCurriculum", "Curriculums")
+    def listGradesOfCourse(self, idCourse, limit=None, after=None, before=None, withTotal=False):
+        return self.fetchPage(GRADES_OF_COURSE_SQL, (GRADES_DECIMAL_ROUNDING, idCourse), GRADES_OF_COURSE_KEYS,
+                              True, limit, after, before, withTotal)
+
+    # Return (name, curriculums, validations, grades, students) of the page
+    # of a course, as returned by getNameOfCourse(), listCurriculumsOfCourse(),
+    # listValidationsOfCourse(), listGradesOfCourse() (paginated by limit,
+    # after and before) and listStudentsOfCourse(), in a single statement (see
+    # fetchTogether()). None if the course does not exist.
+    @query("Courses", "Curriculums", "CourseCurriculum", "Validations", "Grades", "Persons", "CurriculumPerson", page=True)
+    def coursePage(self, idCourse, limit=None, after=None, before=None, withTotal=False):
+        page = self.fetchTogether("SELECT name FROM Courses WHERE id = %s", (idCourse,), [
+            PageTable('listCurriculumsOfCourse', (idCourse,), CURRICULUMS_OF_COURSE_SQL, (idCourse,)),
+            PageTable('listValidationsOfCourse', (idCourse,), VALIDATIONS_OF_COURSE_SQL, (idCourse,)),
+            PageTable('listGradesOfCourse', (idCourse,), GRADES_OF_COURSE_SQL, (GRADES_DECIMAL_ROUNDING, idCourse),
+                      GRADES_OF_COURSE_KEYS, True, apart=True, limit=limit, after=after, before=before,
+                      withTotal=withTotal),
+            PageTable('listStudentsOfCourse', (idCourse,), STUDENTS_OF_COURSE_SQL, (idCourse,), apart=True),
+        ])
+        return page and (page[0][0], *page[1])
+
+    # Return the name of a course and the grades in it of the students of its
+    # curriculums (see GRADE_DATA_SQL), in a single row, or None if it does
+    # not exist. Read by analytics.course_statistics().
+    @query("Courses", "CourseCurriculum", "CurriculumPerson", "Persons", "Validations", "Grades", page=True)
+    def courseGrades(self, idCourse):
+        students = """
+            SELECT student FROM CurriculumPerson
+            JOIN CourseCurriculum ON CourseCurriculum.curriculum = CurriculumPerson.curriculum
+            WHERE CourseCurriculum.course = %(course)s"""
+        self.cursor.execute(f"""
+        SELECT Courses.name, Data.*
+        FROM Courses, ({GRADE_DATA_SQL.format(
+            students=students, courses="SELECT id, 0 FROM Courses WHERE id = %(course)s")}) AS Data
+        WHERE Courses.id = %(course)s
+        """, {'course': idCourse})
+        return self.cursor.fetchone()
 
     # Add a validation to a given course.
+    @write("Validations", "CourseAverages", "CurriculumAverages")
     def addValidationToCourse(self, name, coef, date, idCourse):
         self.cursor.execute("""
-        INSERT INTO Validations (name, coefficient, date, course) VALUES (%s, %s, %s, %s)
-        """, (name, coef, date, idCourse))
-        self.connection.commit()
+        INSERT INTO Validations (name, coefficient, date, course) VALUES (%(name)s, %(coef)s, %(date)s, %(course)s);
+        """ + refresh_averages_sql("""
+            SELECT CurriculumPerson.student, CourseCurriculum.course
+            FROM CourseCurriculum
+            JOIN CurriculumPerson ON CurriculumPerson.curriculum = CourseCurriculum.curriculum
+            WHERE CourseCurriculum.course = %(course)s""", """
+            SELECT CurriculumPerson.student, CurriculumPerson.curriculum
+            FROM CourseCurriculum
+            JOIN CurriculumPerson ON CurriculumPerson.curriculum = CourseCurriculum.curriculum
+            WHERE CourseCurriculum.course = %(course)s"""),
+        {'name': name, 'coef': coef, 'date': date, 'course': idCourse})
 
     # Add a grade to a student.
+    @write("Grades", "CourseAverages", "CurriculumAverages")
     def addGrade(self, idValidation, idStudent, grade):
         self.cursor.execute("""
-        INSERT INTO Grades (validation, student, grade) VALUES (%s, %s, %s)
-        """, (idValidation, idStudent, grade))
-        self.connection.commit()
+        INSERT INTO Grades (validation, student, grade) VALUES (%(validation)s, %(student)s, %(grade)s);
+        """ + refresh_averages_sql(
+            "SELECT %(student)s::int, course FROM Validations WHERE id = %(validation)s", """
+            SELECT CurriculumPerson.student, CurriculumPerson.curriculum
+            FROM Validations
+            JOIN CourseCurriculum ON CourseCurriculum.course = Validations.course
+            JOIN CurriculumPerson ON CurriculumPerson.curriculum = CourseCurriculum.curriculum
+            WHERE Validations.id = %(validation)s AND CurriculumPerson.student = %(student)s"""),
+        {'validation': idValidation, 'student': idStudent, 'grade': grade})
+
+    # Add the grades of several students to a validation, given a list of
+    # (student ID, grade), in one statement.
+    @write("Grades", "CourseAverages", "CurriculumAverages")
+    def addGrades(self, idValidation, grades):
+        self.cursor.execute("""
+        INSERT INTO Grades (validation, student, grade)
+        SELECT %(validation)s::int, * FROM unnest(%(students)s::int[], %(grades)s::float[]);
+        """ + refresh_averages_sql("""
+            SELECT Students.id, Validations.course
+            FROM unnest(%(students)s::int[]) AS Students (id), Validations
+            WHERE Validations.id = %(validation)s""", """
+            SELECT CurriculumPerson.student, CurriculumPerson.curriculum
+            FROM Validations
+            JOIN CourseCurriculum ON CourseCurriculum.course = Validations.course
+            JOIN CurriculumPerson ON CurriculumPerson.curriculum = CourseCurriculum.curriculum
+            WHERE Validations.id = %(validation)s AND CurriculumPerson.student = ANY(%(students)s::int[])"""),
+        {'validation': idValidation, 'students': [int(g[0]) for g in grades],
+         'grades': [float(g[1]) for g in grades]})
+
+    # Import the grades of a validation from a CSV file of (student id,
+    # grade) lines, with an optional header line. The lines whose student is
+    # not registered to the course, whose grade is not between 0 and 20, or
+    # repeating a student of a previous line are rejected. So are the lines
+    # of students already having a grade, unless upsert is set, in which
+    # case their grade is replaced. The other lines are loaded with COPY and
+    # merged into Grades in a single transaction. Return the number of
+    # grades imported and a list of (line number, student, error message) of
+    # the rejected lines.
+    @write("Grades", "CourseAverages", "CurriculumAverages")
+    def importGrades(self, idValidation, file, upsert=False):
+        self.cursor.execute("""
+        SELECT course FROM Validations
+        WHERE id = %s
+        """, (idValidation,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return 0, [(0, None, "This validation does not exist")]
+        idCourse = row[0]
+        students = {p[0] for p in self.listStudentsOfCourse(idCourse)}
+
+        errors = []
+        seen = set()
+        buffer = io.StringIO()
+        staging = csv.writer(buffer)
+        for number, line in enumerate(csv.reader(file), 1):
+            if not line or (number == 1 and not line[0].strip().isdigit()):
+                continue
+            if len(line) != 2:
+                errors.append((number, None, "Expected a student id and a grade"))
+                continue
+            try:
+                student = int(line[0])
+                grade = float(line[1])
+            except ValueError:
+                errors.append((number, line[0], "Invalid student id or grade"))
+                continue
+            if student not in students:
+                errors.append((number, student, "This student is not registered to the course"))
+            elif not 0 <= grade <= 20:
+                errors.append((number, student, "The grade must be between 0 and 20"))
+            elif student in seen:
+                errors.append((number, student, "This student already has a grade in the file"))
+            else:
+                seen.add(student)
+                staging.writerow((number, student, grade))
+        buffer.seek(0)
+
+        params = {'validation': idValidation, 'course': idCourse}
+        with self.transaction():
+            self.cursor.execute("""
+            CREATE TEMP TABLE GradesImport (line INT, student INT, grade FLOAT) ON COMMIT DROP
+            """)
+            self.cursor.copy_expert("COPY GradesImport FROM STDIN WITH (FORMAT csv)", buffer)
+            if upsert:
+                merge = """
+                INSERT INTO Grades (validation, student, grade)
+                SELECT %(validation)s, student, grade FROM GradesImport
+                ON CONFLICT (student, validation) DO UPDATE SET grade = EXCLUDED.grade;
+                """
+            else:
+                # (the grades already there, even if inserted by another
+                # transaction since the file was read, are kept and their
+                # lines removed from GradesImport)
+                self.cursor.execute("""
+                WITH Inserted AS (
+                    INSERT INTO Grades (validation, student, grade)
+                    SELECT %(validation)s, student, grade FROM GradesImport
+                    ON CONFLICT (student, validation) DO NOTHING
+                    RETURNING student
+                )
+                DELETE FROM GradesImport
+                WHERE student NOT IN (SELECT student FROM Inserted)
+                RETURNING line, student
+                """, params)
+                errors.extend((line, student, "This student already has a grade")
+                              for (line, student) in self.cursor.fetchall())
+                merge = ""
+            self.cursor.execute(merge + refresh_averages_sql(
+                "SELECT student, %(course)s::int FROM GradesImport", """
+                SELECT CurriculumPerson.student, CurriculumPerson.curriculum
+                FROM GradesImport
+                JOIN CurriculumPerson ON CurriculumPerson.student = GradesImport.student
+                JOIN CourseCurriculum ON CourseCurriculum.curriculum = CurriculumPerson.curriculum
+                WHERE CourseCurriculum.course = %(course)s"""), params)
+            self.cursor.execute("SELECT count(*) FROM GradesImport")
+            imported = self.cursor.fetchone()[0]
+        return imported, sorted(errors, key=lambda error: error[0])
 
 ##############################################
 ######       Queries for tab            ######
@@ -290,79 +1880,418 @@ class Model:
 ##############################################
 
    # Return a list (grade, lastname, firstname) of grades for
-   # a given validation.
-    def listGradesOfValidation(self, idValidation):
-        self.cursor.execute("""
-        SELECT ROUND(Grades.grade::numeric, %s), Persons.lastname, Persons.firstname
-        FROM Grades
-        JOIN Persons ON Grades.student = Persons.id
-        WHERE Grades.validation = %s
-        ORDER BY Grades.grade DESC
-        """, (GRADES_DECIMAL_ROUNDING, idValidation))
-        return self.cursor.fetchall()
+   # a given validation, sorted by decreasing exact_grade. The list is
+   # paginated by limit, after and before, see fetchPage().
+    @query("Grades", "Persons")
+    def listGradesOfValidation(self, idValidation, limit=None, after=None, before=None, withTotal=False):
+        return self.fetchPage(GRADES_OF_VALIDATION_SQL, (GRADES_DECIMAL_ROUNDING, idValidation),
+                              GRADES_OF_VALIDATION_KEYS, True, limit, after, before, withTotal)
 
     # Get the complete name of a validation given its ID. The
     # complete name of a validation with name "exam" of a course "BDD"
     # is "BDD - exam". You should therefore preppend the name of the
-    # course.
-    def getNameOfValidation(self, id):
-        self.cursor.execute("""
-        SELECT Courses.name || ' - ' || Validations.name 
+    # course. None if it does not exist, or if idCourse is given and it is not
+    # a validation of this course.
+    @query("Validations", "Courses")
+    def getNameOfValidation(self, id, idCourse=None):
+        sql = """
+        SELECT Courses.name || ' - ' || Validations.name AS name
         FROM Validations
         JOIN Courses ON Validations.course = Courses.id
         WHERE Validations.id = %s
-        """, (id,))
-        # suppose that there is a solution
-        return self.cursor.fetchall()[0][0]
+        """
+        if idCourse is None:
+            self.cursor.execute(sql, (id,))
+        else:
+            self.cursor.execute(sql + " AND Validations.course = %s", (id, idCourse))
+        row = self.cursor.fetchone()
+        return row[0] if row else None
+
+    # Return (name, grades, students) of the page of a validation of a given
+    # course, as returned by getNameOfValidation(), listGradesOfValidation()
+    # (paginated by limit, after and before) and listStudentsOfCourse() (the
+    # students who can be graded), in a single statement (see fetchTogether()).
+    # None if the course has no such validation.
+    @query("Validations", "Courses", "Grades", "Persons", "CurriculumPerson", "CourseCurriculum", page=True)
+    def validationPage(self, idCourse, idValidation, limit=None, after=None, before=None, withTotal=False):
+        page = self.fetchTogether("""
+        SELECT Courses.name || ' - ' || Validations.name AS name
+        FROM Validations
+        JOIN Courses ON Validations.course = Courses.id
+        WHERE Validations.id = %s AND Validations.course = %s
+        """, (idValidation, idCourse), [
+            PageTable('listGradesOfValidation', (idValidation,), GRADES_OF_VALIDATION_SQL,
+                      (GRADES_DECIMAL_ROUNDING, idValidation), GRADES_OF_VALIDATION_KEYS, True,
+                      limit=limit, after=after, before=before, withTotal=withTotal),
+            PageTable('listStudentsOfCourse', (idCourse,), STUDENTS_OF_COURSE_SQL, (idCourse,), apart=True),
+        ])
+        return page and (page[0][0], *page[1])
 
 ##############################################
 ######   Queries for tab  PERSON/<ID>   ######
 ##############################################
 
-    # Get the name of a person given its ID.
+    # Get the name of a person given its ID. None if it does not exist.
+    @query("Persons")
     def getNameOfPerson(self, id):
         self.cursor.execute("""
-        SELECT firstname || ' ' || lastname FROM Persons WHERE id = %s
+        SELECT firstname || ' ' || lastname AS name FROM Persons WHERE id = %s
         """, (id,))
-        # suppose that there is a solution
-        return self.cursor.fetchall()[0][0]
+        row = self.cursor.fetchone()
+        return row[0] if row else None
 
-    # Return a list (id, date, curriculum name, course name,
-    # exam name, grade) of grades for a given student, sorted
-    # by decreasing date of validation.
-    def listValidationsOfStudent(self, idStudent):
-        self.cursor.execute("""
-        SELECT Validations.id, Validations.date, Curriculums.name, Courses.name, Validations.name, ROUND(Grades.grade::numeric, %s)
-        FROM Persons
-        JOIN Grades ON Grades.student = Persons.id
-        JOIN Validations ON Validations.id = Grades.validation
-        JOIN CourseCurriculum ON CourseCurriculum.course = Validations.course
-        JOIN Curriculums ON CourseCurriculum.curriculum = Curriculums.id
-        JOIN Courses ON Courses.id = Validations.course
-        WHERE Persons.id = %s
-        """, (GRADES_DECIMAL_ROUNDING, idStudent))
-        return self.cursor.fetchall()
+    # Return a list (id, date, curriculum_name, course_name,
+    # validation_name, grade) of grades for a given student, sorted
+    # by decreasing date of validation (then curriculum_id). The list is paginated
+    # by limit, after and before, see fetchPage().
+    @query("Persons", "Grades", "Validations", "CourseCurriculum", "Curriculums", "Courses")
+    def listValidationsOfStudent(self, idStudent, limit=None, after=None, before=None, withTotal=False):
+        return self.fetchPage(VALIDATIONS_OF_STUDENT_SQL, (GRADES_DECIMAL_ROUNDING, idStudent),
+                              VALIDATIONS_OF_STUDENT_KEYS, True, limit, after, before, withTotal)
 
     # !!! HARD !!!
-    # Return a list (curriculum name, average grade) of all the
+    # Return a list (name, average) of all the
     # curriculum a given student is registered to, where the
     # average grade is computed as before.
+    @query("Curriculums", "CurriculumAverages")
     def listCurriculumsOfStudent(self, idStudent):
+        self.cursor.execute(CURRICULUMS_OF_STUDENT_SQL, (GRADES_DECIMAL_ROUNDING, idStudent))
+        return self.cursor.fetchall()
+
+    # Return (name, curriculums, grades) of the page of a person, as returned
+    # by getNameOfPerson(), listCurriculumsOfStudent() and
+    # listValidationsOfStudent() (paginated by limit, after and before), in a
+    # single statement (see fetchTogether()). None if the person does not exist.
+    @query("Persons", "Curriculums", "CurriculumAverages", "Grades", "Validations", "CourseCurriculum", "Courses", page=True)
+    def personPage(self, idPerson, limit=None, after=None, before=None, withTotal=False):
+        page = self.fetchTogether("""
+        SELECT firstname || ' ' || lastname AS name FROM Persons WHERE id = %s
+        """, (idPerson,), [
+            PageTable('listCurriculumsOfStudent', (idPerson,), CURRICULUMS_OF_STUDENT_SQL,
+                      (GRADES_DECIMAL_ROUNDING, idPerson)),
+            PageTable('listValidationsOfStudent', (idPerson,), VALIDATIONS_OF_STUDENT_SQL,
+                      (GRADES_DECIMAL_ROUNDING, idPerson), VALIDATIONS_OF_STUDENT_KEYS, True,
+                      limit=limit, after=after, before=before, withTotal=withTotal),
+        ])
+        return page and (page[0][0], *page[1])
+
+##############################################
+######       Stored averages            ######
+##############################################
+
+    # Recompute all the stored averages from the grades.
+    @write("CourseAverages", "CurriculumAverages")
+    def refreshAverages(self):
         self.cursor.execute("""
-        WITH CourseGrades AS (
-            SELECT Validations.course as course, (sum(Grades.grade * Validations.coefficient) / sum(Validations.coefficient)) as grades
-            FROM Validations
-            JOIN CourseCurriculum ON CourseCurriculum.course = Validations.course
-            JOIN CurriculumPerson ON CurriculumPerson.student = %s AND CurriculumPerson.curriculum = CourseCurriculum.curriculum
-            LEFT JOIN Grades ON Grades.student = CurriculumPerson.student AND Grades.validation = Validations.id
-            GROUP BY Validations.course
-        )
+        TRUNCATE CourseAverages, CurriculumAverages;
+        """ + refresh_averages_sql(ALL_COURSE_PAIRS_SQL, ALL_CURRICULUM_PAIRS_SQL))
 
-        SELECT Curriculums.name, 
-                            ROUND((sum(COALESCE(CourseGrades.grades,0) * COALESCE(CourseCurriculum.ects,0)) / sum(COALESCE(CourseCurriculum.ects,0)))::numeric, %s)
-        FROM CourseGrades
-        JOIN CourseCurriculum ON CourseCurriculum.course = CourseGrades.course
-        JOIN Curriculums ON CourseCurriculum.curriculum = Curriculums.id
-        GROUP BY Curriculums.name
-        """, (idStudent, GRADES_DECIMAL_ROUNDING))
+    # Recompute the stored averages of the students of a curriculum in one
+    # of its courses, or if idCourse is None, in the curriculum itself from
+    # their course averages (see jobs.refresh_curriculum_averages()).
+    @write("CourseAverages", "CurriculumAverages")
+    def refreshAveragesOfCurriculum(self, idCurriculum, idCourse=None):
+        if idCourse is None:
+            sql = refresh_averages_sql(None, """
+            SELECT student, curriculum FROM CurriculumPerson WHERE curriculum = %(curriculum)s
+            """)
+        else:
+            sql = refresh_averages_sql("""
+            SELECT student, %(course)s::int FROM CurriculumPerson WHERE curriculum = %(curriculum)s
+            """)
+        self.cursor.execute(sql, {'curriculum': idCurriculum, 'course': idCourse})
+
+    # Return a list of (averages: table, student, id: course or curriculum
+    # id, stored, expected) of the stored averages that differ from
+    # the ones computed on the fly from the grades. Empty if all is fine.
+    def checkAverages(self):
+        courseAverages = COURSE_AVERAGES_SQL.format(scope=ALL_COURSE_PAIRS_SQL)
+        self.cursor.execute(f"""
+        WITH Expected AS ({courseAverages})
+        SELECT 'CourseAverages' AS averages, student, course AS id, Stored.grade AS stored, Expected.grade AS expected
+        FROM CourseAverages AS Stored
+        FULL JOIN Expected USING (student, course)
+        WHERE Stored.student IS NULL OR Expected.student IS NULL
+           OR abs(Stored.grade - Expected.grade) > 1e-9
+        UNION ALL
+        SELECT 'CurriculumAverages', student, curriculum, Stored.grade, Expected.grade
+        FROM CurriculumAverages AS Stored
+        FULL JOIN ({CURRICULUM_AVERAGES_SQL.format(scope=ALL_CURRICULUM_PAIRS_SQL, courseAverages="Expected")}) AS Expected
+        USING (student, curriculum)
+        WHERE Stored.student IS NULL OR Expected.student IS NULL
+           OR (Stored.grade IS NULL) <> (Expected.grade IS NULL)
+           OR abs(Stored.grade - Expected.grade) > 1e-9
+        """)
         return self.cursor.fetchall()
+
+##############################################
+######         Background jobs          ######
+##############################################
+
+# The queue of the jobs run by the workers of jobs.py (table Jobs, see
+# migrations/0007_jobs.sql).
+
+    # Add a job running the function of jobs.JOBS named kind with the given
+    # arguments (a list of JSON values) to the queue, and return its ID. The
+    # workers waiting for a job are notified.
+    @write("Jobs")
+    def enqueueJob(self, kind, args, maxAttempts):
+        self.cursor.execute("""
+        WITH Job AS (
+            INSERT INTO Jobs (kind, args, max_attempts) VALUES (%s, %s, %s)
+            RETURNING id
+        )
+        SELECT id, pg_notify('jobs', id::text) FROM Job
+        """, (kind, psycopg2.extras.Json(args), maxAttempts))
+        return self.cursor.fetchone()[0]
+
+    # Return the job of the given ID (all the columns of Jobs), or None. It is
+    # read from the primary, as its status is written by the workers.
+    @query("Jobs", primary=True)
+    def getJob(self, idJob):
+        self.cursor.execute("""
+        SELECT * FROM Jobs WHERE id = %s
+        """, (idJob,))
+        return self.cursor.fetchone()
+
+    # Return the list of (id, kind, args, status, percent: progress in %,
+    # message, attempts, created, finished) of the jobs, the last ones first.
+    # The list is paginated, see fetchPage().
+    @query("Jobs", primary=True)
+    def listJobs(self, limit=None, after=None, before=None, withTotal=False):
+        return self.fetchPage("""
+        SELECT id, kind, args::text AS args, status, round(100 * progress) AS percent, message,
+               attempts, created, finished
+        FROM Jobs
+        """, (), ["id"], True, limit, after, before, withTotal)
+
+    # Take the next queued job due to run for the given worker, unless
+    # maxRunning jobs are running already (whatever their worker), and return
+    # its (id, kind, args, attempts), or None if there is none.
+    @write("Jobs")
+    def claimJob(self, worker, maxRunning):
+        with self.transaction():
+            self.cursor.execute("SELECT pg_advisory_xact_lock(%s)", (JOBS_CLAIM_LOCK,))
+            self.cursor.execute("""
+            UPDATE Jobs
+            SET status = 'running', attempts = attempts + 1, worker = %s,
+                started = now(), heartbeat = now(), progress = 0, message = NULL
+            WHERE id = (
+                SELECT id FROM Jobs
+                WHERE status = 'queued' AND run_after <= now()
+                ORDER BY run_after, id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            ) AND (SELECT count(*) FROM Jobs WHERE status = 'running') < %s
+            RETURNING id, kind, args, attempts
+            """, (worker, maxRunning))
+            return self.cursor.fetchone()
+
+    # Record the progress (from 0 to 1) and message of a job running on the
+    # given worker, and return whether it is asked to stop: it was cancelled,
+    # or it is not running on this worker anymore (see requeueStaleJobs()).
+    @write("Jobs")
+    def heartbeatJob(self, idJob, worker, progress, message):
+        self.cursor.execute("""
+        UPDATE Jobs SET progress = %s, message = %s, heartbeat = now()
+        WHERE id = %s AND worker = %s AND status = 'running'
+        RETURNING cancel_requested
+        """, (progress, message, idJob, worker))
+        row = self.cursor.fetchone()
+        return row is None or row[0]
+
+    # Record the end of a job running on the given worker: done with its
+    # result (a JSON value), cancelled, or failed with an error message. A
+    # failed job which has attempts left and was not cancelled is queued
+    # again, to run after retryDelay seconds doubled for each attempt made.
+    # The workers waiting for a job are notified, as one can run in its place.
+    # Return its status, or None if the job is not running on this worker
+    # anymore (queued again once stale, see requeueStaleJobs(), and maybe
+    # taken by another worker): the end of this run is then ignored.
+    @write("Jobs")
+    def finishJob(self, idJob, worker, status, result=None, error=None, retryDelay=0):
+        retry = "%(status)s = 'failed' AND attempts < max_attempts AND NOT cancel_requested"
+        self.cursor.execute(f"""
+        WITH Job AS (
+            UPDATE Jobs
+            SET status = CASE WHEN {retry} THEN 'queued' ELSE %(status)s END,
+                run_after = CASE WHEN {retry} THEN now() + %(delay)s * 2 ^ (attempts - 1) * interval '1 second'
+                                 ELSE run_after END,
+                finished = CASE WHEN {retry} THEN NULL ELSE now() END,
+                progress = CASE WHEN %(status)s = 'done' THEN 1 ELSE progress END,
+                result = %(result)s, error = %(error)s
+            WHERE id = %(id)s AND worker = %(worker)s AND status = 'running'
+            RETURNING id, status
+        )
+        SELECT status, pg_notify('jobs', id::text) FROM Job
+        """, {'id': idJob, 'worker': worker, 'status': status, 'result': psycopg2.extras.Json(result),
+              'error': error, 'delay': retryDelay})
+        row = self.cursor.fetchone()
+        return row and row[0]
+
+    # Ask a job to stop: a queued one is cancelled at once, and a running one
+    # by its worker (see jobs.py). Return its status, or None if there is no
+    # such job.
+    @write("Jobs")
+    def cancelJob(self, idJob):
+        self.cursor.execute("""
+        UPDATE Jobs
+        SET cancel_requested = status IN ('queued', 'running'),
+            status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END,
+            finished = CASE WHEN status = 'queued' THEN now() ELSE finished END
+        WHERE id = %s
+        RETURNING status
+        """, (idJob,))
+        row = self.cursor.fetchone()
+        return row and row[0]
+
+    # Queue again the running jobs whose worker sent no heartbeat for
+    # staleAfter seconds (it stopped), or fail them if they have no attempts
+    # left. Return their number.
+    @write("Jobs")
+    def requeueStaleJobs(self, staleAfter):
+        self.cursor.execute("""
+        UPDATE Jobs
+        SET status = CASE WHEN cancel_requested THEN 'cancelled'
+                          WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+            finished = CASE WHEN NOT cancel_requested AND attempts < max_attempts THEN NULL ELSE now() END,
+            error = 'the worker stopped'
+        WHERE status = 'running' AND heartbeat < now() - %s * interval '1 second'
+        """, (staleAfter,))
+        return self.cursor.rowcount
+
+##############################################
+######            Exports               ######
+##############################################
+
+# The exports are generators of lists of rows, see stream().
+
+    # Yield the (validation id, validation name, date, coefficient,
+    # student id, student last name, student first name, grade) of all
+    # the grades of a given course, sorted by date of validation.
+    def exportGradesOfCourse(self, idCourse):
+        return self.stream("""
+        SELECT Validations.id, Validations.name, Validations.date, Validations.coefficient,
+               Persons.id, Persons.lastname, Persons.firstname, ROUND(Grades.grade::numeric, %s)
+        FROM Validations
+        JOIN Grades ON Grades.validation = Validations.id
+        JOIN Persons ON Persons.id = Grades.student
+        WHERE Validations.course = %s
+        ORDER BY Validations.date, Validations.id, Persons.id
+        """, (GRADES_DECIMAL_ROUNDING, idCourse))
+
+    # Yield the (student id, last name, first name, average grade) of the
+    # students registered to a given curriculum, sorted by name.
+    def exportAveragesOfCurriculum(self, idCurriculum):
+        return self.stream("""
+        SELECT Persons.id, lastname, firstname, ROUND(CurriculumAverages.grade::numeric, %s)
+        FROM CurriculumAverages
+        JOIN Persons ON Persons.id = CurriculumAverages.student
+        WHERE CurriculumAverages.curriculum = %s
+        ORDER BY lastname, firstname, Persons.id
+        """, (GRADES_DECIMAL_ROUNDING, idCurriculum))
+
+    # Yield the (validation id, date, course name, validation name,
+    # coefficient, grade) of all the grades of a given student, sorted
+    # by date of validation.
+    def exportGradesOfStudent(self, idStudent):
+        return self.stream("""
+        SELECT Validations.id, Validations.date, Courses.name, Validations.name, Validations.coefficient,
+               ROUND(Grades.grade::numeric, %s)
+        FROM Grades
+        JOIN Validations ON Validations.id = Grades.validation
+        JOIN Courses ON Courses.id = Validations.course
+        WHERE Grades.student = %s
+        ORDER BY Validations.date, Validations.id
+        """, (GRADES_DECIMAL_ROUNDING, idStudent))
+
+    # Yield the (student id, last name, first name, students: their number,
+    # curriculums, grades) of the students registered to a given curriculum,
+    # sorted by name, for their transcripts (see transcripts.py): what the
+    # page of each student shows, read for all of them by a single statement.
+    # curriculums is the JSON array of the [name, average] of all the
+    # curriculums of the student, as listCurriculumsOfStudent(), and grades
+    # the JSON array of their [date, curriculum name, course name, validation
+    # name, grade], as listValidationsOfStudent().
+    def exportTranscriptsOfCurriculum(self, idCurriculum):
+        return self.stream("""
+        WITH Students AS (
+            SELECT student FROM CurriculumPerson WHERE curriculum = %(curriculum)s
+        )
+        SELECT Persons.id, Persons.lastname, Persons.firstname, count(*) OVER () AS students,
+               COALESCE(Averages.curriculums, '[]') AS curriculums, COALESCE(Exams.grades, '[]') AS grades
+        FROM Students
+        JOIN Persons ON Persons.id = Students.student
+        LEFT JOIN (
+            SELECT CurriculumAverages.student,
+                   json_agg(json_build_array(Curriculums.name,
+                                             ROUND(CurriculumAverages.grade::numeric, %(rounding)s))
+                            ORDER BY Curriculums.name) AS curriculums
+            FROM CurriculumAverages
+            JOIN Curriculums ON Curriculums.id = CurriculumAverages.curriculum
+            WHERE CurriculumAverages.student IN (SELECT student FROM Students)
+            GROUP BY CurriculumAverages.student
+        ) AS Averages ON Averages.student = Persons.id
+        LEFT JOIN (
+            SELECT Grades.student,
+                   json_agg(json_build_array(Validations.date, Curriculums.name, Courses.name, Validations.name,
+                                             ROUND(Grades.grade::numeric, %(rounding)s))
+                            ORDER BY Validations.date DESC, Validations.id DESC, Curriculums.id DESC) AS grades
+            FROM Grades
+            JOIN Validations ON Validations.id = Grades.validation
+            JOIN CourseCurriculum ON CourseCurriculum.course = Validations.course
+            JOIN Curriculums ON Curriculums.id = CourseCurriculum.curriculum
+            JOIN Courses ON Courses.id = Validations.course
+            WHERE Grades.student IN (SELECT student FROM Students)
+            GROUP BY Grades.student
+        ) AS Exams ON Exams.student = Persons.id
+        ORDER BY Persons.lastname, Persons.firstname, Persons.id
+        """, {'curriculum': idCurriculum, 'rounding': GRADES_DECIMAL_ROUNDING})
+
+# The tables read by the shared queries of Model, whose writes are notified to
+# the other processes (see READ_CACHE_NOTIFY).
+SHARED_TABLES = frozenset(table for method in vars(Model).values() if getattr(method, 'shared', False)
+                          for table in method.reads)
+
+# A Model without connection, running its queries on the given stand-in
+# cursor (see ReplayCursor). Its stream() returns the
+# query of the export instead of running it. The tables of the pages read
+# apart (see Model.readApart()) are read after the statement of the page,
+# or else given by readApart(table), returning the future of the table. The
+# types of the columns of the queries found by a replay (see
+# Model.columnTypes()) are kept in the dict knownTypes if given, so that the
+# next replays run the same statements even if they are forgotten meanwhile.
+class ReplayModel(Model):
+    def __init__(self, cursor, readApart=None, knownTypes=None):
+        self.cache = {}
+        self.savedRoundTrips = 0
+        self.inTransaction = False
+        self.writtenTables = set()
+        self.connection = None
+        self.cursor = cursor
+        self.primaryCursor = None
+        self.wrote = False
+        self.readTable = readApart
+        self.knownTypes = knownTypes
+
+    def stream(self, sql, params):
+        return sql, params
+
+    def columnTypes(self, query):
+        if self.knownTypes is None:
+            return super().columnTypes(query)
+        if query not in self.knownTypes:
+            self.knownTypes[query] = super().columnTypes(query)
+        return self.knownTypes[query]
+
+    def readApart(self, tables):
+        if self.readTable is None:
+            return lambda: [table.read(self) for table in tables]
+        reads = [self.readTable(table) for table in tables]
+
+        def collect():
+            pending = [read for read in reads if not read.done()]
+            if pending:
+                raise PendingReads(pending)
+            return [read.result() for read in reads]
+        return collect
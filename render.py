@@ -0,0 +1,212 @@
+#!/usr/bin/python
+
+import os
+import time
+import threading
+import inspect
+import functools
+from urllib.parse import urlencode
+from markupsafe import Markup, escape
+import cache
+import metrics
+import model
+
+# Rendering of the tables of listing.html and validators of the pages.
+#
+# A table (its title, column keys and rows, see the to_list of listing.html)
+# is rendered by render_table() into an HTML fragment. The tables of the
+# lists cached across requests (the shared read methods of Model, see
+# model.query()) are given as a Query instead of their rows: their fragment is
+# kept in a process-wide cache, keyed by the method and its arguments (with
+# the cursors of its page), and stored with the tables the method reads, so
+# that a fragment found is served without reading nor rendering the rows.
+# This cache is linked to the read cache of Model (see cache.ReadCache.link()):
+# a write of one of its tables, by this process or another one, evicts the
+# fragment as it evicts the result of the query. The other tables are
+# rendered each time, as the writes of their tables are not notified to the
+# other processes.
+#
+# The rows are rendered by a format string built once for each list of keys
+# (see row_renderer()), rather than by a loop of the template on the cells.
+
+# Bounds of the cache of the fragments: number of tables and time to live in
+# seconds, overridden by the FRAGMENT_CACHE_SIZE and FRAGMENT_CACHE_TTL
+# environment variables.
+FRAGMENT_CACHE_SIZE = 256
+FRAGMENT_CACHE_TTL = 300
+
+# Bounds of the versions of the pages remembered by first_served(): number of
+# pages and time to live in seconds, overridden by the SERVED_PAGES_SIZE and
+# SERVED_PAGES_TTL environment variables.
+SERVED_PAGES_SIZE = 4096
+SERVED_PAGES_TTL = 300
+
+_lock = threading.Lock()
+_fragment_cache = None
+_served_pages = None
+
+# Return the process-wide cache of the fragments, creating it on first use,
+# linked to the read cache of Model.
+def get_fragment_cache():
+    global _fragment_cache
+    with _lock:
+        if _fragment_cache is None:
+            maxsize = int(os.getenv('FRAGMENT_CACHE_SIZE', FRAGMENT_CACHE_SIZE))
+            ttl = float(os.getenv('FRAGMENT_CACHE_TTL', FRAGMENT_CACHE_TTL))
+            _fragment_cache = cache.ReadCache(maxsize, ttl)
+            model.get_read_cache().link(_fragment_cache)
+        return _fragment_cache
+
+# Return the process-wide cache of the versions of the pages served (see
+# first_served()), creating it on first use, linked to the read cache of Model.
+def get_served_pages():
+    global _served_pages
+    with _lock:
+        if _served_pages is None:
+            maxsize = int(os.getenv('SERVED_PAGES_SIZE', SERVED_PAGES_SIZE))
+            ttl = float(os.getenv('SERVED_PAGES_TTL', SERVED_PAGES_TTL))
+            _served_pages = cache.ReadCache(maxsize, ttl)
+            model.get_read_cache().link(_served_pages)
+        return _served_pages
+
+# The rows of a table returned by the read method name of a Model or an
+# AsyncModel given its arguments, read by render_table() only if its
+# fragment is not cached.
+class Query:
+    def __init__(self, model, name, *args, **kwargs):
+        self.model = model
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        method = getattr(type(model), name)
+        self.reads = method.reads
+        self.shared = method.shared
+
+    # The key of the query, as the one of its result in the caches of Model.
+    def key(self):
+        return (self.name, self.args, tuple(sorted(self.kwargs.items())))
+
+    # Return the rows, or with an AsyncModel, their awaitable.
+    def read(self):
+        return getattr(self.model, self.name)(*self.args, **self.kwargs)
+
+# Return the function rendering a row of a table with the given keys as a
+# <tr> element. The key of a column is its title, or the link to the details
+# ('Details') or the deletion ('Delete') of the row, whose id is its first
+# value. The columns of empty keys are not shown.
+@functools.lru_cache(maxsize=256)
+def row_renderer(keys):
+    cells = []
+    for index, key in enumerate(keys):
+        if key == "":
+            continue
+        if key == 'Details':
+            cells.append('<td><a href="{0}/">see details</a></td>')
+        elif key == 'Delete':
+            cells.append('<td><a href="del/{0}/">x</a></td>')
+        else:
+            cells.append(f'<td>{{{index}}}</td>')
+    template = "<tr>" + "".join(cells) + "</tr>\n"
+    return lambda row: template.format(*map(escape, row))
+
+# Return the HTML of a table: its title, its rows, and for a Page of a
+# paginated list (see model.Page), the links to the other pages and the
+# total number of rows.
+def table_html(rows, keys, name):
+    render = row_renderer(tuple(keys))
+    html = [f"<h2> {escape(name)} </h2>\n<table border=\"1\">\n<tr>"]
+    html.extend(f"<th>{escape(key)}</th>" for key in keys if key != "")
+    html.append("</tr>\n")
+    html.extend(render(row) for row in rows)
+    html.append("</table>\n")
+    limit = getattr(rows, 'limit', None)
+    total = getattr(rows, 'total', None)
+    prevCursor = getattr(rows, 'prevCursor', None)
+    nextCursor = getattr(rows, 'nextCursor', None)
+    if prevCursor or nextCursor:
+        args = {'size': limit, 'total': 1} if total is not None else {'size': limit}
+        html.append('<p class="pages">\n')
+        if prevCursor:
+            html.append(f'<a href="?{escape(urlencode(args))}">first</a>\n')
+            html.append(f'<a href="?{escape(urlencode(dict(args, before=prevCursor)))}">previous</a>\n')
+        if nextCursor:
+            html.append(f'<a href="?{escape(urlencode(dict(args, after=nextCursor)))}">next</a>\n')
+        html.append('</p>\n')
+    if total is not None:
+        html.append(f'<p class="pages">{total} rows in total</p>\n')
+    return "".join(html)
+
+# Return the HTML of a table, given its rows or the Query reading them, from
+# the fragment cache for a Query of a shared method (see above). With an
+# AsyncModel, the HTML of a Query not cached is returned as an awaitable,
+# which the templates of Quart await. The tables of a Query are recorded as
+# read by the request even if its fragment is found, as the page shows them
+# (see first_served()).
+def render_table(table, keys, name):
+    if not isinstance(table, Query):
+        return timed_table_html(table, keys, name)
+    metrics.count_read(table.reads)
+    if not table.shared:
+        return finish_table(table.read(), lambda rows: timed_table_html(rows, keys, name))
+    fragments = get_fragment_cache()
+    key = table.key() + (tuple(keys), name)
+    found, html = fragments.get(key)
+    if found:
+        metrics.FRAGMENT_CACHE_LOOKUPS.inc("hit")
+        return Markup(html)
+    metrics.FRAGMENT_CACHE_LOOKUPS.inc("miss")
+    version = fragments.version(table.reads)
+
+    def store(rows):
+        html = timed_table_html(rows, keys, name)
+        fragments.put(key, str(html), table.reads, version)
+        return html
+    return finish_table(table.read(), store)
+
+# Return function(rows), or its awaitable if rows is an awaitable.
+def finish_table(rows, function):
+    if not inspect.isawaitable(rows):
+        return function(rows)
+
+    async def finish():
+        return function(await rows)
+    return finish()
+
+def timed_table_html(rows, keys, name):
+    start = time.perf_counter()
+    html = table_html(rows, keys, name)
+    metrics.TABLE_RENDER_SECONDS.observe(time.perf_counter() - start)
+    return Markup(html)
+
+# Return the validators of the page at the given URL, (ETag, Last-Modified
+# date), if it can be answered 304 Not Modified without being rendered: it was
+# served by this process, read only tables of shared read methods of Model
+# (which all the processes invalidate on their writes, see model.query()),
+# none of them from a replica, and they were not written since. None otherwise.
+def served_page(url):
+    found, page = get_served_pages().get(url)
+    return page[:2] if found and page[2] else None
+
+# Return a snapshot of the versions of the tables to give to first_served()
+# for a page whose rendering starts.
+def served_snapshot():
+    return get_served_pages().snapshot()
+
+# Return the time at which this process started to serve the page at the
+# given URL with the given ETag, as its Last-Modified date: a client holding
+# another version of the page got it before, so that it is asked to download
+# the page again, while the clients holding this one may receive 304 Not
+# Modified. The version of the page is kept (at most SERVED_PAGES_TTL
+# seconds) with the tables read while rendering it, given by the
+# metrics.RequestStats of the request and the versions taken by
+# served_snapshot() before it, and forgotten when one of them is written.
+def first_served(url, etag, stats, snapshot):
+    pages = get_served_pages()
+    found, page = pages.get(url)
+    if found and page[0] == etag:
+        return page[1]
+    served = time.time()
+    tables = frozenset(stats.tables) if stats is not None else frozenset()
+    early = bool(tables) and tables <= model.SHARED_TABLES and not stats.replica
+    pages.put(url, (etag, served, early), tables, pages.version(tables, snapshot))
+    return served
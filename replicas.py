@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+import time
+import logging
+import threading
+import metrics
+
+# State of the replicas of the database to which Model and AsyncModel send
+# their read queries (see Model.runRead()): the replicas are used in turn
+# (round robin), skipping the ones down or lagging behind the primary.
+#
+# A replica is checked when a connection to it is taken, at most every
+# REPLICA_CHECK_INTERVAL seconds: its lag is measured by LAG_SQL, and if it is
+# more than REPLICA_MAX_LAG seconds the replica is not used until the next
+# check. A replica which cannot be reached, or fails a query, is not used for
+# REPLICA_RETRY_DELAY seconds. The reads then go to the other replicas, or to
+# the primary if there are none left.
+
+# Number of seconds between two checks of the lag of a replica.
+REPLICA_CHECK_INTERVAL = 5
+
+# Lag in seconds beyond which a replica is not used.
+REPLICA_MAX_LAG = 10
+
+# Number of seconds during which a replica which failed is not used.
+REPLICA_RETRY_DELAY = 30
+
+# Number of seconds to wait for a connection to a replica, before reading
+# from the primary instead.
+REPLICA_CONNECT_TIMEOUT = 2
+
+# Lag of a replica in seconds: the age of the last transaction it replayed,
+# or 0 if it replayed all the WAL it received (otherwise a replica of an idle
+# primary would seem to lag more and more). A server which is not a replica
+# has no lag.
+LAG_SQL = """
+SELECT CASE WHEN pg_last_wal_receive_lsn() <= pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+       END AS lag
+"""
+
+logger = logging.getLogger(__name__)
+
+# A replica: its name in the metrics (host[:port]) and database URL.
+class Replica:
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url
+        # Lag measured by the last check, and when it was done (monotonic).
+        self.lag = None
+        self.checked = None
+        # Time (monotonic) until which the replica is not used.
+        self.downUntil = 0
+
+class ReplicaSet:
+    def __init__(self, replicas):
+        self.replicas = replicas
+        self.lock = threading.Lock()
+        self.next = 0
+
+    # Return the replicas to try in turn for a read, starting by the next one
+    # in the round robin, without the ones down or lagging.
+    def candidates(self):
+        if not self.replicas:
+            return []
+        with self.lock:
+            start = self.next
+            self.next = (self.next + 1) % len(self.replicas)
+        now = time.monotonic()
+        ordered = self.replicas[start:] + self.replicas[:start]
+        return [replica for replica in ordered if replica.downUntil <= now]
+
+    # Whether the lag of the replica should be measured again.
+    def needsCheck(self, replica):
+        return replica.checked is None or time.monotonic() - replica.checked >= REPLICA_CHECK_INTERVAL
+
+    # Record the lag of a replica, measured by LAG_SQL. Return whether the
+    # replica can be used.
+    def checked(self, replica, lag):
+        replica.lag = float(lag)
+        replica.checked = time.monotonic()
+        metrics.REPLICA_LAG_SECONDS.set(replica.lag, replica.name)
+        if replica.lag > REPLICA_MAX_LAG:
+            replica.downUntil = replica.checked + REPLICA_CHECK_INTERVAL
+            metrics.REPLICA_FAILURES.inc(replica.name, "lagging")
+            logger.warning("replica %s lags %.1f s behind the primary, not used for %d s",
+                           replica.name, replica.lag, REPLICA_CHECK_INTERVAL)
+            return False
+        return True
+
+    # Record that a replica could not be reached or failed a query.
+    def failed(self, replica, error):
+        replica.downUntil = time.monotonic() + REPLICA_RETRY_DELAY
+        # (checked again when it comes back)
+        replica.checked = None
+        metrics.REPLICA_FAILURES.inc(replica.name, "down")
+        logger.warning("replica %s failed, not used for %d s: %s",
+                       replica.name, REPLICA_RETRY_DELAY, str(error).strip())
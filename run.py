@@ -1,21 +1,195 @@
 #!/usr/bin/python
 
-from model import Model, init_db
+from model import Model, get_read_cache, get_statement_registry, InvalidCursor, PageTimeout
+from migrate import migrate
 from flask import *
 from forms import *
-from sqlite3 import IntegrityError
-app = Flask(__name__)
+from psycopg2 import IntegrityError
+import io
+import time
+import threading
+import click
+import logging
+import jobs
+import metrics
+import render
+import transcripts
+import views
+from werkzeug.datastructures import CombinedMultiDict
+from dotenv import load_dotenv
 
+# The pages, registered on the application by create_app(). Importing this
+# module neither reads the environment nor connects to the database, so that
+# a worker starts with the cost of its imports only.
+pages = Blueprint('pages', __name__, cli_group=None)
+
+
+# Create the application, for `flask --app run`, `python3 run.py` or a WSGI
+# server (e.g. gunicorn 'run:create_app()').
+def create_app():
+    load_dotenv()
+    app = Flask(__name__)
+    app.url_map.converters['int'] = views.IdConverter
+    app.register_blueprint(pages)
+    return app
+
+
+_schema_checked = False
+_schema_lock = threading.Lock()
+
+
+# Apply the pending migrations before the first request of the process, which
+# also opens the first connection of the pool (see model.get_pool()).
+# `flask --app run migrate` applies them beforehand, e.g. when deploying.
+@pages.before_app_request
+def checkSchema():
+    global _schema_checked
+    if not _schema_checked:
+        with _schema_lock:
+            if not _schema_checked:
+                migrate()
+                _schema_checked = True
+
+
+@pages.app_errorhandler(InvalidCursor)
+def invalidCursor(error):
+    return "Invalid page cursor", 400
+
+
+# A page whose statement took longer than PAGE_TIMEOUT (see model.query()).
+@pages.app_errorhandler(PageTimeout)
+def pageTimeout(error):
+    return "The database is too slow to answer, please retry later", 503
+
+
+# Measure each request in the metrics of the process (see metrics.py). A
+# streamed response is measured once it has been sent.
+@pages.before_app_request
+def startRequestMetrics():
+    g.requestMetrics = (metrics.start_request(), time.perf_counter())
+
+
+@pages.after_app_request
+def recordRequestMetrics(response):
+    if 'requestMetrics' not in g:
+        return response
+    stats, start = g.pop('requestMetrics')
+    labels = (request.url_rule.rule if request.url_rule else 'unmatched',
+              request.method, response.status_code)
+    if not response.is_streamed:
+        metrics.finish_request(stats, time.perf_counter() - start, *labels,
+                               response.calculate_content_length())
+        return response
+    size = [0]
+
+    def counted(chunks):
+        for chunk in chunks:
+            size[0] += len(chunk)
+            yield chunk
+    response.response = counted(response.iter_encoded())
+    response.call_on_close(lambda: metrics.finish_request(
+        stats, time.perf_counter() - start, *labels, size[0]))
+    return response
+
+
+# Validators of the GET pages, so that a client asking again for a page it
+# already has is answered 304 Not Modified without the body: the ETag is a
+# hash of the page, and its Last-Modified date the time at which the process
+# started to serve this version of it (see render.first_served()). The pages
+# must be validated again at each use (no-cache), as their date is not the
+# one of their data. A page whose tables were not written since is answered
+# 304 before being read and rendered (see render.served_page()).
+@pages.before_app_request
+def notModified():
+    if request.method != 'GET':
+        return None
+    g.servedSnapshot = render.served_snapshot()
+    page = render.served_page(request.full_path)
+    if page is None or not request.if_none_match.contains(page[0]):
+        return None
+    response = Response("", 304)
+    response.set_etag(page[0])
+    response.last_modified = page[1]
+    response.cache_control.no_cache = True
+    return response
+
+
+@pages.after_app_request
+def conditionalResponse(response):
+    if request.method != 'GET' or response.status_code != 200 or response.is_streamed:
+        return response
+    response.add_etag()
+    response.last_modified = render.first_served(request.full_path, response.get_etag()[0],
+                                                 metrics.current_request(), g.get('servedSnapshot'))
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+# The tables of listing.html are rendered by render.render_table().
+pages.add_app_template_global(render.render_table, 'render_table')
+
+
+# Render a template, recording the duration and size of the rendering in the
+# metrics of the process.
+def renderTemplate(name, **context):
+    start = time.perf_counter()
+    html = render_template(name, **context)
+    metrics.TEMPLATE_SECONDS.observe(time.perf_counter() - start, name)
+    metrics.TEMPLATE_CHARACTERS.observe(len(html), name)
+    return html
+
+
+# Return a streamed response of the rows yielded by the given export of
+# Model (see Model.stream()), as CSV with a header line or as NDJSON (one JSON
+# object per line) depending on fmt. The response is sent with chunked
+# transfer encoding as the rows are read, one chunk per batch of rows. With
+# ?background=1, the file is written by a job instead (see jobs.py), whose
+# page is shown at once.
+def exportResponse(fmt, filename, columns, export, *args):
+    if fmt not in views.EXPORT_FORMATS:
+        abort(404)
+    if request.args.get('background'):
+        try:
+            jobs.check('export', [fmt, filename, columns, export, *args])
+        except ValueError:
+            abort(404)
+        with Model() as model:
+            idJob = jobs.enqueue(model, 'export', fmt, filename, columns, export, *args)
+            return redirect(url_for('.showJob', id=idJob))
+
+    def generate():
+        yield views.exportHeader(fmt, columns)
+        with Model() as model:
+            for rows in getattr(model, export)(*args):
+                yield views.exportRows(fmt, columns, rows)
+
+    return Response(generate(), mimetype=views.EXPORT_FORMATS[fmt],
+                    headers=views.exportHeaders(filename, fmt))
+
+
+@pages.route('/')
+def index():
+    return renderTemplate('index.html')
 
-from dotenv import load_dotenv
 
-load_dotenv()
-init_db()
+# Counters of the cache shared by the requests of this process, to size it.
+@pages.route('/stats/cache/')
+def showCacheStats():
+    return jsonify(get_read_cache().stats())
 
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+# Metrics of this process in the text format of Prometheus (see metrics.py).
+@pages.route('/metrics')
+def showMetrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Counters of the prepared statements of this process (see statements.py),
+# with the plans of the ones prepared on the connection of this request.
+@pages.route('/stats/statements/')
+def showStatementStats():
+    with Model() as model:
+        return jsonify(dict(get_statement_registry().stats(), **model.planCacheStats()))
 
 
 ################################################################
@@ -23,7 +197,7 @@ def index():
 ################################################################
 
 
-@app.route('/person/', methods=['GET', 'POST'])
+@pages.route('/person/', methods=['GET', 'POST'])
 def showPersons():
     with Model() as model:
         form = PersonForm(request.form)
@@ -31,42 +205,51 @@ def showPersons():
             model.createPerson(form.lastname.data, form.firstname.data,
                                form.address.data, form.phone.data)
 
-        pers = model.listPersons()
-        keys = [
-            '', 'Lastname', 'Firstname', 'Address', 'Phone', '#Curriculums',
-            'Details', 'Delete'
-        ]
-        return render_template(
-            'listing.html',
-            to_list=[(pers, keys, "Persons")],
-            title='Persons',
-            forms=[form])
+        # (?q=<text> lists the persons found instead, see views.searchArgs())
+        text, size = views.searchArgs(request.args)
+        if text:
+            pers = model.searchPersons(text, size)
+        else:
+            pers = render.Query(model, 'listPersons', **views.pageArgs(request.args))
+        return renderTemplate('listing.html', forms=[form], **views.personsContext(pers, text))
+
+
+# The persons found by ?q=<text> (see Model.searchPersons()), as a JSON list
+# of {"id", "name", "phone"} objects, for the search boxes of the forms (at
+# most ?size=<persons>, default SEARCH_LIMIT).
+@pages.route('/person/search/')
+def searchPersons():
+    text, size = views.searchArgs(request.args)
+    if not text:
+        return jsonify([])
+    with Model() as model:
+        return jsonify([person._asdict() for person in model.searchPersons(text, size)])
 
 
-@app.route('/person/del/<id>/')
+# (with BACKGROUND_JOBS=1, the deletions run as jobs, see jobs.py)
+@pages.route('/person/del/<int:id>/')
 def delPerson(id=None):
     with Model() as model:
+        if jobs.in_background():
+            return redirect(url_for('.showJob', id=jobs.enqueue(model, 'deletePerson', id)))
         model.deletePerson(id)
-        return redirect(url_for('showPersons'))
+        return redirect(url_for('.showPersons'))
 
 
-@app.route('/person/<id>/', methods=['GET', 'POST'])
+@pages.route('/person/<int:id>/', methods=['GET', 'POST'])
 def showPerson(id=None):
     with Model() as model:
-        exams = model.listValidationsOfStudent(id)
-        curri = model.listCurriculumsOfStudent(id)
-        keys_exams = [
-            '', 'Date', 'Curriculum', 'Course', 'Validation', 'Grade'
-        ]
-        keys_curri = ['Curriculum Name', 'Grade']
-        return render_template(
-            'listing.html',
-            to_list=[
-                (curri, keys_curri, "Summary of " + model.getNameOfPerson(id)),
-                (exams, keys_exams,
-                 "Detailed grades of student " + model.getNameOfPerson(id))
-            ],
-            title='Person ' + model.getNameOfPerson(id))
+        page = model.personPage(id, **views.pageArgs(request.args))
+        if page is None:
+            abort(404)
+        return renderTemplate('listing.html', **views.personContext(page))
+
+
+@pages.route('/person/<int:id>/export.<fmt>')
+def exportPerson(id=None, fmt=None):
+    return exportResponse(fmt, f"grades-of-person-{id}", [
+        'validation', 'date', 'course', 'name', 'coefficient', 'grade'
+    ], 'exportGradesOfStudent', id)
 
 
 ################################################################
@@ -74,75 +257,95 @@ def showPerson(id=None):
 ################################################################
 
 
-@app.route('/curriculum/', methods=['GET', 'POST'])
+@pages.route('/curriculum/', methods=['GET', 'POST'])
 def showCurriculums():
     with Model() as model:
         form = CurriculumForm(request.form)
-        form.setNames()
+        form.setNames(model)
         if request.method == 'POST' and form.validate():
             model.createCurriculum(form.name.data, form.secretary.data,
                                    form.director.data)
-        pers = model.listCurriculums()
-        keys = [
-            '', 'Name', 'Director Lastname', 'Firstname', 'Secretary Lastname',
-            'Firstname', 'Details', 'Delete'
-        ]
-        return render_template(
-            'listing.html',
-            to_list=[(pers, keys, "Curriculums")],
-            title='Curriculums',
-            forms=[form])
-
-
-@app.route('/curriculum/del/<id>/')
+        return renderTemplate('listing.html', forms=[form],
+                              **views.curriculumsContext(render.Query(model, 'listCurriculums')))
+
+
+@pages.route('/curriculum/del/<int:id>/')
 def delCurriculum(id=None):
     with Model() as model:
         model.deleteCurriculum(id)
-        return redirect(url_for('showCurriculums'))
+        return redirect(url_for('.showCurriculums'))
 
 
-@app.route('/curriculum/<id>/', methods=['GET', 'POST'])
+@pages.route('/curriculum/<int:id>/', methods=['GET', 'POST'])
 def showCurriculum(id=None):
     with Model() as model:
         addStudentForm = SelectStudentForm(request.form)
-        addStudentForm.setNames()
+        addStudentForm.setNames(model)
         addCourseForm = SelectCourseForm(request.form)
-        addCourseForm.setNames()
+        addCourseForm.setNames(model)
         if request.method == 'POST':
             if addStudentForm.validate():
-                model.registerPersonToCurriculum(addStudentForm.student.data,
-                                                 id)
+                model.registerPersonsToCurriculum(addStudentForm.students.data,
+                                                  id)
             else:
                 if addCourseForm.validate():
                     model.registerCourseToCurriculum(addCourseForm.course.data,
                                                      id,
                                                      addCourseForm.ects.data)
                     addStudentForm = SelectStudentForm()
-                    addStudentForm.setNames()
-        avg = model.averageGradesOfStudentsInCurriculum(id)
-        cou = model.listCoursesOfCurriculum(id)
-        keys_avg = ['Lastname', 'Firstname', 'totalGrade']
-        keys_cou = [
-            '', 'Name', 'Teacher Lastname', 'Teacher Firstname', 'ECTS',
-            'Delete'
-        ]
-        return render_template(
-            'listing.html',
-            to_list=[
-                (avg, keys_avg, "Averaged grades of curriculum " +
-                 model.getNameOfCurriculum(id)),
-                (cou, keys_cou,
-                 "Courses of curriculum " + model.getNameOfCurriculum(id)),
-            ],
-            title='Curriculum ' + model.getNameOfCurriculum(id),
-            forms=[addStudentForm, addCourseForm])
-
-
-@app.route('/curriculum/<idCurr>/del/<idCou>/')
+                    addStudentForm.setNames(model)
+        page = model.curriculumPage(id)
+        if page is None:
+            abort(404)
+        return renderTemplate('listing.html', forms=[addStudentForm, addCourseForm],
+                              **views.curriculumContext(page))
+
+
+@pages.route('/curriculum/<int:id>/export.<fmt>')
+def exportCurriculum(id=None, fmt=None):
+    return exportResponse(fmt, f"averages-of-curriculum-{id}", [
+        'student', 'lastname', 'firstname', 'average'
+    ], 'exportAveragesOfCurriculum', id)
+
+
+# Recompute the averages of a curriculum in a job, whose page is shown.
+@pages.route('/curriculum/<int:id>/refresh/', methods=['POST'])
+def refreshCurriculum(id=None):
+    with Model() as model:
+        if model.getNameOfCurriculum(id) is None:
+            abort(404)
+        idJob = jobs.enqueue(model, 'refreshCurriculumAverages', id)
+        return redirect(url_for('.showJob', id=idJob), 303)
+
+
+# Write the transcripts of the students of a curriculum to a zip archive in
+# a job (see transcripts.py), whose page is shown.
+@pages.route('/curriculum/<int:id>/transcripts/', methods=['POST'])
+def writeTranscripts(id=None):
+    with Model() as model:
+        if model.getNameOfCurriculum(id) is None:
+            abort(404)
+        idJob = jobs.enqueue(model, 'transcripts', id)
+        return redirect(url_for('.showJob', id=idJob), 303)
+
+
+@pages.route('/curriculum/<int:id>/stats/')
+def showCurriculumStats(id=None):
+    with Model() as model:
+        data = model.curriculumGrades(id)
+        if data is None:
+            abort(404)
+        # (NumPy is imported by the first statistics page, not at startup)
+        import analytics
+        stats = analytics.curriculum_statistics(data)
+        return renderTemplate('listing.html', **views.statisticsContext(stats, 'ECTS', "courses"))
+
+
+@pages.route('/curriculum/<int:idCurr>/del/<int:idCou>/')
 def delCourseFromCurriculum(idCurr=None, idCou=None):
     with Model() as model:
         model.deleteCourseFromCurriculum(idCou, idCurr)
-        return redirect(url_for('showCurriculum', id=idCurr))
+        return redirect(url_for('.showCurriculum', id=idCurr))
 
 
 ################################################################
@@ -150,85 +353,239 @@ def delCourseFromCurriculum(idCurr=None, idCou=None):
 ################################################################
 
 
-@app.route('/course/', methods=['GET', 'POST'])
+@pages.route('/course/', methods=['GET', 'POST'])
 def showCourses():
     with Model() as model:
         addCourseForm = CourseForm(request.form)
-        addCourseForm.setNames()
+        addCourseForm.setNames(model)
         if request.method == 'POST' and addCourseForm.validate():
             model.createCourse(addCourseForm.name.data,
                                addCourseForm.teacher.data)
-        pers = model.listCourses()
-        keys = [
-            '', 'Name', '', 'Teacher lastname', 'Teacher firstname', 'Details',
-            'Delete'
-        ]
-        return render_template(
-            'listing.html',
-            to_list=[(pers, keys, "Courses")],
-            title='Courses',
-            forms=[addCourseForm])
-
-
-@app.route('/course/del/<id>/')
+        text, size = views.searchArgs(request.args)
+        if text:
+            courses = model.searchCourses(text, size)
+        else:
+            courses = render.Query(model, 'listCourses', **views.pageArgs(request.args))
+        return renderTemplate('listing.html', forms=[addCourseForm],
+                              **views.coursesContext(courses, text))
+
+
+# The courses found by ?q=<text> (see Model.searchCourses()), as a JSON list
+# of {"id", "name", "teacher"} objects (at most ?size=<courses>).
+@pages.route('/course/search/')
+def searchCourses():
+    text, size = views.searchArgs(request.args)
+    if not text:
+        return jsonify([])
+    with Model() as model:
+        return jsonify([course._asdict() for course in model.searchCourses(text, size)])
+
+
+@pages.route('/course/del/<int:id>/')
 def delCourse(id=None):
     with Model() as model:
+        if jobs.in_background():
+            return redirect(url_for('.showJob', id=jobs.enqueue(model, 'deleteCourse', id)))
         model.deleteCourse(id)
-        return redirect(url_for('showCourses'))
+        return redirect(url_for('.showCourses'))
 
 
-@app.route('/course/<id>/', methods=['GET', 'POST'])
+@pages.route('/course/<int:id>/', methods=['GET', 'POST'])
 def showCourse(id=None):
     with Model() as model:
         form = ValidationForm(request.form)
         if request.method == 'POST' and form.validate():
             model.addValidationToCourse(form.name.data, form.coef.data, form.date.data, id)
-        exams = model.listValidationsOfCourse(id)
-        grades = model.listGradesOfCourse(id)
-        curri = model.listCurriculumsOfCourse(id)
-        students = model.listStudentsOfCourse(id)
-        keys_grades = [
-            '', 'Date', 'Curriculum', 'Student lastname', 'Student firstname',
-            'Validation', 'Grade', 'Coef'
-        ]
-        keys_exams = ['', 'Date', 'Name', 'Coef', 'Details']
-        keys_curri = ['', 'Curriculum', 'ECTS']
-        keys_students = ['', 'Lastname', 'Firstname']
-        return render_template(
-            'listing.html',
-            to_list=[(curri, keys_curri,
-                      "Curriculums of course " + model.getNameOfCourse(id)),
-                     (exams, keys_exams,
-                      "List of exams for course " + model.getNameOfCourse(id)),
-                     (grades, keys_grades,
-                      "Grades of course " + model.getNameOfCourse(id)),
-                     (students, keys_students,
-                      "Students of course " + model.getNameOfCourse(id))],
-            forms=[form])
-
-
-@app.route('/course/<idCourse>/<idValidation>/', methods=['GET', 'POST'])
+        page = model.coursePage(id, **views.pageArgs(request.args))
+        if page is None:
+            abort(404)
+        return renderTemplate('listing.html', forms=[form], **views.courseContext(page))
+
+
+@pages.route('/course/<int:id>/export.<fmt>')
+def exportCourse(id=None, fmt=None):
+    return exportResponse(fmt, f"grades-of-course-{id}", [
+        'validation', 'name', 'date', 'coefficient', 'student', 'lastname',
+        'firstname', 'grade'
+    ], 'exportGradesOfCourse', id)
+
+
+@pages.route('/course/<int:id>/stats/')
+def showCourseStats(id=None):
+    with Model() as model:
+        data = model.courseGrades(id)
+        if data is None:
+            abort(404)
+        import analytics
+        stats = analytics.course_statistics(data)
+        return renderTemplate('listing.html', **views.statisticsContext(stats, 'Coef', "validations"))
+
+
+@pages.route('/course/<int:idCourse>/<int:idValidation>/', methods=['GET', 'POST'])
 def showValidation(idCourse=None, idValidation=None):
     with Model() as model:
         form = GradesForm(request.form)
-        form.setNames(idCourse)
-        if request.method == 'POST' and form.validate():
+        if request.method == 'POST':
+            form.setNames(model, idCourse)
+            if form.validate():
+                try:
+                    model.addGrade(idValidation, form.student.data,
+                                   str(form.grade.data))
+                except IntegrityError:
+                    form.student.errors.append("This student already has a grade!")
+
+        page = model.validationPage(idCourse, idValidation, **views.pageArgs(request.args))
+        if page is None:
+            abort(404)
+        # the students of the course were fetched by validationPage()
+        form.setNames(model, idCourse)
+        importForm = ImportGradesForm()
+        importForm.action = url_for('.importGrades', idCourse=idCourse,
+                                    idValidation=idValidation)
+        return renderTemplate('listing.html', forms=[form, importForm],
+                              **views.validationContext(page))
+
+
+@pages.route('/course/<int:idCourse>/<int:idValidation>/import/', methods=['GET', 'POST'])
+def importGrades(idCourse=None, idValidation=None):
+    form = ImportGradesForm(CombinedMultiDict((request.files, request.form)))
+    if request.method != 'POST' or not form.validate():
+        return redirect(url_for('.showValidation', idCourse=idCourse,
+                                idValidation=idValidation))
+    with Model() as model:
+        name = model.getNameOfValidation(idValidation, idCourse)
+        if name is None:
+            abort(404)
+        file = io.TextIOWrapper(form.file.data.stream, encoding='utf-8-sig')
+        try:
+            imported, errors = model.importGrades(idValidation, file,
+                                                  form.upsert.data)
+        except UnicodeDecodeError:
+            imported, errors = 0, views.NOT_UTF8_ERRORS
+        return renderTemplate('listing.html', **views.importContext(name, imported, errors))
+
+
+################################################################
+####              BACKGROUND JOBS                           ####
+################################################################
+
+
+# The jobs, the last ones first. POST {"kind": <kind>, "args": [...]} as JSON
+# to enqueue one (see jobs.JOBS): it is answered 202 Accepted with its ID and
+# the URL of its status, or 400 if its kind or arguments are invalid (see
+# jobs.check()).
+@pages.route('/jobs/', methods=['GET', 'POST'])
+def showJobs():
+    with Model() as model:
+        if request.method == 'POST':
             try:
-                model.addGrade(idValidation, form.student.data,
-                               str(form.grade.data))
-            except IntegrityError:
-                form.errors['student'] = ([
-                    "This student already has a grade!"
-                ])
-
-        grades = model.listGradesOfValidation(idValidation)
-        keys_grades = ['Grade', 'Firstname', 'Lastname']
-        return render_template(
-            'listing.html',
-            to_list=[(grades, keys_grades,
-                      "Grades of " + model.getNameOfValidation(idValidation))],
-            forms=[form])
+                kind, args = views.jobRequest(request.get_json(silent=True) or {})
+                jobs.check(kind, args)
+                idJob = jobs.enqueue(model, kind, *args)
+            except (ValueError, KeyError):
+                abort(400)
+            status = url_for('.showJobStatus', id=idJob)
+            return jsonify(id=idJob, status=status), 202, {'Location': status}
+        return renderTemplate('listing.html',
+                              **views.jobsContext(model.listJobs(**views.pageArgs(request.args))))
+
+
+@pages.route('/jobs/<int:id>/')
+def showJob(id=None):
+    with Model() as model:
+        job = model.getJob(id)
+        if job is None:
+            abort(404)
+        return renderTemplate('job.html', job=job, title=f'Job {id}')
+
+
+# The job as a JSON object (all the columns of Jobs, see 0007_jobs.sql).
+@pages.route('/jobs/<int:id>/status')
+def showJobStatus(id=None):
+    with Model() as model:
+        job = model.getJob(id)
+        if job is None:
+            abort(404)
+        return jsonify(job._asdict())
+
+
+# The result of a job done: the file it wrote, or its JSON value. A job not
+# done is answered 409 Conflict with its status.
+@pages.route('/jobs/<int:id>/result')
+def showJobResult(id=None):
+    with Model() as model:
+        job = model.getJob(id)
+    if job is None:
+        abort(404)
+    if job.status != 'done':
+        return jsonify(status=job.status, error=job.error), 409
+    if isinstance(job.result, dict) and 'file' in job.result:
+        return send_from_directory(jobs.setting('JOB_RESULTS_DIR'), job.result['file'],
+                                   as_attachment=True, download_name=job.result['name'])
+    return jsonify(job.result)
+
+
+# Cancel a job queued, or ask its worker to stop it if it runs.
+@pages.route('/jobs/<int:id>/cancel', methods=['POST'])
+def cancelJob(id=None):
+    with Model() as model:
+        if model.cancelJob(id) is None:
+            abort(404)
+        return redirect(url_for('.showJob', id=id), 303)
+
+
+################################################################
+####              MAINTENANCE COMMANDS                      ####
+################################################################
+
+
+# flask --app run migrate
+@pages.cli.command('migrate')
+def migrateCommand():
+    applied = migrate()
+    print(f"{len(applied)} migrations applied.")
+
+
+# flask --app run check-averages
+@pages.cli.command('check-averages')
+def checkAverages():
+    with Model() as model:
+        mismatches = model.checkAverages()
+        for (table, student, id, stored, expected) in mismatches:
+            print(f"{table}: student {student}, id {id}: stored {stored}, expected {expected}")
+        print(f"{len(mismatches)} stored averages differ from the grades.")
+
+
+# flask --app run refresh-averages
+@pages.cli.command('refresh-averages')
+def refreshAverages():
+    with Model() as model:
+        model.refreshAverages()
+        print("Averages recomputed!")
+
+
+# flask --app run jobs [--workers N]
+@pages.cli.command('jobs')
+@click.option('--workers', type=int, default=lambda: jobs.setting('JOB_WORKERS'),
+              help="Number of worker processes (default JOB_WORKERS).")
+def runJobs(workers):
+    logging.basicConfig(level=logging.INFO, format=jobs.LOG_FORMAT)
+    jobs.run_workers(workers)
+
+
+# flask --app run transcripts CURRICULUM OUTPUT [--workers N]
+@pages.cli.command('transcripts')
+@click.argument('curriculum', type=int)
+@click.argument('output')
+@click.option('--workers', type=int, help="Number of rendering processes (default TRANSCRIPT_WORKERS).")
+def writeTranscriptsCommand(curriculum, output, workers):
+    with Model() as model:
+        try:
+            count, seconds = transcripts.generate_transcripts(model, curriculum, output, workers)
+        except LookupError as error:
+            raise click.ClickException(str(error))
+        print(f"{count} transcripts in {seconds:.2f} s ({count / seconds:.0f} transcripts/s).")
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
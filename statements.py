@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+
+# The statements that can be prepared: PREPARE only accepts these.
+PREPARABLE = re.compile(r"\s*(SELECT|WITH|INSERT|UPDATE|DELETE|VALUES)\b", re.IGNORECASE)
+
+# The placeholders of psycopg2: %s, %(name)s, and %% for a literal %.
+PLACEHOLDER = re.compile(r"%\((\w+)\)s|%s|%%")
+
+# A statement of the registry: the query of psycopg2 it runs, as the SQL given
+# to PREPARE (with $1, $2... as parameters) and the EXECUTE to run instead of
+# it, with the same parameters as the query. prepareSql is None if the query
+# cannot be prepared.
+class Statement:
+    def __init__(self, query, withParams):
+        # (a query run with and without parameters is prepared twice: %% is
+        # only a literal % with parameters)
+        self.name = "s_" + hashlib.md5(query.encode() + (b"%" if withParams else b"")).hexdigest()[:16]
+        self.prepareSql = None
+        self.executeSql = None
+        if not PREPARABLE.match(query):
+            return
+        if not withParams:
+            # psycopg2 does not interpret the placeholders without parameters.
+            self.prepareSql = f"PREPARE {self.name} AS {query}"
+            self.executeSql = f"EXECUTE {self.name}"
+            return
+        names = []
+        positional = []
+
+        def replace(match):
+            if match.group(0) == "%%":
+                return "%"
+            if match.group(1) is None:
+                positional.append("%s")
+                return f"${len(positional)}"
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return f"${names.index(match.group(1)) + 1}"
+        sql = PLACEHOLDER.sub(replace, query)
+        if names and positional:
+            return
+        arguments = positional or [f"%({name})s" for name in names]
+        self.prepareSql = f"PREPARE {self.name} AS {sql}"
+        self.executeSql = f"EXECUTE {self.name} ({', '.join(arguments)})" if arguments else f"EXECUTE {self.name}"
+
+# A process-wide registry of the statements run by Model (see model.Cursor),
+# each of them prepared once per connection with PREPARE, then run by name
+# with EXECUTE: the server parses it only once, and can reuse its plan.
+#
+# Statements are registered by their query on first use. Those which cannot
+# be prepared (utility statements, parameters given as tuples, queries
+# rejected by PREPARE) are marked so, and run as they are. The registry holds
+# at most maxsize statements: the least recently used one is evicted beyond
+# it, and deallocated by each connection preparing it before the connection
+# prepares another one (see evicted()), so that the statements prepared on a
+# connection are bounded too.
+class StatementRegistry:
+    def __init__(self, enabled=True, maxsize=256):
+        self.enabled = enabled
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.statements = OrderedDict()
+        self.names = set()
+        self.prepares = 0
+        self.executes = 0
+        self.unprepared = 0
+        self.failures = 0
+        self.evictions = 0
+        self.deallocations = 0
+
+    # Return the Statement to run instead of the given query and parameters,
+    # or None if it must be run as it is.
+    def get(self, query, vars):
+        if not self.enabled or not isinstance(query, str):
+            return None
+        values = vars.values() if isinstance(vars, dict) else vars or ()
+        if any(isinstance(value, tuple) for value in values):
+            # Tuples are expanded by psycopg2 into a list of values.
+            return None
+        key = (query, vars is not None)
+        with self.lock:
+            statement = self.statements.get(key)
+            if statement is None:
+                statement = self.statements[key] = Statement(query, vars is not None)
+                self.names.add(statement.name)
+                while len(self.statements) > self.maxsize:
+                    _, evicted = self.statements.popitem(last=False)
+                    self.names.discard(evicted.name)
+                    self.evictions += 1
+            else:
+                self.statements.move_to_end(key)
+        if statement.prepareSql is None:
+            with self.lock:
+                self.unprepared += 1
+            return None
+        return statement
+
+    # Return the names, among the given ones of the statements prepared on a
+    # connection, of the statements evicted from the registry, to deallocate.
+    def evicted(self, prepared):
+        with self.lock:
+            return prepared - self.names
+
+    # Record that the given number of statements were deallocated.
+    def deallocated(self, count):
+        with self.lock:
+            self.deallocations += count
+
+    # Record that a statement was prepared on a connection.
+    def prepared(self):
+        with self.lock:
+            self.prepares += 1
+
+    # Record that a statement was run with EXECUTE.
+    def executed(self):
+        with self.lock:
+            self.executes += 1
+
+    # Record that PREPARE failed on a statement, which is run as it is from now on.
+    def failed(self, statement):
+        with self.lock:
+            statement.prepareSql = None
+            self.failures += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'statements': sum(1 for s in self.statements.values() if s.prepareSql is not None),
+                'prepares': self.prepares,
+                'executes': self.executes,
+                # EXECUTE of a statement already prepared on its connection,
+                # neither parsed nor planned again.
+                'hits': self.executes - self.prepares,
+                'unprepared': self.unprepared,
+                'failures': self.failures,
+                'maxsize': self.maxsize,
+                'evictions': self.evictions,
+                'deallocations': self.deallocations,
+            }
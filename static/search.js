@@ -0,0 +1,46 @@
+// Search box of the select fields of persons that do not list all the
+// persons (see PERSON_CHOICES_LIMIT in forms.py): as a name is typed, the
+// persons found by it (see Model.searchPersons()) are asked to the URL of
+// the data-search attribute of the field, and replace the persons listed,
+// except the ones already selected.
+document.querySelectorAll("select[data-search]").forEach(function (select) {
+  var input = document.createElement("input");
+  input.type = "search";
+  input.placeholder = "Search a name";
+  select.parentNode.insertBefore(input, select);
+
+  var timer = null;
+  var pending = null;
+
+  function search() {
+    var text = input.value.trim();
+    if (!text) {
+      return;
+    }
+    if (pending) {
+      pending.abort();
+    }
+    pending = new AbortController();
+    fetch(select.dataset.search + "?" + new URLSearchParams({q: text}), {signal: pending.signal})
+      .then(function (response) { return response.json(); })
+      .then(function (persons) {
+        Array.from(select.options).forEach(function (option) {
+          if (!option.selected) {
+            option.remove();
+          }
+        });
+        var listed = new Set(Array.from(select.options, function (option) { return option.value; }));
+        persons.forEach(function (person) {
+          if (!listed.has(String(person.id))) {
+            select.add(new Option(person.name, person.id));
+          }
+        });
+      })
+      .catch(function () {});
+  }
+
+  input.addEventListener("input", function () {
+    clearTimeout(timer);
+    timer = setTimeout(search, 200);
+  });
+});
@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+# Tests of the process-wide cache of the query results (see cache.py). They
+# need no database:
+#
+#   python3 -m unittest discover tests
+
+import unittest
+from unittest import mock
+import cache
+from cache import ReadCache
+
+class ReadCacheTest(unittest.TestCase):
+    def put(self, readCache, key, value, tables):
+        readCache.put(key, value, tables, readCache.version(tables))
+
+    def test_get_put(self):
+        readCache = ReadCache()
+        self.assertEqual(readCache.get('persons'), (False, None))
+        self.put(readCache, 'persons', [1, 2], ['Persons'])
+        self.assertEqual(readCache.get('persons'), (True, [1, 2]))
+        self.assertEqual((readCache.stats()['hits'], readCache.stats()['misses']), (1, 1))
+
+    def test_invalidate(self):
+        readCache = ReadCache()
+        self.put(readCache, 'persons', [1], ['Persons', 'CurriculumPerson'])
+        self.put(readCache, 'courses', [2], ['Courses'])
+        readCache.invalidate(['CurriculumPerson'])
+        self.assertEqual(readCache.get('persons'), (False, None))
+        self.assertEqual(readCache.get('courses'), (True, [2]))
+
+    # A result read before a write of its tables may be stale: it is not kept.
+    def test_put_after_invalidate(self):
+        readCache = ReadCache()
+        version = readCache.version(['Persons', 'Courses'])
+        readCache.invalidate(['Courses'])
+        readCache.put('courses', [1], ['Persons', 'Courses'], version)
+        self.assertEqual(readCache.get('courses'), (False, None))
+        self.put(readCache, 'courses', [1], ['Persons', 'Courses'])
+        self.assertEqual(readCache.get('courses'), (True, [1]))
+
+    def test_put_after_unrelated_invalidate(self):
+        readCache = ReadCache()
+        version = readCache.version(['Persons'])
+        readCache.invalidate(['Courses'])
+        readCache.put('persons', [1], ['Persons'], version)
+        self.assertEqual(readCache.get('persons'), (True, [1]))
+
+    def test_put_after_clear(self):
+        readCache = ReadCache()
+        version = readCache.version(['Persons'])
+        readCache.clear()
+        readCache.put('persons', [1], ['Persons'], version)
+        self.assertEqual(readCache.get('persons'), (False, None))
+
+    def test_ttl(self):
+        readCache = ReadCache(ttl=60)
+        with mock.patch('time.monotonic', return_value=1000):
+            self.put(readCache, 'persons', [1], ['Persons'])
+        with mock.patch('time.monotonic', return_value=1059):
+            self.assertEqual(readCache.get('persons'), (True, [1]))
+        with mock.patch('time.monotonic', return_value=1061):
+            self.assertEqual(readCache.get('persons'), (False, None))
+        self.assertEqual(readCache.stats()['evictions'], 1)
+
+    def test_least_recently_used(self):
+        readCache = ReadCache(maxsize=2)
+        self.put(readCache, 'a', 1, ['Persons'])
+        self.put(readCache, 'b', 2, ['Persons'])
+        readCache.get('a')
+        self.put(readCache, 'c', 3, ['Persons'])
+        self.assertEqual(readCache.get('b'), (False, None))
+        self.assertEqual(readCache.get('a'), (True, 1))
+        self.assertEqual(readCache.get('c'), (True, 3))
+
+class CascadeTest(unittest.TestCase):
+    def test_cascade(self):
+        self.assertEqual(cache.cascade(['Validations']), {'Validations', 'Grades'})
+        self.assertEqual(cache.cascade(['Curriculums']),
+                         {'Curriculums', 'CurriculumPerson', 'CourseCurriculum', 'CurriculumAverages'})
+        self.assertEqual(cache.cascade(['Grades']), {'Grades'})
+
+
+if __name__ == '__main__':
+    unittest.main()
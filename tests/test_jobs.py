@@ -0,0 +1,49 @@
+#!/usr/bin/python
+
+# Tests of the checks of the kinds and arguments of the jobs given to
+# POST /jobs/ (see check() in jobs.py). They need no database:
+#
+#   python3 -m unittest discover tests
+
+import unittest
+from types import SimpleNamespace
+import jobs
+
+class CheckTest(unittest.TestCase):
+    export = ['csv', 'grades-of-course-3', ['validation', 'grade'], 'exportGradesOfCourse']
+
+    def test_valid(self):
+        jobs.check('refreshAverages', [])
+        jobs.check('transcripts', [12])
+        jobs.check('deletePerson', ["7"])
+        jobs.check('export', self.export + [3])
+
+    def test_unknown_kind(self):
+        for kind in ('dropDatabase', None, ['export']):
+            with self.assertRaises(KeyError):
+                jobs.check(kind, [])
+
+    def test_arguments(self):
+        for (kind, args) in [('refreshAverages', [1]), ('transcripts', []), ('transcripts', [1, 2]),
+                             ('transcripts', ["1; DROP"]), ('deletePerson', [True]), ('deleteCourse', [1.5])]:
+            with self.assertRaises(ValueError):
+                jobs.check(kind, args)
+
+    def test_export(self):
+        for (position, value) in [(0, 'xml'), (1, '../../etc/passwd'), (1, 'a/b'), (1, 'a.csv'), (1, ''),
+                                  (2, 'validation'), (2, [1]), (3, 'listPersons'), (3, 'exportNothing')]:
+            args = self.export + [3]
+            args[position] = value
+            with self.assertRaises(ValueError):
+                jobs.check('export', args)
+        with self.assertRaises(ValueError):
+            jobs.check('export', self.export + ["3/.."])
+        with self.assertRaises(ValueError):
+            jobs.check('export', self.export)
+
+    def test_result_path(self):
+        path = jobs.result_path(SimpleNamespace(idJob=5), "../../x.csv")
+        self.assertEqual(path, jobs.os.path.join(jobs.setting('JOB_RESULTS_DIR'), "5-x.csv"))
+
+if __name__ == '__main__':
+    unittest.main()
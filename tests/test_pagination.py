@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+# Tests of the pagination of the lists of Model by cursors (see paginate_sql()
+# and build_page() in model.py). They need no database:
+#
+#   python3 -m unittest discover tests
+
+import base64
+import unittest
+from model import InvalidCursor, encode_cursor, decode_cursor, paginate_sql, build_page, record_type
+
+def tampered(text):
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+class CursorTest(unittest.TestCase):
+    def test_round_trip(self):
+        self.assertEqual(decode_cursor(encode_cursor(['Martin', 12, None, 1.5])), ['Martin', 12, None, 1.5])
+
+    def test_invalid(self):
+        for cursor in ("not a cursor!", "bm90IGpzb24=", tampered("{'a': 1}"), "", tampered("\xff")):
+            with self.assertRaises(InvalidCursor):
+                decode_cursor(cursor)
+
+    def test_not_list(self):
+        for text in ('{"id": 1}', '12', '"Martin"', 'null'):
+            with self.assertRaises(InvalidCursor):
+                decode_cursor(tampered(text))
+
+    def test_not_scalar(self):
+        for text in ('[{"id": 1}]', '[[1, 2]]'):
+            with self.assertRaises(InvalidCursor):
+                decode_cursor(tampered(text))
+
+class PaginateTest(unittest.TestCase):
+    sql = "SELECT id, lastname FROM Persons WHERE kind = %s"
+
+    def test_first_page(self):
+        self.assertEqual(paginate_sql(self.sql, ('student',), ['lastname', 'id'], limit=20),
+                         (f"SELECT * FROM ({self.sql}) AS Rows ORDER BY lastname ASC, id ASC LIMIT %s",
+                          ('student', 21)))
+
+    def test_all_rows(self):
+        sql, params = paginate_sql(self.sql, ('student',), ['id'], descending=True)
+        self.assertEqual(sql, f"SELECT * FROM ({self.sql}) AS Rows ORDER BY id DESC")
+
+    def test_after(self):
+        after = encode_cursor(['Martin', 12])
+        self.assertEqual(paginate_sql(self.sql, ('student',), ['lastname', 'id'], limit=20, after=after),
+                         (f"SELECT * FROM ({self.sql}) AS Rows WHERE (lastname, id) > (%s, %s)"
+                          " ORDER BY lastname ASC, id ASC LIMIT %s", ('student', 'Martin', 12, 21)))
+
+    # (the previous page is fetched backwards from the cursor)
+    def test_before(self):
+        before = encode_cursor([12])
+        self.assertEqual(paginate_sql(self.sql, ('student',), ['id'], limit=20, before=before),
+                         (f"SELECT * FROM ({self.sql}) AS Rows WHERE (id) < (%s) ORDER BY id DESC LIMIT %s",
+                          ('student', 12, 21)))
+
+    def test_descending(self):
+        cursor = encode_cursor([12])
+        sql, params = paginate_sql(self.sql, ('student',), ['id'], descending=True, limit=20, after=cursor)
+        self.assertEqual(sql, f"SELECT * FROM ({self.sql}) AS Rows WHERE (id) < (%s) ORDER BY id DESC LIMIT %s")
+        sql, params = paginate_sql(self.sql, ('student',), ['id'], descending=True, limit=20, before=cursor)
+        self.assertEqual(sql, f"SELECT * FROM ({self.sql}) AS Rows WHERE (id) > (%s) ORDER BY id ASC LIMIT %s")
+
+    def test_wrong_number_of_values(self):
+        with self.assertRaises(InvalidCursor):
+            paginate_sql(self.sql, ('student',), ['lastname', 'id'], limit=20, after=encode_cursor([12]))
+
+    def test_tampered_cursor(self):
+        with self.assertRaises(InvalidCursor):
+            paginate_sql(self.sql, ('student',), ['id'], limit=20, after=tampered('[{"id": 12}]'))
+
+class BuildPageTest(unittest.TestCase):
+    Row = record_type(('id',))
+
+    def rows(self, *ids):
+        return [self.Row(id) for id in ids]
+
+    def test_first_page(self):
+        page = build_page(self.rows(1, 2, 3), ['id'], limit=2)
+        self.assertEqual(page, self.rows(1, 2))
+        self.assertEqual(decode_cursor(page.nextCursor), [2])
+        self.assertIsNone(page.prevCursor)
+
+    def test_last_page(self):
+        page = build_page(self.rows(3, 4), ['id'], limit=2, after=encode_cursor([2]))
+        self.assertIsNone(page.nextCursor)
+        self.assertEqual(decode_cursor(page.prevCursor), [3])
+
+    def test_before(self):
+        page = build_page(self.rows(4, 3, 2), ['id'], limit=2, before=encode_cursor([5]))
+        self.assertEqual(page, self.rows(3, 4))
+        self.assertEqual(decode_cursor(page.nextCursor), [4])
+        self.assertEqual(decode_cursor(page.prevCursor), [3])
+        page = build_page(self.rows(2, 1), ['id'], limit=2, before=encode_cursor([3]))
+        self.assertIsNone(page.prevCursor)
+
+    def test_no_limit(self):
+        page = build_page(self.rows(1, 2), ['id'], total=2)
+        self.assertEqual(page, self.rows(1, 2))
+        self.assertEqual((page.nextCursor, page.prevCursor, page.total), (None, None, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+
+# Tests of the rendering of the tables of listing.html and of the validators
+# of the pages (see render.py). They need no database:
+#
+#   python3 -m unittest discover tests
+
+import asyncio
+import contextvars
+import unittest
+import cache
+import metrics
+import model
+import render
+
+# A stand-in for Model with a shared list (see model.query()) and another
+# one, counting the times they are read.
+class FakeModel:
+    def __init__(self):
+        self.reads = 0
+
+    def listPersons(self, limit=None, after=None):
+        self.reads += 1
+        return [(1, 'Martin <Jean>'), (2, 'Durand')][:limit]
+    listPersons.reads = ("Persons", "CurriculumPerson")
+    listPersons.shared = True
+
+    def listGrades(self):
+        self.reads += 1
+        return [(1, 12.5)]
+    listGrades.reads = ("Grades",)
+    listGrades.shared = False
+
+class FakeAsyncModel(FakeModel):
+    async def listPersons(self, limit=None, after=None):
+        return FakeModel.listPersons(self, limit, after)
+    listPersons.reads = FakeModel.listPersons.reads
+    listPersons.shared = True
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.readCache = model._read_cache
+        model._read_cache = cache.ReadCache()
+        render._fragment_cache = None
+        render._served_pages = None
+
+    def tearDown(self):
+        model._read_cache = self.readCache
+        render._fragment_cache = None
+        render._served_pages = None
+
+class RenderTableTest(CacheTest):
+    keys = ['Details', 'Name']
+
+    def lookups(self, result):
+        return metrics.FRAGMENT_CACHE_LOOKUPS.series.get((result,), 0)
+
+    def test_rows(self):
+        html = render.render_table([(1, 'Martin <Jean>')], self.keys, 'Persons')
+        self.assertIn('<td>Martin &lt;Jean&gt;</td>', html)
+        self.assertEqual(render.get_fragment_cache().stats()['size'], 0)
+
+    def test_hit(self):
+        fake = FakeModel()
+        hits, misses = self.lookups("hit"), self.lookups("miss")
+        html = render.render_table(render.Query(fake, 'listPersons', limit=2), self.keys, 'Persons')
+        self.assertIn('<td>Martin &lt;Jean&gt;</td>', html)
+        self.assertEqual(render.render_table(render.Query(fake, 'listPersons', limit=2), self.keys, 'Persons'), html)
+        self.assertEqual(fake.reads, 1)
+        self.assertEqual((self.lookups("hit") - hits, self.lookups("miss") - misses), (1, 1))
+
+    def test_arguments(self):
+        fake = FakeModel()
+        render.render_table(render.Query(fake, 'listPersons', limit=2), self.keys, 'Persons')
+        render.render_table(render.Query(fake, 'listPersons', limit=1), self.keys, 'Persons')
+        render.render_table(render.Query(fake, 'listPersons', limit=2, after='x'), self.keys, 'Persons')
+        render.render_table(render.Query(fake, 'listPersons', limit=2), self.keys, 'Persons found')
+        self.assertEqual(fake.reads, 4)
+
+    def test_invalidated(self):
+        fake = FakeModel()
+        query = render.Query(fake, 'listPersons')
+        render.render_table(query, self.keys, 'Persons')
+        model.get_read_cache().invalidate(['Grades'])
+        render.render_table(query, self.keys, 'Persons')
+        self.assertEqual(fake.reads, 1)
+        model.get_read_cache().invalidate(cache.cascade(['Curriculums']))
+        render.render_table(query, self.keys, 'Persons')
+        self.assertEqual(fake.reads, 2)
+        model.get_read_cache().clear()
+        render.render_table(query, self.keys, 'Persons')
+        self.assertEqual(fake.reads, 3)
+
+    def test_not_shared(self):
+        fake = FakeModel()
+        for _ in range(2):
+            render.render_table(render.Query(fake, 'listGrades'), ['', 'Grade'], 'Grades')
+        self.assertEqual(fake.reads, 2)
+
+    def test_async(self):
+        fake = FakeAsyncModel()
+        html = asyncio.run(render.render_table(render.Query(fake, 'listPersons'), self.keys, 'Persons'))
+        self.assertIn('<td>Durand</td>', html)
+        self.assertEqual(render.render_table(render.Query(fake, 'listPersons'), self.keys, 'Persons'), html)
+        self.assertEqual(fake.reads, 1)
+
+class FirstServedTest(CacheTest):
+    def stats(self, *tables, replica=False):
+        stats = metrics.RequestStats()
+        stats.read(tables, replica)
+        return stats
+
+    def test_stable(self):
+        stats = self.stats('Persons')
+        served = render.first_served('/person/', 'abc', stats, render.served_snapshot())
+        self.assertEqual(render.first_served('/person/', 'abc', stats, render.served_snapshot()), served)
+        self.assertGreaterEqual(render.first_served('/person/', 'def', stats, render.served_snapshot()), served)
+        self.assertNotEqual(render.first_served('/person/', 'def', stats, render.served_snapshot()), 0)
+
+    def test_served_page(self):
+        served = render.first_served('/person/', 'abc', self.stats('Persons'), render.served_snapshot())
+        self.assertEqual(render.served_page('/person/'), ('abc', served))
+        model.get_read_cache().invalidate(['Persons'])
+        self.assertIsNone(render.served_page('/person/'))
+
+    def test_written_while_rendered(self):
+        snapshot = render.served_snapshot()
+        model.get_read_cache().invalidate(['Persons'])
+        render.first_served('/person/', 'abc', self.stats('Persons'), snapshot)
+        self.assertIsNone(render.served_page('/person/'))
+
+    # The page is served again with the fragment of its list found: it still
+    # depends on the tables of the list.
+    def test_fragment_found(self):
+        fake = FakeModel()
+
+        def serve(url):
+            stats = metrics.start_request()
+            snapshot = render.served_snapshot()
+            render.render_table(render.Query(fake, 'listPersons'), ['Name'], 'Persons')
+            return render.first_served(url, 'abc', stats, snapshot)
+        contextvars.copy_context().run(serve, '/person/')
+        served = contextvars.copy_context().run(serve, '/person/?size=100')
+        self.assertEqual(fake.reads, 1)
+        self.assertEqual(render.served_page('/person/?size=100'), ('abc', served))
+        model.get_read_cache().invalidate(['CurriculumPerson'])
+        self.assertIsNone(render.served_page('/person/?size=100'))
+
+    def test_not_early(self):
+        for (url, stats) in [('/person/1/', self.stats('Persons', 'Grades')),
+                             ('/person/?q=a', self.stats('Persons', replica=True)),
+                             ('/metrics', self.stats())]:
+            served = render.first_served(url, 'abc', stats, render.served_snapshot())
+            self.assertIsNone(render.served_page(url))
+            self.assertEqual(render.first_served(url, 'abc', stats, render.served_snapshot()), served)
+
+
+if __name__ == '__main__':
+    unittest.main()
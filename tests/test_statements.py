@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+# Tests of the rewriting of the queries of Model into prepared statements (see
+# statements.py). They need no database:
+#
+#   python3 -m unittest discover tests
+
+import unittest
+from statements import Statement, StatementRegistry
+from model import paginate_sql
+
+class StatementTest(unittest.TestCase):
+    def test_positional_parameters(self):
+        statement = Statement("SELECT * FROM Persons WHERE id = %s AND lastname = %s", True)
+        self.assertEqual(statement.prepareSql,
+                         f"PREPARE {statement.name} AS SELECT * FROM Persons WHERE id = $1 AND lastname = $2")
+        self.assertEqual(statement.executeSql, f"EXECUTE {statement.name} (%s, %s)")
+
+    def test_repeated_named_parameters(self):
+        statement = Statement("SELECT %(id)s, %(name)s WHERE %(id)s > 0", True)
+        self.assertEqual(statement.prepareSql, f"PREPARE {statement.name} AS SELECT $1, $2 WHERE $1 > 0")
+        self.assertEqual(statement.executeSql, f"EXECUTE {statement.name} (%(id)s, %(name)s)")
+
+    # (psycopg2 refuses them, so they are run as they are)
+    def test_mixed_parameters(self):
+        statement = Statement("SELECT %s, %(id)s", True)
+        self.assertIsNone(statement.prepareSql)
+        self.assertIsNone(statement.executeSql)
+
+    def test_percent_with_parameters(self):
+        statement = Statement("SELECT '100%%' || %s", True)
+        self.assertEqual(statement.prepareSql, f"PREPARE {statement.name} AS SELECT '100%' || $1")
+        self.assertEqual(statement.executeSql, f"EXECUTE {statement.name} (%s)")
+
+    # (psycopg2 sends the query as it is without parameters)
+    def test_percent_without_parameters(self):
+        statement = Statement("SELECT '100%%'", False)
+        self.assertEqual(statement.prepareSql, f"PREPARE {statement.name} AS SELECT '100%%'")
+        self.assertEqual(statement.executeSql, f"EXECUTE {statement.name}")
+
+    def test_empty_parameters(self):
+        statement = Statement("SELECT 1", True)
+        self.assertEqual(statement.prepareSql, f"PREPARE {statement.name} AS SELECT 1")
+        self.assertEqual(statement.executeSql, f"EXECUTE {statement.name}")
+
+    def test_names(self):
+        self.assertEqual(Statement("SELECT %s", True).name, Statement("SELECT %s", True).name)
+        self.assertNotEqual(Statement("SELECT %s", True).name, Statement("SELECT %s + 1", True).name)
+        self.assertNotEqual(Statement("SELECT '%%'", True).name, Statement("SELECT '%%'", False).name)
+
+    def test_not_preparable(self):
+        for query in ("SET search_path = %s", "LISTEN cache", "COPY Grades FROM STDIN"):
+            self.assertIsNone(Statement(query, True).prepareSql)
+
+class StatementRegistryTest(unittest.TestCase):
+    def test_registered_once(self):
+        registry = StatementRegistry()
+        statement = registry.get("SELECT %s", (1,))
+        self.assertIs(registry.get("SELECT %s", (2,)), statement)
+        self.assertIsNot(registry.get("SELECT %s", None), statement)
+
+    # (the pages of every size run the same statement)
+    def test_page_sizes(self):
+        registry = StatementRegistry()
+        statement = registry.get(*paginate_sql("SELECT id FROM Persons", (), ['id'], limit=20))
+        self.assertIs(registry.get(*paginate_sql("SELECT id FROM Persons", (), ['id'], limit=1000)), statement)
+        self.assertEqual(registry.stats()['statements'], 1)
+
+    def test_evicted(self):
+        registry = StatementRegistry(maxsize=2)
+        first = registry.get("SELECT %s", (1,))
+        second = registry.get("SELECT %s + 1", (1,))
+        registry.get("SELECT %s", (1,))
+        registry.get("SELECT %s + 2", (1,))
+        self.assertEqual(registry.evicted({first.name, second.name}), {second.name})
+        self.assertEqual(registry.stats()['statements'], 2)
+        self.assertEqual(registry.stats()['evictions'], 1)
+
+    # (psycopg2 expands a tuple into a list of values, e.g. for IN %s)
+    def test_tuple_parameters(self):
+        registry = StatementRegistry()
+        self.assertIsNone(registry.get("SELECT * FROM Persons WHERE id IN %s", ((1, 2),)))
+        self.assertIsNone(registry.get("SELECT * FROM Persons WHERE id IN %(ids)s", {'ids': (1, 2)}))
+
+    def test_not_text(self):
+        self.assertIsNone(StatementRegistry().get(b"SELECT 1", None))
+
+    def test_disabled(self):
+        self.assertIsNone(StatementRegistry(enabled=False).get("SELECT %s", (1,)))
+
+    def test_failed(self):
+        registry = StatementRegistry()
+        statement = registry.get("SELECT %s", (1,))
+        registry.failed(statement)
+        self.assertIsNone(registry.get("SELECT %s", (1,)))
+        self.assertEqual(registry.stats()['failures'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
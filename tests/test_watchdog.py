@@ -0,0 +1,38 @@
+#!/usr/bin/python
+
+# Tests of the watchdog cancelling the pages over their timeout (see
+# model.Watchdog). They need no database:
+#
+#   python3 -m unittest discover tests
+
+import threading
+import unittest
+from model import Watchdog
+
+class WatchdogTest(unittest.TestCase):
+    def test_expired(self):
+        watchdog = Watchdog()
+        cancelled = threading.Event()
+        token = watchdog.watch(0.01, cancelled.set)
+        self.assertTrue(cancelled.wait(1))
+        self.assertTrue(watchdog.unwatch(token))
+
+    def test_unwatched(self):
+        watchdog = Watchdog()
+        cancelled = threading.Event()
+        token = watchdog.watch(0.05, cancelled.set)
+        self.assertFalse(watchdog.unwatch(token))
+        self.assertFalse(cancelled.wait(0.1))
+
+    # (the first deadline is not delayed by a later, longer one)
+    def test_several(self):
+        watchdog = Watchdog()
+        first, second = threading.Event(), threading.Event()
+        watchdog.watch(10, second.set)
+        watchdog.watch(0.01, first.set)
+        self.assertTrue(first.wait(1))
+        self.assertFalse(second.is_set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+
+import os
+import re
+import sys
+import time
+import zipfile
+import argparse
+import collections
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+import jinja2
+from model import Model
+
+# Batch generation of the transcripts of the students of a curriculum: one
+# HTML document per student, with what the page of the student shows (the
+# averages of their curriculums and all their grades), written to a
+# directory or to a zip archive:
+#
+#   python3 transcripts.py CURRICULUM transcripts.zip [--workers N]
+#
+# or as a job (see jobs.py), from POST /curriculum/<id>/transcripts/. The
+# data of all the students is read by a single statement (see
+# Model.exportTranscriptsOfCurriculum()), by batches, instead of the queries
+# of one page per student. The documents are rendered by chunks of
+# TRANSCRIPT_CHUNK_SIZE students in a pool of processes, one per CPU core by
+# default, while the next rows are read and the rendered documents written.
+
+# Number of processes rendering the transcripts (0: one per CPU core, 1: in
+# this process, without a pool), overridden by the TRANSCRIPT_WORKERS
+# environment variable.
+TRANSCRIPT_WORKERS = 0
+
+# Number of transcripts rendered by a task of the pool.
+TRANSCRIPT_CHUNK_SIZE = 50
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+_template = None
+
+# Return the template of the transcripts, loaded once by each process.
+def get_template():
+    global _template
+    if _template is None:
+        environment = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATES_DIR), autoescape=True)
+        _template = environment.get_template("transcript.html")
+    return _template
+
+# Return the file name of the transcript of a student.
+def transcript_name(id, lastname, firstname):
+    return re.sub(r"[^\w-]+", "_", f"{lastname}-{firstname}") + f"-{id}.html"
+
+# Return the (file name, HTML as bytes) of the transcripts of the given rows
+# of Model.exportTranscriptsOfCurriculum() (run by the processes of the pool).
+def render_transcripts(curriculum, rows):
+    template = get_template()
+    return [(transcript_name(id, lastname, firstname),
+             template.render(id=id, lastname=lastname, firstname=firstname, curriculum=curriculum,
+                             curriculums=curriculums, grades=grades).encode())
+            for (id, lastname, firstname, _, curriculums, grades) in rows]
+
+# Stand-in for the pool rendering the transcripts in this process.
+class InlineExecutor:
+    def submit(self, function, *args):
+        future = Future()
+        future.set_result(function(*args))
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+# Writes the transcripts to a directory, or to a zip archive given by its path
+# (ending with .zip) or as a binary file (which needs not be seekable, e.g.
+# the standard output).
+class TranscriptWriter:
+    def __init__(self, output):
+        self.directory = None
+        self.archive = None
+        if isinstance(output, str) and not output.endswith(".zip"):
+            os.makedirs(output, exist_ok=True)
+            self.directory = output
+        else:
+            self.archive = zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED)
+
+    def write(self, name, data):
+        if self.archive is not None:
+            self.archive.writestr(name, data)
+        else:
+            with open(os.path.join(self.directory, name), "wb") as file:
+                file.write(data)
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+
+# Write the transcripts of the students of a curriculum to output (see
+# TranscriptWriter), rendered by the given number of processes (see
+# TRANSCRIPT_WORKERS). progress(done, total) is called after each chunk of
+# transcripts written. Return the number of transcripts written and the
+# number of seconds taken. Raise LookupError if the curriculum does not exist.
+def generate_transcripts(model, idCurriculum, output, workers=None, progress=None):
+    start = time.perf_counter()
+    curriculum = model.getNameOfCurriculum(idCurriculum)
+    if curriculum is None:
+        raise LookupError(f"no curriculum {idCurriculum}")
+    if workers is None:
+        workers = int(os.getenv('TRANSCRIPT_WORKERS', TRANSCRIPT_WORKERS))
+    workers = workers or os.cpu_count()
+    if workers > 1:
+        executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+    else:
+        executor = InlineExecutor()
+    writer = TranscriptWriter(output)
+    # (at most two chunks per process are rendered or waiting to be written,
+    # so that the memory used does not depend on the number of students)
+    pending = collections.deque()
+    done = total = 0
+
+    def write_next():
+        nonlocal done
+        for (name, data) in pending.popleft().result():
+            writer.write(name, data)
+            done += 1
+        if progress:
+            progress(done, total)
+
+    try:
+        for rows in model.exportTranscriptsOfCurriculum(idCurriculum):
+            total = rows[0][3]
+            for index in range(0, len(rows), TRANSCRIPT_CHUNK_SIZE):
+                pending.append(executor.submit(render_transcripts, curriculum,
+                                               rows[index:index + TRANSCRIPT_CHUNK_SIZE]))
+                while len(pending) > 2 * workers:
+                    write_next()
+        while pending:
+            write_next()
+    finally:
+        executor.shutdown(cancel_futures=True)
+        writer.close()
+    return done, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Write the transcripts of the students of a curriculum.")
+    parser.add_argument("curriculum", type=int, help="id of the curriculum")
+    parser.add_argument("output", help="directory, or zip archive (.zip, or - for the standard output)")
+    parser.add_argument("--workers", type=int, help="number of rendering processes (default TRANSCRIPT_WORKERS)")
+    options = parser.parse_args()
+
+    def report(done, total):
+        print(f"\r{done}/{total} transcripts", end="", file=sys.stderr, flush=True)
+
+    with Model() as model:
+        output = sys.stdout.buffer if options.output == "-" else options.output
+        try:
+            count, seconds = generate_transcripts(model, options.curriculum, output, options.workers, report)
+        except LookupError as error:
+            parser.error(str(error))
+    print(f"\n{count} transcripts in {seconds:.2f} s ({count / seconds:.0f} transcripts/s).", file=sys.stderr)
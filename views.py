@@ -0,0 +1,231 @@
+#!/usr/bin/python
+
+from model import PAGE_SIZE, SEARCH_LIMIT
+from decimal import Decimal
+from werkzeug.routing import IntegerConverter
+import csv
+import io
+import json
+
+# The logic of the pages shared by run.py (Flask, on Model) and asgi.py
+# (Quart, on AsyncModel): the arguments read from the query strings, the
+# tables shown by listing.html given the results of the queries, the
+# encoding of the exports, and the converter of the IDs of the routes. The
+# routes of both only read the request, call the database and answer with
+# these; nothing here touches either. The rows of a table can be given as a
+# render.Query, read only if its fragment is not cached.
+
+# Maximum number of rows per page a request can ask for.
+MAX_PAGE_SIZE = 1000
+
+# Largest ID of a row (the ids are SERIAL columns).
+MAX_ID = 2**31 - 1
+
+# The converter of the IDs of the routes (<int:id>), registered by the
+# applications as the one of int: an ID out of the range of the ids does not
+# match, so that the page answers 404 instead of failing in the database.
+class IdConverter(IntegerConverter):
+    def __init__(self, map, *args, **kwargs):
+        kwargs.setdefault('max', MAX_ID)
+        super().__init__(map, *args, **kwargs)
+
+# The formats of the exports and their MIME types.
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+# The report of an import of grades from a file which is not UTF-8 text.
+NOT_UTF8_ERRORS = [(0, None, "The file is not UTF-8 text")]
+
+
+# Return the pagination arguments of the list methods of Model given in the
+# query string args of the request: ?size=<rows per page>&after=<cursor> or
+# &before=<cursor>, and &total=1 to also count the rows.
+def pageArgs(args):
+    size = args.get('size', PAGE_SIZE, type=int)
+    return dict(limit=max(1, min(size, MAX_PAGE_SIZE)),
+                after=args.get('after'),
+                before=args.get('before'),
+                withTotal=bool(args.get('total')))
+
+
+# Return the text searched by ?q=<text> and the number of results asked by
+# ?size=<results> (default SEARCH_LIMIT), see Model.searchPersons().
+def searchArgs(args):
+    size = args.get('size', SEARCH_LIMIT, type=int)
+    return args.get('q', '').strip(), max(1, min(size, MAX_PAGE_SIZE))
+
+
+# Return the kind and the arguments of the job asked by the JSON body of a
+# POST to /jobs/: {"kind": <kind>, "args": [...]}. Raise ValueError if it is
+# malformed.
+def jobRequest(body):
+    if not isinstance(body, dict):
+        raise ValueError("the body is not a JSON object")
+    args = body.get('args', [])
+    if not isinstance(args, list):
+        raise ValueError("args is not a list")
+    return body.get('kind'), args
+
+
+################################################################
+####              TABLES OF THE PAGES                       ####
+################################################################
+
+
+# The context of listing.html for the list of persons, or for the persons
+# found by text if it is not empty (see searchArgs()).
+def personsContext(pers, text):
+    if text:
+        keys = ['', 'Name', 'Phone', 'Details', 'Delete']
+        name = f'Persons found by "{text}"'
+    else:
+        keys = [
+            '', 'Lastname', 'Firstname', 'Address', 'Phone', '#Curriculums',
+            'Details', 'Delete'
+        ]
+        name = "Persons"
+    return dict(to_list=[(pers, keys, name)], title='Persons', search=text)
+
+
+# The context of listing.html for the page of a person, see Model.personPage().
+def personContext(page):
+    name, curri, exams = page
+    keys_exams = [
+        '', 'Date', 'Curriculum', 'Course', 'Validation', 'Grade'
+    ]
+    keys_curri = ['Curriculum Name', 'Grade']
+    return dict(
+        to_list=[
+            (curri, keys_curri, "Summary of " + name),
+            (exams, keys_exams, "Detailed grades of student " + name)
+        ],
+        title='Person ' + name)
+
+
+def curriculumsContext(curriculums):
+    keys = [
+        '', 'Name', 'Director Lastname', 'Firstname', 'Secretary Lastname',
+        'Firstname', 'Details', 'Delete'
+    ]
+    return dict(to_list=[(curriculums, keys, "Curriculums")], title='Curriculums')
+
+
+# The context of listing.html for the page of a curriculum, see
+# Model.curriculumPage().
+def curriculumContext(page):
+    name, avg, cou = page
+    keys_avg = ['Lastname', 'Firstname', 'totalGrade']
+    keys_cou = [
+        '', 'Name', 'Teacher Lastname', 'Teacher Firstname', 'ECTS',
+        'Delete'
+    ]
+    return dict(
+        to_list=[
+            (avg, keys_avg, "Averaged grades of curriculum " + name),
+            (cou, keys_cou, "Courses of curriculum " + name),
+        ],
+        title='Curriculum ' + name)
+
+
+# The context of listing.html for the list of courses, or for the courses
+# found by text if it is not empty.
+def coursesContext(courses, text):
+    if text:
+        keys = ['', 'Name', 'Teacher', 'Details', 'Delete']
+        name = f'Courses found by "{text}"'
+    else:
+        keys = [
+            '', 'Name', '', 'Teacher lastname', 'Teacher firstname', 'Details',
+            'Delete'
+        ]
+        name = "Courses"
+    return dict(to_list=[(courses, keys, name)], title='Courses', search=text)
+
+
+# The context of listing.html for the page of a course, see Model.coursePage().
+def courseContext(page):
+    name, curri, exams, grades, students = page
+    keys_grades = [
+        '', 'Date', 'Curriculum', 'Student lastname', 'Student firstname',
+        'Validation', 'Grade', 'Coef'
+    ]
+    keys_exams = ['', 'Date', 'Name', 'Coef', 'Details']
+    keys_curri = ['', 'Curriculum', 'ECTS']
+    keys_students = ['', 'Lastname', 'Firstname']
+    return dict(
+        to_list=[(curri, keys_curri, "Curriculums of course " + name),
+                 (exams, keys_exams, "List of exams for course " + name),
+                 (grades, keys_grades, "Grades of course " + name),
+                 (students, keys_students, "Students of course " + name)])
+
+
+# The context of listing.html for the page of a validation, see
+# Model.validationPage().
+def validationContext(page):
+    name, grades, students = page
+    keys_grades = ['Grade', 'Firstname', 'Lastname']
+    return dict(to_list=[(grades, keys_grades, "Grades of " + name)])
+
+
+# The context of listing.html for the report of an import of grades in the
+# validation named name, see Model.importGrades().
+def importContext(name, imported, errors):
+    keys_errors = ['Line', 'Student', 'Error']
+    return dict(
+        to_list=[(errors, keys_errors,
+                  f"Imported {imported} grades of " + name +
+                  f", {len(errors)} lines rejected")],
+        title='Import of grades')
+
+
+# The context of listing.html for a statistics page, given
+# analytics.Statistics: the summary of the averages and of its parts (courses
+# or validations, weighted by the given column), the distribution of the
+# averages and the ranks of the students.
+def statisticsContext(stats, weight, parts):
+    keys_summary = ['Name', weight, 'Students', 'Mean', 'Median', 'Std dev', 'Min', 'Max', 'Failed %']
+    keys_distribution = ['Average', 'Students', '%']
+    keys_students = ['', 'Lastname', 'Firstname', 'Average', 'Rank', 'Percentile']
+    return dict(
+        to_list=[
+            (stats.summary, keys_summary, f"Averages in {stats.name} and in its {parts}"),
+            (stats.distribution, keys_distribution, "Distribution of the averages in " + stats.name),
+            (stats.students, keys_students, "Ranks of the students in " + stats.name),
+        ],
+        title='Statistics of ' + stats.name)
+
+
+def jobsContext(jobList):
+    keys = ['', 'Kind', 'Arguments', 'Status', 'Progress %', 'Message', 'Attempts',
+            'Created', 'Finished', 'Details']
+    return dict(to_list=[(jobList, keys, "Jobs")], title='Jobs')
+
+
+################################################################
+####              EXPORTS                                   ####
+################################################################
+
+
+# The headers of the response of an export named filename in the format fmt.
+def exportHeaders(filename, fmt):
+    return {'Content-Disposition': f'attachment; filename="{filename}.{fmt}"'}
+
+
+# The first line of an export in the format fmt: the names of the columns for
+# CSV, nothing for NDJSON.
+def exportHeader(fmt, columns):
+    return ",".join(columns) + "\r\n" if fmt == 'csv' else ""
+
+
+# The text of a batch of rows of an export, as CSV or as NDJSON (one JSON
+# object per line, named by columns) depending on fmt.
+def exportRows(fmt, columns, rows):
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue()
+    return "".join(json.dumps(dict(zip(columns, row)), default=encodeValue) + "\n"
+                   for row in rows)
+
+
+def encodeValue(value):
+    return float(value) if isinstance(value, Decimal) else str(value)